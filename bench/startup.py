@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+'''
+Measure the startup time of the evaluation scripts, and check that they only
+import the heavy modules that the selected analysis needs.
+
+Each case runs a script on a tiny input, so the time is almost all spent
+starting up and importing modules. The best wall-clock time of several runs
+is reported with the heavy modules that were imported, found with
+"python -X importtime". Any heavy module that a case is not expected to
+need is reported as unexpected, and the exit status is then 1.
+
+Usage:
+  bench/startup.py --repeat 5
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that take a noticeable time to import
+HEAVY_MODULES = ['numpy', 'nltk', 'sacrebleu', 'cairosvg', 'multiprocessing']
+
+TREE = '(ROOT (S (NP (DT the) (NN cat)) (VP (VBD sat))))\n'
+
+# (name, script, arguments, file to read stdin from, heavy modules needed),
+# where the files are given by the names they are written to in write_inputs
+CASES = [
+  ('compare-mt single', 'compare-mt.py', ['ref', 'sys1'], None, {'numpy'}),
+  ('compare-mt pair', 'compare-mt.py', ['ref', 'sys1', 'sys2'], None, {'numpy'}),
+  ('paired-bootstrap acc', 'paired-bootstrap.py', ['ref', 'sys1', 'sys2', '--num_samples', '100'], None, {'numpy'}),
+  ('paired-bootstrap bleu', 'paired-bootstrap.py', ['ref', 'sys1', 'sys2', '--num_samples', '100', '--eval_type', 'bleu'], None, {'numpy'}),
+  ('paired-bootstrap bleu_detok', 'paired-bootstrap.py', ['ref', 'sys1', 'sys2', '--num_samples', '100', '--eval_type', 'bleu_detok'], None, {'numpy', 'sacrebleu'}),
+  ('paired-bootstrap chrf', 'paired-bootstrap.py', ['ref', 'sys1', 'sys2', '--num_samples', '100', '--eval_type', 'chrf'], None, {'numpy'}),
+  ('paired-bootstrap ter', 'paired-bootstrap.py', ['ref', 'sys1', 'sys2', '--num_samples', '100', '--eval_type', 'ter'], None, {'numpy', 'sacrebleu'}),
+  ('syntactic-complexity', 'syntactic-complexity.py', [], 'trees', {'numpy'}),
+  ('print-trees svg', 'print-trees.py', ['--out_dir', 'svg'], 'trees', set()),
+  ('syseval-combine', 'syseval-combine.py', ['--src', 'ref', '--ref', 'ref', '--hyps', 'sys1', 'sys2', '--seed', '1',
+                                             '--ids_out', 'eval.ids', '--tsv_out', 'eval.tsv'], None, set()),
+  ('syseval-report', 'syseval-report.py', ['rated.tsv', 'rated.ids', '--num_samples', '100'], None, {'numpy'}),
+]
+
+def write_inputs(dirname):
+  lines = ['the cat sat on the mat .', 'a dog barked at the cat .', 'it was a sunny day .']
+  for name, sents in [('ref', lines), ('sys1', [x.replace('cat', 'dog') for x in lines]),
+                      ('sys2', [x.replace('the', 'a') for x in lines])]:
+    with open(os.path.join(dirname, name), 'w') as f:
+      f.write(''.join(x + '\n' for x in sents * 10))
+  with open(os.path.join(dirname, 'trees'), 'w') as f:
+    f.write(TREE * 10)
+  # A rated evaluation file as written by syseval-combine.py and filled in
+  with open(os.path.join(dirname, 'rated.tsv'), 'w') as tsv, open(os.path.join(dirname, 'rated.ids'), 'w') as ids:
+    tsv.write('Source\tTranslation\tRating\n')
+    for i in range(30):
+      tsv.write('%s\t%s\t%d\n\t%s\t%d\n\n' % (lines[i%3], lines[i%3], i%5+1, lines[(i+1)%3], (i+2)%5+1))
+      ids.write('0\t1\n' if i%2 else '1\t0\n')
+
+def heavy_imports(importtime_output):
+  ''' The heavy modules listed in the output of python -X importtime '''
+  found = set()
+  for line in importtime_output.splitlines():
+    if line.startswith('import time:'):
+      name = line.rsplit('|', 1)[-1].strip().split('.')[0]
+      if name in HEAVY_MODULES:
+        found.add(name)
+  return found
+
+def run_case(script, case_args, stdin_name, dirname, repeat):
+  ''' Run a case, returning its best time and the heavy modules it imported '''
+  cmd = [sys.executable, os.path.join(SCRIPT_DIR, script)] + case_args
+  times = []
+  for _ in range(repeat):
+    stdin = open(os.path.join(dirname, stdin_name)) if stdin_name else subprocess.DEVNULL
+    start = time.perf_counter()
+    subprocess.run(cmd, cwd=dirname, stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    times.append(time.perf_counter() - start)
+    if stdin_name:
+      stdin.close()
+  stdin = open(os.path.join(dirname, stdin_name)) if stdin_name else subprocess.DEVNULL
+  proc = subprocess.run([sys.executable, '-X', 'importtime'] + cmd[1:], cwd=dirname, stdin=stdin,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+  if stdin_name:
+    stdin.close()
+  return min(times), heavy_imports(proc.stderr)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--repeat', type=int, default=5, help='How many times to run each case')
+  args = parser.parse_args()
+
+  start = time.perf_counter()
+  subprocess.run([sys.executable, '-c', 'pass'], check=True)
+  print('%-30s %8.3fs' % ('python (no imports)', time.perf_counter() - start))
+  ok = True
+  with tempfile.TemporaryDirectory() as dirname:
+    write_inputs(dirname)
+    for name, script, case_args, stdin_name, needed in CASES:
+      best, found = run_case(script, case_args, stdin_name, dirname, args.repeat)
+      unexpected = found - needed
+      ok = ok and not unexpected
+      print('%-30s %8.3fs  imports: %s%s' % (name, best, ', '.join(sorted(found)) or '-',
+                                             '  UNEXPECTED: ' + ', '.join(sorted(unexpected)) if unexpected else ''))
+  sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+'''
+A benchmark suite for the evaluation scripts on synthetic corpora.
+
+A reference and system outputs of the given size are generated, with words
+drawn from a Zipfian distribution over the vocabulary and systems that each
+change a different fraction of the reference words. Each script is then
+run on them in its own process: compare-mt.py on one system and on every
+pair of systems, paired-bootstrap.py for each eval type,
+syntactic-complexity.py on random parse trees of the reference, and the
+syseval-combine.py and syseval-report.py pipeline. The wall-clock time,
+throughput in lines per second and peak memory of each case are printed,
+and can be appended to a file of JSON records to compare with earlier runs.
+
+Usage:
+  bench/suite.py --lines 100000 --vocab 20000 --length 25 --systems 3 --results bench.jsonl
+
+With --profile, the scripts are also run with --profile, and the time spent
+in each of their phases is printed after each case.
+'''
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+EVAL_TYPES = ['acc', 'pearson', 'bleu', 'bleu_detok', 'chrf', 'ter']
+LABELS = ['A', 'B', 'C', 'D', 'E']
+PHRASE_LABELS = ['NP', 'VP', 'PP', 'S', 'SBAR', 'ADJP']
+POS_TAGS = ['NN', 'NNS', 'VB', 'VBD', 'DT', 'IN', 'JJ', 'RB', 'PRP']
+
+# Runs a command and prints its peak memory in KB as the last line of stderr.
+# The peak memory of a process includes that of the process it was forked
+# from, so commands are run from this small process rather than the suite.
+MEASURE_CODE = ('import resource, subprocess, sys\n'
+                'ret = subprocess.call(sys.argv[1:])\n'
+                'print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss, file=sys.stderr)\n'
+                'sys.exit(ret)\n')
+
+def write_lines(fname, lines):
+  with open(fname, 'w') as f:
+    f.write(''.join(x + '\n' for x in lines))
+
+def sample_corpus(rng, num_lines, vocab, length):
+  ''' Sample the word IDs and line offsets of a corpus with Zipfian word frequencies '''
+  lengths = np.maximum(1, rng.poisson(length, num_lines))
+  probs = 1.0 / np.arange(1, vocab+1)
+  ids = rng.choice(vocab, size=int(lengths.sum()), p=probs / probs.sum())
+  return ids, np.concatenate([[0], np.cumsum(lengths)])
+
+def corpus_lines(words, ids, offsets, keep=None):
+  ''' The text of each line, leaving out the tokens where keep is False '''
+  tokens = words[ids].tolist()
+  keep = np.ones(len(ids), dtype=bool).tolist() if keep is None else keep.tolist()
+  return [' '.join(x for x, k in zip(tokens[a:b], keep[a:b]) if k) for a, b in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+def random_tree(rng, tokens):
+  ''' A random parse tree over the tokens of a sentence, in Penn treebank format '''
+  nodes = ['(%s %s)' % (POS_TAGS[t], w) for t, w in zip(rng.integers(0, len(POS_TAGS), len(tokens)).tolist(), tokens)]
+  while len(nodes) > 1:
+    start = int(rng.integers(0, len(nodes)-1))
+    end = min(len(nodes), start + int(rng.integers(2, 4)))
+    nodes[start:end] = ['(%s %s)' % (PHRASE_LABELS[int(rng.integers(0, len(PHRASE_LABELS)))], ' '.join(nodes[start:end]))]
+  return '(ROOT %s)' % nodes[0]
+
+def write_data(dirname, args):
+  ''' Write the synthetic reference, system outputs, labels, scores and trees '''
+  rng = np.random.default_rng(args.seed)
+  words = np.array(['w%d' % i for i in range(args.vocab)], dtype=object)
+  ids, offsets = sample_corpus(rng, args.lines, args.vocab, args.length)
+  ref = corpus_lines(words, ids, offsets)
+  write_lines(os.path.join(dirname, 'ref'), ref)
+  gold_labels = rng.integers(0, len(LABELS), args.lines)
+  gold_scores = rng.normal(size=args.lines)
+  write_lines(os.path.join(dirname, 'ref.labels'), [LABELS[x] for x in gold_labels.tolist()])
+  write_lines(os.path.join(dirname, 'ref.scores'), ['%.4f' % x for x in gold_scores.tolist()])
+  for i in range(args.systems):
+    # Each system replaces and drops a different fraction of the words
+    noise = 0.1 + 0.05 * i
+    sys_ids = np.where(rng.random(len(ids)) < noise, rng.integers(0, args.vocab, len(ids)), ids)
+    keep = rng.random(len(ids)) >= noise / 2
+    write_lines(os.path.join(dirname, 'sys%d' % (i+1)), corpus_lines(words, sys_ids, offsets, keep))
+    labels = np.where(rng.random(args.lines) < noise * 3, rng.integers(0, len(LABELS), args.lines), gold_labels)
+    write_lines(os.path.join(dirname, 'sys%d.labels' % (i+1)), [LABELS[x] for x in labels.tolist()])
+    scores = gold_scores + rng.normal(scale=noise * 5, size=args.lines)
+    write_lines(os.path.join(dirname, 'sys%d.scores' % (i+1)), ['%.4f' % x for x in scores.tolist()])
+  write_lines(os.path.join(dirname, 'trees'), [random_tree(rng, x.split()) for x in ref])
+
+def fill_ratings(dirname, seed):
+  ''' Fill in the ratings of the file written by syseval-combine.py with random scores '''
+  rng = np.random.default_rng(seed)
+  with open(os.path.join(dirname, 'eval.tsv')) as f:
+    lines = f.read().split('\n')
+  lines = lines[:1] + [x.replace('XXX', str(int(rng.integers(1, 6)))) for x in lines[1:]]
+  with open(os.path.join(dirname, 'rated.tsv'), 'w') as f:
+    f.write('\n'.join(lines))
+
+def run(cmd, dirname, stdin_name=None):
+  ''' Run a command, returning its wall-clock time, peak memory in MB and stderr '''
+  stdin = open(os.path.join(dirname, stdin_name)) if stdin_name else subprocess.DEVNULL
+  start = time.perf_counter()
+  proc = subprocess.run([sys.executable, '-c', MEASURE_CODE] + cmd, cwd=dirname, stdin=stdin,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+  seconds = time.perf_counter() - start
+  if stdin_name:
+    stdin.close()
+  lines = proc.stderr.rstrip('\n').split('\n')
+  err, peak_kb = '\n'.join(lines[:-1]), lines[-1]
+  if proc.returncode != 0:
+    raise RuntimeError('%s failed:\n%s' % (' '.join(cmd), err))
+  return seconds, int(peak_kb) / 1024., err
+
+def cases(args):
+  ''' The (name, script, arguments, file to read stdin from, number of lines) of each case '''
+  systems = ['sys%d' % (i+1) for i in range(args.systems)]
+  workers = ['--workers', str(args.workers)]
+  ret = [('compare-mt single', 'compare-mt.py', ['ref', 'sys1'] + workers, None, args.lines)]
+  ret.append(('compare-mt single wer', 'compare-mt.py', ['ref', 'sys1', '--wer'] + workers, None, args.lines))
+  if args.systems > 1:
+    ret.append(('compare-mt %d systems' % args.systems, 'compare-mt.py', ['ref'] + systems + workers, None, args.lines))
+    for eval_type in EVAL_TYPES:
+      suffix = {'acc': '.labels', 'pearson': '.scores'}.get(eval_type, '')
+      ret.append(('paired-bootstrap ' + eval_type, 'paired-bootstrap.py',
+                  ['ref' + suffix] + [x + suffix for x in systems] +
+                  ['--eval_type', eval_type, '--num_samples', str(args.num_samples), '--seed', str(args.seed)] + workers,
+                  None, args.lines))
+  ret.append(('syntactic-complexity', 'syntactic-complexity.py', workers, 'trees', args.lines))
+  ret.append(('syseval-combine', 'syseval-combine.py',
+              ['--src', 'ref', '--ref', 'ref', '--hyps'] + systems +
+              ['--lines', str(args.eval_lines), '--seed', str(args.seed), '--ids_out', 'eval.ids', '--tsv_out', 'eval.tsv'],
+              None, args.lines))
+  ret.append(('syseval-report', 'syseval-report.py', ['rated.tsv', 'eval.ids', '--seed', str(args.seed)],
+              None, min(args.lines, args.eval_lines)))
+  return ret
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--lines', type=int, default=10000, help='The number of lines in the synthetic corpora')
+  parser.add_argument('--vocab', type=int, default=10000, help='The size of the vocabulary')
+  parser.add_argument('--length', type=int, default=20, help='The average sentence length')
+  parser.add_argument('--systems', type=int, default=2, help='The number of system outputs')
+  parser.add_argument('--num_samples', type=int, default=1000, help='The number of bootstrap samples for paired-bootstrap.py')
+  parser.add_argument('--eval_lines', type=int, default=1000, help='The number of lines to sample for manual evaluation')
+  parser.add_argument('--workers', type=int, default=1, help='The number of worker processes for the scripts that support them')
+  parser.add_argument('--seed', type=int, default=0, help='The random seed for the data and the scripts')
+  parser.add_argument('--only', type=str, default=None, help='Only run the cases whose names contain this string')
+  parser.add_argument('--data_dir', type=str, default=None, help='Write the synthetic data to this directory and keep it, instead of a temporary one')
+  parser.add_argument('--results', type=str, default=None, help='Append the results to this file as a JSON line')
+  parser.add_argument('--profile', action='store_true', help='Run the scripts with --profile and print their phase timings')
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    dirname = args.data_dir or tmp_dir
+    os.makedirs(dirname, exist_ok=True)
+    start = time.perf_counter()
+    write_data(dirname, args)
+    print('Generated data in %.1fs' % (time.perf_counter() - start))
+    print('%-28s %9s %12s %10s' % ('case', 'seconds', 'lines/s', 'peak MB'))
+    results = []
+    for name, script, case_args, stdin_name, num_lines in cases(args):
+      cmd = [sys.executable, os.path.join(SCRIPT_DIR, script)] + case_args + (['--profile'] if args.profile else [])
+      if args.only and args.only not in name:
+        # syseval-report.py is run on the output of syseval-combine.py
+        if script == 'syseval-combine.py':
+          run(cmd, dirname, stdin_name)
+        continue
+      if script == 'syseval-report.py':
+        fill_ratings(dirname, args.seed)
+      seconds, peak_mb, err = run(cmd, dirname, stdin_name)
+      results.append({'name': name, 'seconds': seconds, 'lines_per_second': num_lines / seconds, 'peak_mb': peak_mb})
+      print('%-28s %9.3f %12.0f %10.1f' % (name, seconds, num_lines / seconds, peak_mb))
+      if args.profile and '--- Profile ---' in err:
+        print(''.join('    ' + x + '\n' for x in err.split('--- Profile ---\n', 1)[1].splitlines()), end='')
+
+  if args.results != None:
+    params = {k: getattr(args, k) for k in ('lines', 'vocab', 'length', 'systems', 'num_samples', 'eval_lines', 'workers', 'seed')}
+    with open(args.results, 'a') as f:
+      f.write(json.dumps({'date': datetime.datetime.now().isoformat(), 'params': params, 'cases': results}) + '\n')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,35 @@
+'''
+Processing chunks of lines in worker processes, for the scripts that take
+--workers.
+
+The input is read in chunks as they are needed, and each is handed to a
+pool of processes. The results come back in the order of the chunks, and
+only a few chunks per worker are read ahead of the ones being processed, so
+memory use doesn't grow with the size of the input.
+'''
+
+import collections
+
+def map_chunks(func, chunks, workers=1):
+  ''' Apply a function to each chunk in order, with up to workers processes
+
+  :param func: the function to apply, which must be defined at the top level
+    of a module so it can be sent to the worker processes
+  :param chunks: an iterable of chunks, which is read lazily
+  :param workers: the number of processes, where 1 or less processes the
+    chunks in this one
+  :returns: a generator of the results of func, in the order of the chunks
+  '''
+  if workers <= 1:
+    for chunk in chunks:
+      yield func(chunk)
+    return
+  import multiprocessing
+  with multiprocessing.Pool(workers) as pool:
+    pending = collections.deque()
+    for chunk in chunks:
+      pending.append(pool.apply_async(func, (chunk,)))
+      if len(pending) > 2 * workers:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
@@ -2,128 +2,55 @@
 #       https://github.com/neulab/compare-mt
 
 import sys
+import os
 import argparse
-import operator
+import gzip
+import hashlib
+import heapq
 import itertools
-import nltk
-from collections import defaultdict
+import json
+from array import array
+import numpy as np
+from ngram_utils import NgramVocab, NgramCounts, WordCounts, group_keys, line_keys, ngram_keys, sentence_bleus_plus1
+from freq_index import FreqIndex, count_train_file, read_train_counts
+from corpus_cache import load_corpus
+from phase_timer import PhaseTimer, NO_TIMER
+from levenshtein import STEPS, distance, step_counts
+
+# The n-gram order used for sentence BLEU
+BLEU_ORDER = 4
+# The number of lines analyzed at once by each worker process
+CHUNK_LINES = 10000
+# The version of the result files, changed whenever their contents change
+RESULTS_VERSION = 4
+# The version of the layout of the statistics files written with --stats_out
+SHARD_VERSION = 1
+# The bits of an n-gram position that hold its token position in the line
+POS_BITS = 24
+# The bit of an n-gram position that holds its side, above the line
+SIDE_BIT = 62
 
 parser = argparse.ArgumentParser(
     description='Program to compare MT results',
 )
 parser.add_argument('ref_file', type=str, help='A path to a correct reference file')
-parser.add_argument('out_file', type=str, help='A path to a system output')
-parser.add_argument('out2_file', nargs='?', type=str, default=None, help='A path to another system output. Add only if you want to compare outputs from two systems.')
+parser.add_argument('out_files', nargs='+', type=str, help='Paths to system outputs. Add a second output if you want to compare outputs from two systems, or more to compare every pair of systems.')
 parser.add_argument('--train_file', type=str, default=None, help='A link to the training corpus target file')
 parser.add_argument('--train_counts', type=str, default=None, help='A link to the training word frequency counts as a tab-separated "word\\tfreq" file')
+parser.add_argument('--train_index', type=str, default=None, help='A prefix of training word frequency index files built with freq_index.py, which is faster to load than --train_file or --train_counts')
 parser.add_argument('--alpha', type=float, default=1.0, help='A smoothing coefficient to control how much the model focuses on low- and high-frequency events. 1.0 should be fine most of the time.')
 parser.add_argument('--ngram', type=int, default=4, help='Maximum length of n-grams.')
 parser.add_argument('--ngram_size', type=int, default=50, help='How many n-grams to print.')
 parser.add_argument('--sent_size', type=int, default=10, help='How many sentences to print.')
-args = parser.parse_args()
-
-with open(args.ref_file, "r") as f:
-  ref = [line.strip().split() for line in f]
-with open(args.out_file, "r") as f:
-  out = [line.strip().split() for line in f]
-if args.out2_file != None:
-  with open(args.out2_file, "r") as f:
-    out2 = [line.strip().split() for line in f]
-
-def calc_ngrams(sent):
-  ret = defaultdict(lambda: 0)
-  for n in range(args.ngram):
-    for i in range(len(sent)-n):
-      ret[tuple(sent[i:i+n+1])] += 1
-  return ret
-
-def match_ngrams(left, right):
-  ret = defaultdict(lambda: 0)
-  for k, v in left.items():
-    if k in right:
-      ret[k] = min(v, right[k])
-  return ret
-
-# Calculate over and under-generated n-grams for two corpora
-def calc_over_under(ref, out, alpha):
-  # Create n-grams
-  refall = defaultdict(lambda: 0)
-  outall = defaultdict(lambda: 0)
-  for refsent, outsent in zip(ref, out):
-    for k, v in calc_ngrams(refsent).items():
-      refall[k] += v
-    for k, v in calc_ngrams(outsent).items():
-      outall[k] += v
-  # Calculate scores
-  scores = {}
-  for k, v in refall.items():
-    scores[k] = (v + args.alpha) / (v + outall[k] + 2*args.alpha)
-  for k, v in outall.items():
-    scores[k] = (refall[k] + args.alpha) / (refall[k] + v + 2*args.alpha)
-  return refall, outall, scores
-
-# Calculate over and under-generated n-grams for two corpora
-def calc_compare(ref, out, out2, alpha):
-  outall = defaultdict(lambda: 0)
-  out2all = defaultdict(lambda: 0)
-  for refsent, outsent, out2sent in zip(ref, out, out2):
-    refn = calc_ngrams(refsent)
-    outmatch = match_ngrams(refn, calc_ngrams(outsent))
-    out2match = match_ngrams(refn, calc_ngrams(out2sent))
-    for k, v in outmatch.items():
-      if v > out2match[k]:
-        outall[k] += v - out2match[k]
-    for k, v in out2match.items():
-      if v > outmatch[k]:
-        out2all[k] += v - outmatch[k]
-  # Calculate scores
-  scores = {}
-  for k, v in out2all.items():
-    scores[k] = (v + args.alpha) / (v + outall[k] + 2*args.alpha)
-  for k, v in outall.items():
-    scores[k] = (out2all[k] + args.alpha) / (out2all[k] + v + 2*args.alpha)
-  return outall, out2all, scores
-
-# Calculate the frequency counts, from the training corpus
-# or training frequency file if either are specified, from the
-# reference file if not
-freq_counts = defaultdict(lambda: 0)
-if args.train_counts != None:
-  with open(args.train_counts, "r") as f:
-    for line in f:
-      word, freq = line.strip().split('\t')
-      freq_counts[word] = freq
-else:
-  my_file = args.train_file if args.train_file != None else args.ref_file
-  with open(my_file, "r") as f:
-    for line in f:
-      for word in line.strip().split():
-        freq_counts[word] += 1 
-
-def calc_matches_by_freq(ref, out, buckets):
-  extended_buckets = buckets + [max(freq_counts.values()) + 1]
-  matches = [[0,0,0] for x in extended_buckets]
-  for refsent, outsent in zip(ref, out):
-    reffreq, outfreq = defaultdict(lambda: 0), defaultdict(lambda: 0)
-    for x in refsent:
-      reffreq[x] += 1
-    for x in outsent:
-      outfreq[x] += 1
-    for k in set(itertools.chain(reffreq.keys(), outfreq.keys())):
-      for bucket, match in zip(extended_buckets, matches):
-        if freq_counts[k] < bucket:
-          match[0] += min(reffreq[k], outfreq[k])
-          match[1] += reffreq[k]
-          match[2] += outfreq[k]
-          break 
-  for bothf, reff, outf in matches:
-    if bothf == 0:
-      rec, prec, fmeas = 0.0, 0.0, 0.0
-    else:
-      rec = bothf / float(reff)
-      prec = bothf / float(outf)
-      fmeas = 2 * prec * rec / (prec + rec)
-    yield bothf, reff, outf, rec, prec, fmeas
+parser.add_argument('--wer', action='store_true', help='Also align every output with the reference as Levenshtein.pm does, and print the number of each kind of edit and the word error rate.')
+parser.add_argument('--workers', type=int, default=1, help='How many worker processes to analyze the corpus with.')
+parser.add_argument('--stats_cache', type=str, default=None, help='A file to keep the --wer edit steps of each line in between runs, so that the lines that haven\'t changed since the last run with the same reference aren\'t aligned again. It can only be used with --wer, and lines are analyzed in one process with it.')
+parser.add_argument('--corpus_cache', type=str, default=None, help='A directory of tokenized corpora built with corpus_cache.py, which are read instead of the reference and output files, and added to it if they are not there yet.')
+parser.add_argument('--profile', action='store_true', help='Print the time spent loading, counting n-grams, scoring and writing output to stderr.')
+parser.add_argument('--json_out', type=str, default=None, help='Write the full analysis results to this file as gzipped JSON.')
+parser.add_argument('--stats_out', type=str, default=None, help='Write the statistics of the corpus to this file instead of printing a report, so that the statistics of shards of a larger corpus can be combined with --merge_stats.')
+parser.add_argument('--merge_stats', action='store_true', help='Print the report of a corpus from the statistics of its shards, written with --stats_out and given in order instead of the reference and output files.')
+parser.add_argument('--cache_dir', type=str, default=None, help='A directory to cache the full analysis results in, keyed by a hash of the inputs and parameters. Reports with different --ngram_size or --sent_size are then printed without re-analyzing the corpus.')
 
 buckets = [1, 2, 3, 4, 5, 10, 100, 1000]
 bucket_strs = []
@@ -136,72 +63,932 @@ for x in buckets:
   last_start = x
 bucket_strs.append("{}+".format(last_start))
 
-# Analyze the reference/output
-if args.out2_file == None:
-  refall, outall, scores = calc_over_under(ref, out, args.alpha)
-  scorelist = sorted(scores.items(), key=operator.itemgetter(1))
+# Read a file line by line as lists of tokens, or from the tokenized corpus
+# cache if one is given
+def read_lines(fname, corpus_cache=None):
+  if corpus_cache != None:
+    yield from load_corpus(fname, corpus_cache).lines()
+    return
+  with open(fname, "r") as f:
+    for line in f:
+      yield line.split()
+
+# Read aligned files line by line, so the text of the corpora never needs to
+# be in memory
+def read_corpora(fnames, corpus_cache=None):
+  return zip(*[read_lines(x, corpus_cache) for x in fnames])
+
+# The position of every n-gram occurrence, ordered by side, then by line,
+# order, and the position of its first token in the line. N-grams with equal
+# scores are sorted by these, so that as in the original script the n-grams
+# of one side (the reference, or the second system when comparing systems)
+# come first in the order they are first seen, followed by the rest.
+def ngram_positions(line_ids, starts, orders, offsets, side, max_order):
+  return (side << SIDE_BIT) + (((line_ids * max_order + orders - 1) << POS_BITS) + starts - offsets[line_ids])
+
+# The difference between the positions of the same n-gram in consecutive lines
+def line_stride(max_order):
+  return max_order << POS_BITS
+
+# Calculate scores for every n-gram, and return their indices sorted by score
+# (ties broken by first occurrence) with the scores. If max_ngrams is given,
+# only the n-grams that can be among the max_ngrams with the lowest or
+# highest scores are sorted and returned
+def calc_scores(left, right, first, alpha, max_ngrams=None):
+  scores = (left + alpha) / (left + right + 2*alpha)
+  if max_ngrams is None or 2*max_ngrams >= len(scores):
+    ids = np.arange(len(scores))
+  elif max_ngrams == 0:
+    ids = np.zeros(0, dtype=np.int64)
+  else:
+    parts = np.partition(scores, [max_ngrams-1, len(scores)-max_ngrams])
+    ids = np.flatnonzero((scores <= parts[max_ngrams-1]) | (scores >= parts[len(scores)-max_ngrams]))
+  ids = ids[np.lexsort((first[ids], scores[ids]))]
+  return ids, scores[ids]
+
+# A chunk of lines of one file, as word IDs and the keys of every n-gram
+# occurrence in them
+class EncodedLines(object):
+  def __init__(self, vocab, lines, max_order):
+    self.wids, self.offsets = vocab.encode_lines(lines)
+    self.lens = np.diff(self.offsets)
+    ngrams = ngram_keys(vocab.hashes()[self.wids], self.offsets, max_order)
+    self.keys = np.concatenate([k for k, p in ngrams])
+    self.starts = np.concatenate([p for k, p in ngrams])
+    self.orders = np.repeat(np.arange(1, max_order+1), [len(k) for k, p in ngrams])
+    self.line_ids = np.repeat(np.arange(len(lines)), self.lens)[self.starts]
+
+  def positions(self, side, max_order):
+    return ngram_positions(self.line_ids, self.starts, self.orders, self.offsets, side, max_order)
+
+  def line_counts(self, max_order):
+    # The distinct n-grams up to max_order in each line, as line keys, and
+    # how often each appears in its line
+    sel = self.orders <= max_order
+    return np.unique(line_keys(self.keys[sel], self.line_ids[sel]), return_counts=True)
+
+  def tokens(self):
+    # The word IDs of each line, as lists
+    wids = self.wids.tolist()
+    return [wids[a:b] for a, b in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())]
+
+# A chunk of reference lines, with the distinct n-grams of each line counted,
+# so that the clipped matches of a system output are found for all the lines
+# at once. None of this depends on the outputs, so eval-server.py keeps it
+# between requests.
+class ReferenceLines(object):
+  def __init__(self, vocab, lines, max_order):
+    self.max_order = max_order
+    enc = EncodedLines(vocab, lines, max_order)
+    self.wids, self.offsets, self.lens = enc.wids, enc.offsets, enc.lens
+    # One entry per distinct n-gram of each line, sorted by line key
+    lkeys = line_keys(enc.keys, enc.line_ids)
+    perm, starts = group_keys(lkeys)
+    rep = perm[starts]
+    self.line_keys = lkeys[rep]
+    self.counts = np.diff(np.append(starts, len(lkeys)))
+    self.keys, self.orders, self.line_ids, self.starts = enc.keys[rep], enc.orders[rep], enc.line_ids[rep], enc.starts[rep]
+    self.positions = (np.minimum.reduceat(enc.positions(0, max_order)[perm], starts) if len(starts) else
+                      np.zeros(0, dtype=np.int64))
+    # the counts of the n-grams of each order over all the lines, by order
+    self.tables = {}
+
+  def ngram_table(self, order):
+    # The n-grams of one order counted over all the lines, as given by
+    # NgramCounts.table, which are kept as they are the same for every output
+    if order not in self.tables:
+      ids = np.flatnonzero(self.orders == order)
+      counts = NgramCounts(order)
+      counts.add(order, self.keys[ids], self.counts[ids, None], self.positions[ids], self.wids, self.starts[ids])
+      self.tables[order] = counts.table(order)
+    return self.tables[order]
+
+  def matches(self, out, max_order):
+    # The clipped matches of an output with each n-gram of each line, for
+    # n-grams up to max_order
+    ret = np.zeros(len(self.line_keys), dtype=np.int64)
+    if len(self.line_keys):
+      keys, counts = out.line_counts(max_order)
+      ids = np.minimum(np.searchsorted(self.line_keys, keys), len(self.line_keys)-1)
+      hit = self.line_keys[ids] == keys
+      ret[ids[hit]] = np.minimum(self.counts[ids[hit]], counts[hit])
+    return ret
+
+  def match_orders(self, matches, max_order):
+    # The matches of each line, summed for each n-gram order up to max_order
+    sel = self.orders <= max_order
+    sums = np.bincount(self.line_ids[sel] * max_order + self.orders[sel] - 1, weights=matches[sel],
+                       minlength=len(self.lens) * max_order)
+    return sums.astype(np.int64).reshape(len(self.lens), max_order)
+
+  def tokens(self):
+    wids = self.wids.tolist()
+    return [wids[a:b] for a, b in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())]
+
+# Over and under-generated n-grams for two corpora
+class OverUnderAnalysis(object):
+  def __init__(self, max_order):
+    self.max_order = max_order
+    # the reference and output counts of every n-gram on either side
+    self.counts = NgramCounts(max_order, 2)
+
+  def add(self, ref, out, first_offset):
+    out_positions = out.positions(1, ref.max_order)
+    for n in range(1, self.max_order+1):
+      keys, ref_counts, first, words = ref.ngram_table(n)
+      counts = np.zeros((len(keys), 2), dtype=np.int64)
+      counts[:, 0] = ref_counts[:, 0]
+      self.counts.add_table(n, keys, counts, first + first_offset, words)
+      o = np.flatnonzero(out.orders == n)
+      counts = np.zeros((len(o), 2), dtype=np.int64)
+      counts[:, 1] = 1
+      self.counts.add(n, out.keys[o], counts, out_positions[o] + first_offset, out.wids, out.starts[o])
+
+  def merge(self, other, word_remap, first_offset):
+    self.counts.merge(other.counts, word_remap, first_offset)
+
+  def result(self, alpha, max_ngrams=None):
+    counts, first, words = self.counts.tables()
+    refall, outall = counts[:, 0], counts[:, 1]
+    return (refall, outall, words) + calc_scores(refall, outall, first, alpha, max_ngrams)
+
+# N-grams that one system matched in the reference more often than the other
+class CompareAnalysis(object):
+  def __init__(self, max_order):
+    self.max_order = max_order
+    # how many more times the first and the second system matched each n-gram
+    self.counts = NgramCounts(max_order, 2)
+
+  def add(self, ref, outmatch, out2match, first_offset):
+    diff = outmatch - out2match
+    differs = diff != 0
+    for n in range(1, self.max_order+1):
+      ids = np.flatnonzero(differs & (ref.orders == n))
+      d = diff[ids]
+      # n-grams the second system matched more often come first
+      sides = (d > 0).astype(np.int64) << SIDE_BIT
+      self.counts.add(n, ref.keys[ids], np.stack([np.maximum(d, 0), np.maximum(-d, 0)], axis=1),
+                      ref.positions[ids] + sides + first_offset, ref.wids, ref.starts[ids])
+
+  def merge(self, other, word_remap, first_offset):
+    self.counts.merge(other.counts, word_remap, first_offset)
+
+  def result(self, alpha, max_ngrams=None):
+    counts, first, words = self.counts.tables()
+    outall, out2all = counts[:, 0], counts[:, 1]
+    return (outall, out2all, words) + calc_scores(out2all, outall, first, alpha, max_ngrams)
+
+# Word matches of a system, kept per word so that they can be
+# divided into frequency buckets after the whole corpus is read
+class FreqMatchAnalysis(object):
+  def __init__(self):
+    self.both = WordCounts()
+    self.ref = WordCounts()
+    self.out = WordCounts()
+
+  def add(self, ref, out, matches):
+    unigrams = np.flatnonzero(ref.orders == 1)
+    self.both.add(ref.wids[ref.starts[unigrams]], matches[unigrams])
+    self.ref.add(ref.wids)
+    self.out.add(out.wids)
+
+  def merge(self, other, word_remap, first_offset):
+    self.both.merge(other.both, word_remap)
+    self.ref.merge(other.ref, word_remap)
+    self.out.merge(other.out, word_remap)
+
+  def result(self, freqs, buckets):
+    # freqs are the training frequencies of every word in the vocabulary
+    size = len(freqs)
+    both, ref, out = self.both.array(size), self.ref.array(size), self.out.array(size)
+    bucket_ids = np.searchsorted(buckets, freqs, side='right')
+    matches = np.stack([np.bincount(bucket_ids, weights=x, minlength=len(buckets)+1).astype(np.int64)
+                        for x in (both, ref, out)], axis=-1).tolist()
+    for bothf, reff, outf in matches:
+      if bothf == 0:
+        rec, prec, fmeas = 0.0, 0.0, 0.0
+      else:
+        rec = bothf / float(reff)
+        prec = bothf / float(outf)
+        fmeas = 2 * prec * rec / (prec + rec)
+      yield bothf, reff, outf, rec, prec, fmeas
+
+# Total lengths and the histogram of length differences from the reference
+class LengthAnalysis(object):
+  def __init__(self):
+    self.length_ref = 0
+    self.length_out = 0
+    self.length_diff = {}
+
+  def add(self, ref_lens, out_lens):
+    self.length_ref += int(ref_lens.sum())
+    self.length_out += int(out_lens.sum())
+    diffs, counts = np.unique(out_lens - ref_lens, return_counts=True)
+    for ld, count in zip(diffs.tolist(), counts.tolist()):
+      self.length_diff[ld] = self.length_diff.get(ld,0) + count
+
+  def merge(self, other, word_remap, first_offset):
+    self.length_ref += other.length_ref
+    self.length_out += other.length_out
+    for ld, count in other.length_diff.items():
+      self.length_diff[ld] = self.length_diff.get(ld,0) + count
+
+# The number of each kind of edit step aligning a line of a system output
+# with the reference, in the order of STEPS
+def line_steps(ref, out):
+  counts = step_counts(distance(ref, out)[0])
+  return [counts[x] for x in STEPS]
+
+# The edit operations aligning a system output with the reference, counted
+# over the corpus as in grade.pl
+class ErrorAnalysis(object):
+  def __init__(self):
+    self.counts = dict.fromkeys(STEPS, 0)
+    self.sent_correct = 0
+
+  def add(self, steps):
+    # steps are the line_steps of each line
+    steps = np.array(steps, dtype=np.int64).reshape(-1, len(STEPS))
+    for step, count in zip(STEPS, steps.sum(axis=0).tolist()):
+      self.counts[step] += count
+    # a line is correct when its path only has equal steps
+    self.sent_correct += int((steps[:, STEPS.index('e')] == steps.sum(axis=1)).sum())
+
+  def merge(self, other, word_remap, first_offset):
+    for step, count in other.counts.items():
+      self.counts[step] += count
+    self.sent_correct += other.sent_correct
+
+# The sentences with the largest sentence BLEU+1 differences between two
+# systems, keeping only the sent_size best and worst in bounded heaps so
+# that their text is at hand when the report is printed
+class BleuDiffAnalysis(object):
+  def __init__(self, sent_size):
+    self.sent_size = sent_size
+    # max-heap (by negated keys) of the lowest differences, min-heap of the highest
+    self.lowest = []
+    self.highest = []
+
+  def add(self, i, sents, b1, b2):
+    self._push(self.lowest, (-(b2-b1), -b1, -b2, -i), sents)
+    self._push(self.highest, (b2-b1, b1, b2, i), sents)
+
+  def add_lines(self, start, sents, b1, b2):
+    ''' Add a chunk of lines, pushing only those that could be kept
+
+    :param start: the index of the first line
+    :param sents: a function giving the sentences of a line by its index in the chunk
+    :param b1: an array of the sentence BLEU+1 of system 1 on each line
+    :param b2: an array of the sentence BLEU+1 of system 2 on each line
+    '''
+    order = np.lexsort((b2, b1, b2-b1))
+    sent_size = min(self.sent_size, len(order))
+    for i in sorted(set(order[:sent_size].tolist()) | set(order[len(order)-sent_size:].tolist())):
+      self.add(start+i, sents(i), b1[i], b2[i])
+
+  def _push(self, heap, key, sents):
+    if len(heap) < self.sent_size:
+      heapq.heappush(heap, (key, sents))
+    elif self.sent_size > 0 and key > heap[0][0]:
+      heapq.heapreplace(heap, (key, sents))
+
+  def merge(self, other, word_remap, first_offset):
+    for key, sents in other.lowest:
+      self._push(self.lowest, key, sents)
+    for key, sents in other.highest:
+      self._push(self.highest, key, sents)
+
+  def sentences(self):
+    ''' The text of the kept sentences, by line index '''
+    ret = {-k[3]: s for k, s in self.lowest}
+    ret.update((k[3], s) for k, s in self.highest)
+    return ret
+
+def read_freq_index(args):
+  # Get the frequency counts, from the training frequency index, corpus
+  # or frequency file if any are specified. If not, they are taken
+  # from the reference while it is read for the analysis
+  if args.train_index != None:
+    return FreqIndex.load(args.train_index)
+  elif args.train_counts != None:
+    return FreqIndex.from_counts(read_train_counts(args.train_counts))
+  elif args.train_file != None:
+    return FreqIndex.from_counts(count_train_file(args.train_file))
+  return None
+
+# The --wer edit steps of each line saved between runs, so that when a
+# system output is evaluated again with the same reference, the lines that
+# haven't changed don't need to be aligned again. Lines are stored by a hash
+# of the text of the output line and its reference. Nothing else is cached,
+# as counting the n-grams and working out the sentence BLEU+1 of a chunk of
+# lines is faster than hashing the lines to look them up.
+class LineStatsCache(object):
+  def __init__(self):
+    self.index = {}
+    self.steps = np.zeros((0, len(STEPS)), dtype=np.int64)
+    # the steps of the lines seen in this run
+    self.used = {}
+
+  @classmethod
+  def load(cls, fname):
+    ''' Load a cache, or start an empty one if it doesn't exist or was written by an earlier version '''
+    if not os.path.exists(fname):
+      return cls()
+    with np.load(fname) as data:
+      if 'steps' not in data.files:
+        return cls()
+      return cls.from_arrays(data)
+
+  @classmethod
+  def from_arrays(cls, data):
+    ''' Create a cache from the arrays of a saved one '''
+    cache = cls()
+    cache.steps = data['steps']
+    keys = data['keys'].tobytes()
+    cache.index = {keys[i*16:(i+1)*16]: i for i in range(len(cache.steps))}
+    return cache
+
+  def save(self, fname):
+    ''' Save the lines seen in this run '''
+    # Write to a temporary file first, so that the cache is never left half written
+    with open(fname + '.tmp', 'wb') as f:
+      np.savez(f, **self.arrays())
+    os.replace(fname + '.tmp', fname)
+
+  def renew(self):
+    ''' Get a cache of the lines seen in this run, as if it was saved and loaded again '''
+    return LineStatsCache.from_arrays(self.arrays())
+
+  def arrays(self):
+    ''' The lines seen in this run, as arrays '''
+    return {'keys': np.frombuffer(b''.join(self.used.keys()), dtype=np.uint8),
+            'steps': np.array(list(self.used.values()), dtype=np.int64).reshape(-1, len(STEPS))}
+
+  @staticmethod
+  def line_key(ref, out):
+    ''' A hash of an output line paired with its reference '''
+    return hashlib.blake2b(b'out\0' + ' '.join(ref).encode('utf-8') + b'\0' + ' '.join(out).encode('utf-8'),
+                           digest_size=16).digest()
+
+  def get(self, key):
+    ''' Get the steps of a line, or None if they aren't known '''
+    if key in self.used:
+      return self.used[key]
+    i = self.index.get(key)
+    return None if i is None else self.steps[i].tolist()
+
+  def put(self, key, steps):
+    self.used[key] = steps
+
+# The maximum order of the n-grams counted, as the n-grams for BLEU are also
+# needed when comparing systems
+def analysis_order(num_systems, ngram):
+  return ngram if num_systems == 1 else max(ngram, BLEU_ORDER)
+
+# All the statistics needed for the reports on a reference and one or more
+# systems. Lines are added a chunk at a time, and the statistics of
+# consecutive parts of a corpus can be merged to get those of the whole
+# corpus. Only the current chunk of text is held, but memory still grows
+# with the corpus: each distinct n-gram takes a few dozen bytes in the
+# count arrays (in pair mode, only those the two systems matched a
+# different number of times), and each line its sentence BLEU+1 for
+# every system when comparing systems.
+class CorpusAnalysis(object):
+  def __init__(self, num_systems, ngram, sent_size, wer=False, vocab=None):
+    self.num_systems = num_systems
+    self.ngram = ngram
+    self.num_lines = 0
+    self.max_order = analysis_order(num_systems, ngram)
+    self.vocab = vocab or NgramVocab()
+    self.errors = [ErrorAnalysis() for _ in range(num_systems)] if wer else []
+    self.freq_matches = [FreqMatchAnalysis() for _ in range(num_systems)]
+    if num_systems == 1:
+      self.over_under = OverUnderAnalysis(ngram)
+    else:
+      self.lengths = [LengthAnalysis() for _ in range(num_systems)]
+      self.pairs = [(i, j) for i in range(num_systems) for j in range(i+1, num_systems)]
+      self.compares = {pair: CompareAnalysis(ngram) for pair in self.pairs}
+      self.bleu_diffs = {pair: BleuDiffAnalysis(sent_size) for pair in self.pairs}
+      self.sent_bleus = [array('d') for _ in range(num_systems)]
+
+  def add_lines(self, refs, outs, ref=None, cache=None):
+    ''' Add a chunk of lines
+
+    :param refs: the reference lines, each a list of tokens
+    :param outs: the lines of each system output
+    :param ref: the ReferenceLines of refs, if they have already been encoded
+      with the vocabulary of this analysis
+    :param cache: a LineStatsCache to take per-line statistics from and add them to
+    '''
+    start = self.num_lines
+    self.num_lines += len(refs)
+    first_offset = start * line_stride(self.max_order)
+    if ref is None:
+      ref = ReferenceLines(self.vocab, refs, self.max_order)
+    encoded = [EncodedLines(self.vocab, x, self.max_order) for x in outs]
+    # Only word matches are needed for a single system
+    matches = [ref.matches(x, 1 if self.num_systems == 1 else self.max_order) for x in encoded]
+    for out, match, freq_match in zip(encoded, matches, self.freq_matches):
+      freq_match.add(ref, out, match)
+    bleus, steps = self.line_stats(refs, outs, ref, encoded, matches, cache)
+    for errors, sys_steps in zip(self.errors, steps):
+      errors.add(sys_steps)
+    if self.num_systems == 1:
+      self.over_under.add(ref, encoded[0], first_offset)
+      return
+    for out, length, sys_bleus, sent_bleu in zip(encoded, self.lengths, bleus, self.sent_bleus):
+      length.add(ref.lens, out.lens)
+      sent_bleu.extend(sys_bleus)
+    sents = lambda i: [refs[i]] + [x[i] for x in outs]
+    for s1, s2 in self.pairs:
+      self.compares[s1,s2].add(ref, matches[s1], matches[s2], first_offset)
+      self.bleu_diffs[s1,s2].add_lines(start, sents, bleus[s1], bleus[s2])
+
+  def line_stats(self, refs, outs, ref, encoded, matches, cache):
+    # The sentence BLEU+1 of each line of each system when comparing systems,
+    # and the edit steps with --wer, taking those of unchanged lines from the
+    # cache if there is one
+    bleus, steps = [], []
+    ref_tokens = ref.tokens() if self.errors else None
+    for out_lines, out, match in zip(outs, encoded, matches):
+      if self.num_systems > 1:
+        bleus.append(sentence_bleus_plus1(ref.match_orders(match, BLEU_ORDER), out.lens, ref.lens))
+      if not self.errors:
+        continue
+      out_tokens = out.tokens()
+      if cache is None:
+        steps.append([line_steps(r, o) for r, o in zip(ref_tokens, out_tokens)])
+        continue
+      sys_steps = []
+      for r, o, ref_line, out_line in zip(ref_tokens, out_tokens, refs, out_lines):
+        key = cache.line_key(ref_line, out_line)
+        line = cache.get(key)
+        if line is None:
+          line = line_steps(r, o)
+        cache.put(key, line)
+        sys_steps.append(line)
+      steps.append(sys_steps)
+    return bleus, steps
+
+  def merge(self, other):
+    # Sentence indices and n-gram positions in the other analysis are
+    # relative to its first line
+    for bleu_diff in getattr(other, 'bleu_diffs', {}).values():
+      bleu_diff.lowest = [((k[0], k[1], k[2], k[3]-self.num_lines), s) for k, s in bleu_diff.lowest]
+      bleu_diff.highest = [((k[0], k[1], k[2], k[3]+self.num_lines), s) for k, s in bleu_diff.highest]
+    first_offset = self.num_lines * line_stride(self.max_order)
+    self.num_lines += other.num_lines
+    for sent_bleu, other_sent_bleu in zip(getattr(self, 'sent_bleus', []), getattr(other, 'sent_bleus', [])):
+      sent_bleu.extend(other_sent_bleu)
+    word_remap = self.vocab.merge(other.vocab)
+    analyses = self.freq_matches + self.errors + ([self.over_under] if self.num_systems == 1 else
+                                    self.lengths + [self.compares[x] for x in self.pairs] + [self.bleu_diffs[x] for x in self.pairs])
+    other_analyses = other.freq_matches + other.errors + ([other.over_under] if other.num_systems == 1 else
+                                           other.lengths + [other.compares[x] for x in other.pairs] + [other.bleu_diffs[x] for x in other.pairs])
+    for analysis, other_analysis in zip(analyses, other_analyses):
+      analysis.merge(other_analysis, word_remap, first_offset)
+
+def split_lines(lines):
+  # The reference lines and the lines of each system output of a chunk of
+  # aligned lines
+  columns = [list(x) for x in zip(*lines)]
+  return columns[0], columns[1:]
+
+def analyze_chunk(chunk):
+  num_systems, ngram, sent_size, wer, lines = chunk
+  analysis = CorpusAnalysis(num_systems, ngram, sent_size, wer)
+  analysis.add_lines(*split_lines(lines))
+  return analysis
+
+# A reference read and encoded once, with the distinct n-grams of each line
+# counted, so that eval-server.py can analyze any number of requests on it
+# while only reading and counting the system outputs. The vocabulary is
+# copied for each analysis, which adds the words of the outputs to it.
+class EncodedReference(object):
+  def __init__(self, ref_file, max_order, corpus_cache=None):
+    self.max_order = max_order
+    self.vocab = NgramVocab()
+    # the reference lines and their ReferenceLines, for each chunk of lines
+    self.chunks = []
+    lines = read_corpora([ref_file], corpus_cache)
+    for chunk in iter(lambda: list(itertools.islice(lines, CHUNK_LINES)), []):
+      refs = [x[0] for x in chunk]
+      self.chunks.append((refs, ReferenceLines(self.vocab, refs, max_order)))
+
+  def add_outputs(self, analysis, out_files, corpus_cache=None, cache=None):
+    ''' Add the lines of system outputs to an analysis whose vocabulary was copied from this one '''
+    files = [read_lines(x, corpus_cache) for x in out_files]
+    for refs, ref in self.chunks:
+      outs = [list(itertools.islice(x, len(refs))) for x in files]
+      num_lines = min(len(x) for x in outs)
+      if num_lines == 0:
+        break
+      # As with read_corpora, lines past the end of the shortest file are left out
+      if num_lines < len(refs):
+        refs, ref, outs = refs[:num_lines], None, [x[:num_lines] for x in outs]
+      analysis.add_lines(refs, outs, ref=ref, cache=cache)
+
+def analyze_corpus(ref_file, out_files, ngram, sent_size, workers=1, stats_cache=None, corpus_cache=None, wer=False,
+                   reference=None, timer=NO_TIMER):
+  # Read all the files in a single pass, feeding every analysis a chunk of
+  # lines at a time. With more than one worker, chunks are analyzed in
+  # parallel and merged in order. If a statistics cache file is given with
+  # --wer (it is ignored without), the edit steps of the lines in it are not worked out again, and
+  # it is updated with the lines of this run. A LineStatsCache can also be
+  # given, which is left for the caller to keep or save, and an
+  # EncodedReference of ref_file, so that only the outputs are read.
+  analysis = CorpusAnalysis(len(out_files), ngram, sent_size, wer, vocab=reference.vocab.copy() if reference else None)
+  cache = stats_cache if wer else None
+  if cache != None and not isinstance(cache, LineStatsCache):
+    cache = LineStatsCache.load(stats_cache)
+  with timer.phase('count'):
+    if reference is not None:
+      reference.add_outputs(analysis, out_files, corpus_cache, cache)
+      return analysis
+    lines = timer.iterate('load', read_corpora([ref_file] + out_files, corpus_cache))
+    chunks = iter(lambda: list(itertools.islice(lines, CHUNK_LINES)), [])
+    if cache != None or workers <= 1:
+      for chunk in chunks:
+        analysis.add_lines(*split_lines(chunk), cache=cache)
+      if cache is not None and cache is not stats_cache:
+        cache.save(stats_cache)
+    else:
+      import multiprocessing
+      with multiprocessing.Pool(workers) as pool:
+        for chunk_analysis in pool.imap(analyze_chunk, ((len(out_files), ngram, sent_size, wer, x) for x in chunks)):
+          analysis.merge(chunk_analysis)
+  return analysis
+
+def ngram_texts(vocab, words, ids):
+  # The text of n-grams, by their indices in the n-grams of every order in
+  # turn, whose word IDs are in words
+  bounds = np.cumsum([0] + [len(x) for x in words])
+  orders = np.searchsorted(bounds, ids, side='right') - 1
+  texts = [None] * len(ids)
+  for n, table in enumerate(words):
+    sel = np.flatnonzero(orders == n)
+    for i, wids in zip(sel.tolist(), table[ids[sel] - bounds[n]].tolist()):
+      texts[i] = ' '.join(vocab.ngram(wids))
+  return texts
+
+def ngram_columns(vocab, words, ids, scores, left, right, left_name, right_name, max_ngrams=None):
+  # The n-grams sorted by score as columns, keeping only the max_ngrams
+  # with the lowest and highest scores if max_ngrams is given
+  if max_ngrams is not None and 2*max_ngrams < len(ids):
+    keep = np.r_[0:max_ngrams, len(ids)-max_ngrams:len(ids)]
+    ids, scores = ids[keep], scores[keep]
+  return {
+    'ngram': ngram_texts(vocab, words, ids),
+    'score': scores.tolist(),
+    left_name: left[ids].tolist(),
+    right_name: right[ids].tolist(),
+  }
+
+def analysis_results(analysis, freqs, args, max_ngrams=None):
+  ''' Get the results of an analysis as a dictionary that can be saved as JSON
+
+  :param analysis: the CorpusAnalysis of the whole corpus
+  :param freqs: the training frequencies of every word in the vocabulary
+  :param args: the command line arguments
+  :param max_ngrams: if given, keep only this many of the best and worst
+    scoring n-grams instead of all of them
+  :returns: the results, which can be printed with print_single_report
+    and print_pair_report
+  '''
+  vocab = analysis.vocab
+  results = {
+    'version': RESULTS_VERSION,
+    'ref_file': args.ref_file,
+    'out_files': args.out_files,
+    'ngram': args.ngram,
+    'alpha': args.alpha,
+    'num_lines': analysis.num_lines,
+    'buckets': bucket_strs,
+    # bothf, reff, outf, rec, prec, fmeas for each frequency bucket of each system
+    'freq_buckets': [list(x.result(freqs, buckets)) for x in analysis.freq_matches],
+  }
+  if analysis.errors:
+    # d, i, s and e counts and the number of sentences without errors for each system
+    results['errors'] = [dict(x.counts, sent_correct=x.sent_correct) for x in analysis.errors]
+  if analysis.num_systems == 1:
+    refall, outall, words, ids, scores = analysis.over_under.result(args.alpha, max_ngrams)
+    results['ngrams'] = ngram_columns(vocab, words, ids, scores, refall, outall, 'ref', 'out', max_ngrams)
+    return results
+  results['lengths'] = [{'ref': x.length_ref, 'out': x.length_out, 'diff': sorted(x.length_diff.items())}
+                        for x in analysis.lengths]
+  results['sentence_bleu'] = [x.tolist() for x in analysis.sent_bleus]
+  results['pairs'] = []
+  sentences = {}
+  for s1, s2 in analysis.pairs:
+    outall, out2all, words, ids, scores = analysis.compares[s1,s2].result(args.alpha, max_ngrams)
+    results['pairs'].append({'systems': [s1, s2],
+                             'ngrams': ngram_columns(vocab, words, ids, scores, outall, out2all, 'sys1', 'sys2', max_ngrams)})
+    sentences.update(analysis.bleu_diffs[s1,s2].sentences())
+  # The text of the sentences with the largest BLEU differences, so they
+  # can be printed without reading the corpus again
+  results['sentences'] = {str(i): [' '.join(x) for x in sents] for i, sents in sorted(sentences.items())}
+  return results
+
+def hash_inputs(args):
+  # A hash of the contents of all the input files, and the parameters that
+  # change the results. The display sizes are left out, as the results
+  # hold everything needed to print reports of any size.
+  h = hashlib.sha256()
+  h.update(json.dumps([RESULTS_VERSION, args.ngram, args.alpha, args.wer]).encode('utf-8'))
+  fnames = [('ref', args.ref_file)] + [('out', x) for x in args.out_files]
+  if args.train_index != None:
+    fnames += [('train_index', args.train_index + '.words.npy'), ('train_index', args.train_index + '.counts.npy')]
+  elif args.train_counts != None:
+    fnames.append(('train_counts', args.train_counts))
+  elif args.train_file != None:
+    fnames.append(('train_file', args.train_file))
+  for kind, fname in fnames:
+    h.update(kind.encode('utf-8'))
+    file_hash = hashlib.sha256()
+    with open(fname, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b''):
+        file_hash.update(block)
+    h.update(file_hash.digest())
+  return h.hexdigest()
+
+def load_results(fname):
+  with gzip.open(fname, 'rt', encoding='utf-8') as f:
+    return json.load(f)
+
+def save_results(results, fname):
+  # Write to a temporary file first, so that a cache never holds partial results
+  with gzip.open(fname + '.tmp', 'wt', encoding='utf-8') as f:
+    json.dump(results, f, separators=(',', ':'))
+  os.replace(fname + '.tmp', fname)
+
+# The statistics of a shard of a corpus, with the names of the original
+# files, so merging shards in order gives exactly the results of analyzing
+# the whole corpus. The counts are saved as arrays and everything else in a
+# JSON header, so loading a shard never unpickles anything.
+def save_shard(analysis, args, fname):
+  header = {'version': RESULTS_VERSION, 'format': SHARD_VERSION, 'ref_file': args.ref_file, 'out_files': args.out_files,
+            'sent_size': args.sent_size, 'num_systems': analysis.num_systems, 'ngram': analysis.ngram,
+            'wer': bool(analysis.errors), 'num_lines': analysis.num_lines, 'words': analysis.vocab.words,
+            'errors': [[x.counts, x.sent_correct] for x in analysis.errors]}
+  arrays = {'hashes': analysis.vocab.hashes()}
+  for i, freq_match in enumerate(analysis.freq_matches):
+    for name in ('both', 'ref', 'out'):
+      arrays['freq_match%d.%s' % (i, name)] = getattr(freq_match, name).counts
+  if analysis.num_systems == 1:
+    arrays.update(analysis.over_under.counts.arrays('over_under.'))
+  else:
+    header['lengths'] = [[x.length_ref, x.length_out, list(x.length_diff.items())] for x in analysis.lengths]
+    header['bleu_diffs'] = [[analysis.bleu_diffs[x].lowest, analysis.bleu_diffs[x].highest] for x in analysis.pairs]
+    for i, sent_bleu in enumerate(analysis.sent_bleus):
+      arrays['sent_bleu%d' % i] = np.frombuffer(sent_bleu, dtype=np.float64)
+    for s1, s2 in analysis.pairs:
+      arrays.update(analysis.compares[s1,s2].counts.arrays('compare%d-%d.' % (s1, s2)))
+  with open(fname + '.tmp', 'wb') as f:
+    np.savez_compressed(f, header=np.frombuffer(json.dumps(header).encode('utf-8'), dtype=np.uint8), **arrays)
+  os.replace(fname + '.tmp', fname)
+
+def load_shard(fname):
+  # The CorpusAnalysis of a shard and its header
+  try:
+    data = np.load(fname, allow_pickle=False)
+  except ValueError:
+    # earlier versions wrote pickles, which are not loaded
+    raise ValueError('%s was written by a different version of this script' % fname)
+  with data:
+    header = json.loads(data['header'].tobytes().decode('utf-8')) if 'header' in data.files else {}
+    if (header.get('version'), header.get('format')) != (RESULTS_VERSION, SHARD_VERSION):
+      raise ValueError('%s was written by a different version of this script' % fname)
+    analysis = CorpusAnalysis(header['num_systems'], header['ngram'], header['sent_size'], header['wer'],
+                              vocab=NgramVocab.from_words(header['words'], data['hashes']))
+    analysis.num_lines = header['num_lines']
+    for errors, (counts, sent_correct) in zip(analysis.errors, header['errors']):
+      errors.counts, errors.sent_correct = counts, sent_correct
+    for i, freq_match in enumerate(analysis.freq_matches):
+      for name in ('both', 'ref', 'out'):
+        getattr(freq_match, name).counts = data['freq_match%d.%s' % (i, name)]
+    if analysis.num_systems == 1:
+      analysis.over_under.counts.add_arrays(data, 'over_under.')
+      return analysis, header
+    for length, (length_ref, length_out, length_diff) in zip(analysis.lengths, header['lengths']):
+      length.length_ref, length.length_out, length.length_diff = length_ref, length_out, dict(length_diff)
+    for pair, (lowest, highest) in zip(analysis.pairs, header['bleu_diffs']):
+      bleu_diff = analysis.bleu_diffs[pair]
+      bleu_diff.lowest = [(tuple(k), s) for k, s in lowest]
+      bleu_diff.highest = [(tuple(k), s) for k, s in highest]
+    for i, sent_bleu in enumerate(analysis.sent_bleus):
+      sent_bleu.frombytes(data['sent_bleu%d' % i].astype(np.float64).tobytes())
+    for s1, s2 in analysis.pairs:
+      analysis.compares[s1,s2].counts.add_arrays(data, 'compare%d-%d.' % (s1, s2))
+  return analysis, header
+
+def load_shards(fnames):
+  ''' Merge the statistics of the shards of a corpus
+
+  :param fnames: the files written by save_shard, in the order of the shards
+  :returns: the CorpusAnalysis of the whole corpus, and the header of the
+    first shard, which has the names of its reference and output files and
+    the sent_size
+  '''
+  analysis, first = None, None
+  for fname in fnames:
+    other, header = load_shard(fname)
+    if first is None:
+      analysis, first = other, header
+      continue
+    if ((other.num_systems, other.ngram, header['sent_size'], bool(other.errors)) !=
+        (analysis.num_systems, analysis.ngram, first['sent_size'], bool(analysis.errors))):
+      raise ValueError('%s has different systems, --ngram, --sent_size or --wer from %s' % (fname, fnames[0]))
+    analysis.merge(other)
+  return analysis, first
+
+def bleu_diff_ranks(results, s1, s2, sent_size):
+  # The line indices with the lowest and highest sentence BLEU+1 differences,
+  # ordered by (difference, sys1 BLEU, sys2 BLEU, index)
+  b1 = np.array(results['sentence_bleu'][s1])
+  b2 = np.array(results['sentence_bleu'][s2])
+  bdiff = b2 - b1
+  order = np.lexsort((np.arange(len(b1)), b2, b1, bdiff))
+  sent_size = min(sent_size, len(order))
+  bdiff, b1, b2 = bdiff.tolist(), b1.tolist(), b2.tolist()
+  # lines without any matches have a BLEU+1 of 0, printed as an integer as the
+  # original script did
+  def rows(ids):
+    return [(bdiff[i] if b1[i] or b2[i] else 0, b1[i] or 0, b2[i] or 0, i) for i in ids.tolist()]
+  return rows(order[:sent_size]), rows(order[len(order)-sent_size:])
+
+def sentence_texts(results, ids, fnames, corpus_cache=None):
+  # Get the text of sentences from the results, or from the corpus files if
+  # they are not in the results because a larger --sent_size was requested
+  sents = {i: results['sentences'][str(i)] for i in ids if str(i) in results['sentences']}
+  missing = set(ids) - set(sents)
+  if missing and corpus_cache != None:
+    corpora = [load_corpus(x, corpus_cache) for x in fnames]
+    for i in missing:
+      sents[i] = [' '.join(x.line(i)) for x in corpora]
+  elif missing:
+    last = max(missing)
+    for i, lines in enumerate(read_corpora(fnames)):
+      if i in missing:
+        sents[i] = [' '.join(x) for x in lines]
+      if i == last:
+        break
+  return sents
+
+def print_single_report(results, args):
+  ngrams = results['ngrams']
+  rows = list(zip(ngrams['ngram'], ngrams['score'], ngrams['ref'], ngrams['out']))
   # Print the ouput
   print('********************** N-gram Difference Analysis ************************')
   print('--- %d over-generated n-grams indicative of output' % args.ngram_size)
-  for k, v in scorelist[:args.ngram_size]:
-    print('%s\t%f (ref=%d, out=%d)' % (' '.join(k), v, refall[k], outall[k]))
+  for k, v, ref, out in rows[:args.ngram_size]:
+    print('%s\t%f (ref=%d, out=%d)' % (k, v, ref, out))
   print()
   print('--- %d under-generated n-grams indicative of reference' % args.ngram_size)
-  for k, v in reversed(scorelist[-args.ngram_size:]):
-    print('%s\t%f (ref=%d, out=%d)' % (' '.join(k), v, refall[k], outall[k]))
+  for k, v, ref, out in reversed(rows[-args.ngram_size:]):
+    print('%s\t%f (ref=%d, out=%d)' % (k, v, ref, out))
   # Calculate f-measure
-  matches = calc_matches_by_freq(ref, out, buckets)
+  matches = results['freq_buckets'][0]
   print('\n\n********************** Word Frequency Analysis ************************')
   print('--- word f-measure by frequency bucket')
   for bucket_str, match in zip(bucket_strs, matches):
     print("{}\t{:.4f}".format(bucket_str, match[5]))
-# Analyze the differences between two systems
-else:
-  outall, out2all, scores = calc_compare(ref, out, out2, args.alpha)
-  scorelist = sorted(scores.items(), key=operator.itemgetter(1))
+  if 'errors' in results:
+    print_error_report(results, [0])
+
+def print_error_report(results, systems):
+  # The edit operation counts and word error rate of each system, as in grade.pl
+  errors = [results['errors'][s] for s in systems]
+  print('\n\n********************** Word Error Analysis ************************')
+  print('--- edit operations (d=delete, i=insert, s=substitute, e=equal)')
+  for step in STEPS:
+    print('\t'.join([step] + [str(x[step]) for x in errors]))
+  print('--- word error rate, and ratio of sentences without errors')
+  ref_lens = [x['e']+x['s']+x['d'] for x in errors]
+  print('\t'.join(['WER'] + ['{:.4f}'.format((x['s']+x['i']+x['d'])/ref_len if ref_len else 0.) for x, ref_len in zip(errors, ref_lens)]))
+  print('\t'.join(['Sent'] + ['{:.4f}'.format(x['sent_correct']/results['num_lines']) for x in errors]))
+
+def print_pair_report(results, s1, s2, args):
+  n1, n2 = s1+1, s2+1
+  pair = [x for x in results['pairs'] if x['systems'] == [s1, s2]][0]
+  ngrams = pair['ngrams']
+  rows = list(zip(ngrams['ngram'], ngrams['score'], ngrams['sys1'], ngrams['sys2']))
   # Print the ouput
   print('********************** N-gram Difference Analysis ************************')
-  print('--- %d n-grams that System 1 did a better job of producing' % args.ngram_size)
-  for k, v in scorelist[:args.ngram_size]:
-    print('%s\t%f (sys1=%d, sys2=%d)' % (' '.join(k), v, outall[k], out2all[k]))
-  print('\n--- %d n-grams that System 2 did a better job of producing' % args.ngram_size)
-  for k, v in reversed(scorelist[-args.ngram_size:]):
-    print('%s\t%f (sys1=%d, sys2=%d)' % (' '.join(k), v, outall[k], out2all[k]))  
+  print('--- %d n-grams that System %d did a better job of producing' % (args.ngram_size, n1))
+  for k, v, out, out2 in rows[:args.ngram_size]:
+    print('%s\t%f (sys%d=%d, sys%d=%d)' % (k, v, n1, out, n2, out2))
+  print('\n--- %d n-grams that System %d did a better job of producing' % (args.ngram_size, n2))
+  for k, v, out, out2 in reversed(rows[-args.ngram_size:]):
+    print('%s\t%f (sys%d=%d, sys%d=%d)' % (k, v, n1, out, n2, out2))
   # Calculate f-measure
-  matches = calc_matches_by_freq(ref, out, buckets)
-  matches2 = calc_matches_by_freq(ref, out2, buckets)
+  matches = results['freq_buckets'][s1]
+  matches2 = results['freq_buckets'][s2]
   print('\n\n********************** Word Frequency Analysis ************************')
   print('--- word f-measure by frequency bucket')
   for bucket_str, match, match2 in zip(bucket_strs, matches, matches2):
     print("{}\t{:.4f}\t{:.4f}".format(bucket_str, match[5], match2[5]))
-  # Calculate BLEU diff
-  scorediff_list = []
-  chencherry = nltk.translate.bleu_score.SmoothingFunction()
-  for i, (o1, o2, r) in enumerate(zip(out, out2, ref)):
-    b1 = nltk.translate.bleu_score.sentence_bleu([r], o1, smoothing_function=chencherry.method2)
-    b2 = nltk.translate.bleu_score.sentence_bleu([r], o2, smoothing_function=chencherry.method2)
-    scorediff_list.append((b2-b1, b1, b2, i))
-  scorediff_list.sort()
+  if 'errors' in results:
+    print_error_report(results, [s1, s2])
+  length, length2 = results['lengths'][s1], results['lengths'][s2]
   print('\n\n********************** Length Analysis ************************')
   print('--- length ratio')
-  length_ref = sum([len(x) for x in ref])
-  length_out = sum([len(x) for x in out])
-  length_out2 = sum([len(x) for x in out2])
-  print('System 1: {}, System 2: {}'.format(length_out/length_ref, length_out2/length_ref))
+  print('System {}: {}, System {}: {}'.format(n1, length['out']/length['ref'], n2, length2['out']/length2['ref']))
   print('--- length difference from reference by bucket')
-  length_diff = {}
-  length_diff2 = {}
-  for r, o, o2 in zip(ref, out, out2):
-    ld = len(o)-len(r)
-    ld2 = len(o2)-len(r)
-    length_diff[ld] = length_diff.get(ld,0) + 1
-    length_diff2[ld2] = length_diff2.get(ld2,0) + 1
+  length_diff, length_diff2 = dict(length['diff']), dict(length2['diff'])
   for ld in sorted(list(set(length_diff.keys()) | set(length_diff2.keys()))):
     print("{}\t{}\t{}".format(ld, length_diff.get(ld,0), length_diff2.get(ld,0)))
+  # Print the sentences with the largest BLEU differences
+  lowest, highest = bleu_diff_ranks(results, s1, s2, args.sent_size)
+  sents = sentence_texts(results, [x[3] for x in lowest + highest], [args.ref_file] + args.out_files, args.corpus_cache)
   print('\n\n********************** BLEU Analysis ************************')
-  print('--- %d sentences that System 1 did a better job at than System 2' % args.sent_size)
-  for bdiff, b1, b2, i in scorediff_list[:args.sent_size]:
-    print ('BLEU+1 sys2-sys1={}, sys1={}, sys2={}\nRef:  {}\nSys1: {}\nSys2: {}\n'.format(bdiff, b1, b2, ' '.join(ref[i]), ' '.join(out[i]), ' '.join(out2[i])))
-  print('--- %d sentences that System 2 did a better job at than System 1' % args.sent_size)
-  for bdiff, b1, b2, i in scorediff_list[-args.sent_size:]:
-    print ('BLEU+1 sys2-sys1={}, sys1={}, sys2={}\nRef:  {}\nSys1: {}\nSys2: {}\n'.format(bdiff, b1, b2, ' '.join(ref[i]), ' '.join(out[i]), ' '.join(out2[i])))
+  print('--- %d sentences that System %d did a better job at than System %d' % (args.sent_size, n1, n2))
+  for bdiff, b1, b2, i in lowest:
+    r, o1, o2 = sents[i][0], sents[i][n1], sents[i][n2]
+    print ('BLEU+1 sys{n2}-sys{n1}={}, sys{n1}={}, sys{n2}={}\nRef:  {}\nSys{n1}: {}\nSys{n2}: {}\n'.format(bdiff, b1, b2, r, o1, o2, n1=n1, n2=n2))
+  print('--- %d sentences that System %d did a better job at than System %d' % (args.sent_size, n2, n1))
+  for bdiff, b1, b2, i in highest:
+    r, o1, o2 = sents[i][0], sents[i][n1], sents[i][n2]
+    print ('BLEU+1 sys{n2}-sys{n1}={}, sys{n1}={}, sys{n2}={}\nRef:  {}\nSys{n1}: {}\nSys{n2}: {}\n'.format(bdiff, b1, b2, r, o1, o2, n1=n1, n2=n2))
+
+def compute_results(args, max_ngrams=None, analysis=None, timer=NO_TIMER):
+  with timer.phase('load'):
+    freq_index = read_freq_index(args)
+  if analysis is None:
+    analysis = analyze_corpus(args.ref_file, args.out_files, args.ngram, args.sent_size, workers=args.workers,
+                              stats_cache=args.stats_cache, corpus_cache=args.corpus_cache, wer=args.wer, timer=timer)
+  with timer.phase('score'):
+    return analysis_results(analysis, analysis_freqs(analysis, freq_index), args, max_ngrams=max_ngrams)
+
+def analysis_freqs(analysis, freq_index=None):
+  # The training frequency of every word in the vocabulary, or its
+  # frequency in the reference if there is no training data
+  if freq_index is None:
+    return analysis.freq_matches[0].ref.array(len(analysis.vocab.words))
+  return freq_index.lookup(analysis.vocab.words)
+
+def print_reports(results, args):
+  # Analyze the reference/output
+  if len(args.out_files) == 1:
+    print_single_report(results, args)
+  # Analyze the differences between two systems
+  elif len(args.out_files) == 2:
+    print_pair_report(results, 0, 1, args)
+  # Analyze the differences between every pair of systems
+  else:
+    for s1, s2 in [tuple(x['systems']) for x in results['pairs']]:
+      print('############################ System %d vs. System %d ############################' % (s1+1, s2+1))
+      print('System %d: %s\nSystem %d: %s\n' % (s1+1, args.out_files[s1], s2+1, args.out_files[s2]))
+      print_pair_report(results, s1, s2, args)
+
+def main():
+  args = parser.parse_args()
+  timer = PhaseTimer(args.profile)
+  if args.stats_cache != None and not args.wer:
+    parser.error('--stats_cache only caches the edit steps of --wer, so it can only be used with --wer')
+  if args.stats_out != None:
+    if args.merge_stats or args.cache_dir != None:
+      parser.error('--stats_out can not be used with --merge_stats or --cache_dir')
+    analysis = analyze_corpus(args.ref_file, args.out_files, args.ngram, args.sent_size, workers=args.workers,
+                              stats_cache=args.stats_cache, corpus_cache=args.corpus_cache, wer=args.wer, timer=timer)
+    with timer.phase('output'):
+      save_shard(analysis, args, args.stats_out)
+    timer.report()
+    return
+  analysis = None
+  if args.merge_stats:
+    if args.cache_dir != None:
+      parser.error('--merge_stats can not be used with --cache_dir')
+    with timer.phase('load'):
+      analysis, first = load_shards([args.ref_file] + args.out_files)
+    if args.sent_size > first['sent_size']:
+      parser.error('--sent_size can be at most the %d the shards were written with' % first['sent_size'])
+    # The report names the original files, and sentences are only taken
+    # from the statistics, as the files only hold the lines of one shard
+    args.ref_file, args.out_files, args.ngram, args.wer = first['ref_file'], first['out_files'], analysis.ngram, bool(analysis.errors)
+  # Results are kept in full if they are saved, and otherwise only as
+  # many n-grams as will be printed are kept
+  if args.cache_dir != None:
+    with timer.phase('load'):
+      cache_file = os.path.join(args.cache_dir, hash_inputs(args) + '.json.gz')
+    if os.path.exists(cache_file):
+      with timer.phase('load'):
+        results = load_results(cache_file)
+    else:
+      results = compute_results(args, timer=timer)
+      with timer.phase('output'):
+        os.makedirs(args.cache_dir, exist_ok=True)
+        save_results(results, cache_file)
+  elif args.json_out != None:
+    results = compute_results(args, analysis=analysis, timer=timer)
+  else:
+    results = compute_results(args, max_ngrams=args.ngram_size, analysis=analysis, timer=timer)
+  if args.json_out != None:
+    with timer.phase('output'):
+      save_results(results, args.json_out)
+
+  with timer.phase('output'):
+    print_reports(results, args)
+  timer.report()
+
+if __name__ == '__main__':
+  main()
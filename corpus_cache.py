@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+'''
+An on-disk cache of tokenized corpora, shared by the evaluation scripts.
+
+A corpus is split into whitespace-separated tokens once, and stored as
+three NumPy files: PREFIX.words.npy, the vocabulary as UTF-8 text with one
+word per line, PREFIX.ids.npy, the word ID of every token in the corpus,
+and PREFIX.offsets.npy, the position of the first token of every line.
+The token and offset arrays are memory-mapped when loaded, so even a very
+large corpus loads almost instantly, and single lines can be read without
+reading the lines before them.
+
+Cached corpora are kept in a directory, named by a hash of the absolute
+path, size and modification time of the original file, so a file that
+changes is tokenized again.
+
+Usage:
+  corpus_cache.py --cache_dir cache ref.txt sys1.txt sys2.txt
+
+tokenizes the files ahead of time. The same directory can then be passed
+to compare-mt.py, paired-bootstrap.py and syseval-combine.py with
+--corpus_cache cache.
+'''
+
+import argparse
+import hashlib
+import json
+import os
+from array import array
+
+import numpy as np
+
+# The number of lines whose tokens are converted to strings at once
+BLOCK_LINES = 10000
+
+class TokenizedCorpus(object):
+  ''' Lines of tokens stored as a vocabulary, word IDs and line offsets '''
+
+  def __init__(self, words, ids, offsets):
+    self.words = words
+    self.ids = ids
+    self.offsets = offsets
+    self._word_array = None
+
+  @classmethod
+  def from_file(cls, fname):
+    ''' Tokenize a file by splitting each line on whitespace '''
+    word_ids = {}
+    ids = array('i')
+    offsets = array('q', [0])
+    with open(fname, 'r') as f:
+      for line in f:
+        for word in line.split():
+          wid = word_ids.get(word)
+          if wid is None:
+            wid = word_ids[word] = len(word_ids)
+          ids.append(wid)
+        offsets.append(len(ids))
+    return cls(list(word_ids), np.frombuffer(ids, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64))
+
+  @classmethod
+  def load(cls, prefix):
+    ''' Load a memory-mapped corpus written by save '''
+    words = np.load(prefix + '.words.npy').tobytes().decode('utf-8')
+    return cls(words.split('\n') if words else [],
+               np.load(prefix + '.ids.npy', mmap_mode='r'),
+               np.load(prefix + '.offsets.npy', mmap_mode='r'))
+
+  def save(self, prefix):
+    # The offsets are written last, so a corpus is only loaded once all of
+    # its files are complete
+    for name, data in [('words', np.frombuffer('\n'.join(self.words).encode('utf-8'), dtype=np.uint8)),
+                       ('ids', self.ids), ('offsets', self.offsets)]:
+      with open(prefix + '.' + name + '.tmp', 'wb') as f:
+        np.save(f, data)
+      os.replace(prefix + '.' + name + '.tmp', prefix + '.' + name + '.npy')
+
+  def __len__(self):
+    ''' The number of lines in the corpus '''
+    return len(self.offsets) - 1
+
+  def lengths(self):
+    ''' Get the number of tokens in every line as an array '''
+    return np.diff(self.offsets)
+
+  def line(self, i):
+    ''' Get the tokens of a single line '''
+    return [self.words[x] for x in self.ids[self.offsets[i]:self.offsets[i+1]].tolist()]
+
+  def lines(self):
+    ''' Iterate over the lines as lists of tokens, like line.split() on the original file '''
+    if self._word_array is None:
+      self._word_array = np.array(self.words, dtype=object)
+    for start in range(0, len(self), BLOCK_LINES):
+      offsets = np.asarray(self.offsets[start:start+BLOCK_LINES+1])
+      tokens = self._word_array[self.ids[offsets[0]:offsets[-1]]].tolist()
+      offsets = (offsets - offsets[0]).tolist()
+      for begin, end in zip(offsets, offsets[1:]):
+        yield tokens[begin:end]
+
+def cache_prefix(cache_dir, fname):
+  ''' The prefix of the cached files of a corpus, which changes whenever the file does '''
+  st = os.stat(fname)
+  key = json.dumps([os.path.abspath(fname), st.st_size, st.st_mtime_ns])
+  return os.path.join(cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest()[:32])
+
+def load_corpus(fname, cache_dir):
+  ''' Load a tokenized corpus from the cache, tokenizing and caching it if it isn't there '''
+  prefix = cache_prefix(cache_dir, fname)
+  if os.path.exists(prefix + '.offsets.npy'):
+    return TokenizedCorpus.load(prefix)
+  corpus = TokenizedCorpus.from_file(fname)
+  os.makedirs(cache_dir, exist_ok=True)
+  corpus.save(prefix)
+  return corpus
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('files', nargs='+', help='The corpora to tokenize')
+  parser.add_argument('--cache_dir', type=str, required=True, help='The directory to keep the tokenized corpora in')
+  args = parser.parse_args()
+  for fname in args.files:
+    load_corpus(fname, args.cache_dir)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+'''
+A resident server for compare-mt.py and paired-bootstrap.py, in the spirit
+of serverfy.pl.
+
+Running the scripts from scratch for every evaluation means paying for
+starting Python, importing NumPy (and sacrebleu), and reading, tokenizing
+and counting the n-grams of the reference every time. This server does
+that once: it keeps the scripts imported, and for each reference it has
+seen it keeps its vocabulary and the n-gram counts of each of its lines
+for compare-mt.py, the --wer edit steps and paired-bootstrap.py statistics
+of the lines of the last request (as with the --stats_cache option of both
+scripts, but in memory), and the preprocessed gold data for
+paired-bootstrap.py. A request then only reads and counts the system
+outputs, and only aligns the lines that changed. References are evicted
+least recently used first once there are more than --max_references, and a
+reference file that changes is loaded again.
+
+On 2000 lines of 22 words on average, a compare request on a reference the
+server has seen takes about 0.08s for one system and 0.13s for two (0.16s
+with --wer), against 0.55s for running compare-mt.py. What remains is
+spent on each output: looking up its words in the vocabulary (about 14ms),
+sorting its n-grams and searching for them in the reference to find the
+matches (about 17ms), counting the n-grams each pair of systems matched
+differently (about 11ms), and reading the file (about 5ms).
+
+Requests are XML-RPC calls over HTTP, each handled in its own thread, with
+the command line arguments of the script as a list of strings. They return
+the report the script would print:
+  compare(args)     the arguments of compare-mt.py
+  bootstrap(args)   the arguments of paired-bootstrap.py
+  status()          the references being kept
+
+Usage:
+  eval-server.py --port 9002 --max_references 16
+  eval-server.py --port 9002 --call compare ref.txt out1.txt out2.txt --ngram 3
+
+or from Python:
+  xmlrpc.client.ServerProxy('http://localhost:9002').bootstrap(['ref.txt', 'out1.txt', 'out2.txt', '--eval_type', 'bleu'])
+
+The analysis is done in the server process, so --workers is ignored, and
+file names are relative to the directory the server was started in. The
+server keeps its own statistics, so requests with --stats_cache,
+--stats_out, --merge_stats or --cache_dir, or with --corpus_cache for
+bootstrap, are refused; run the scripts themselves for those.
+'''
+
+import argparse
+import collections
+import contextlib
+import importlib.util
+import io
+import os
+import socketserver
+import sys
+import threading
+import time
+import xmlrpc.client
+from xmlrpc.server import SimpleXMLRPCServer
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def load_script(name):
+  ''' Import one of the scripts in this directory, which have hyphens in their names, as a module '''
+  spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(SCRIPT_DIR, name + '.py'))
+  module = importlib.util.module_from_spec(spec)
+  sys.modules[spec.name] = module
+  spec.loader.exec_module(module)
+  return module
+
+def file_key(fname):
+  ''' A key for a file that changes whenever the file does '''
+  st = os.stat(fname)
+  return (os.path.abspath(fname), st.st_size, st.st_mtime_ns)
+
+def reject_options(args, names):
+  ''' Refuse a request that uses any of the named options, which the server does not support '''
+  for name in names:
+    if getattr(args, name) not in (None, False):
+      raise ValueError('--%s is not supported by the server' % name)
+
+def request_parser(parser, prog):
+  ''' Make an argument parser of a script raise a ValueError with its message instead of exiting on bad arguments '''
+  parser.prog = prog
+  def error(message):
+    raise ValueError('%s: error: %s' % (parser.prog, message))
+  parser.error = error
+  return parser
+
+class ThreadOutput(object):
+  ''' A replacement for stdout whose output can be captured separately by each thread '''
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.local = threading.local()
+
+  def write(self, text):
+    return (getattr(self.local, 'buffer', None) or self.stream).write(text)
+
+  def flush(self):
+    (getattr(self.local, 'buffer', None) or self.stream).flush()
+
+  @contextlib.contextmanager
+  def capture(self):
+    ''' Capture everything this thread prints in the body of a with statement '''
+    self.local.buffer = io.StringIO()
+    try:
+      yield self.local.buffer
+    finally:
+      self.local.buffer = None
+
+class Reference(object):
+  ''' What is kept in memory for a reference or gold file '''
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    # compare-mt.py encoded reference, by n-gram order, and --wer edit steps
+    self.encoded = {}
+    self.line_cache = None
+    # paired-bootstrap.py preprocessed gold data and per-example statistics, by eval type
+    self.gold = {}
+    self.stats_rows = {}
+
+class Loaded(object):
+  ''' A value loaded on first use, behind its own lock so that loading it doesn't hold up other requests '''
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.value = None
+
+  def get(self, load):
+    with self.lock:
+      if self.value is None:
+        self.value = load()
+      return self.value
+
+class EvalServer(object):
+  ''' The state kept between requests, and the methods to answer them '''
+
+  def __init__(self, output, max_references=16):
+    self.output = output
+    self.max_references = max_references
+    self.compare_mt = load_script('compare-mt')
+    self.paired_bootstrap = load_script('paired-bootstrap')
+    request_parser(self.compare_mt.parser, 'compare-mt.py')
+    self.lock = threading.Lock()
+    self.references = collections.OrderedDict()
+    self.freq_indices = collections.OrderedDict()
+
+  def _lru_get(self, items, key, create):
+    with self.lock:
+      value = items.pop(key, None)
+      items[key] = value = create() if value is None else value
+      while len(items) > self.max_references:
+        items.popitem(last=False)
+      return value
+
+  def reference(self, fname):
+    return self._lru_get(self.references, file_key(fname), Reference)
+
+  def freq_index(self, args):
+    ''' The training frequency index given by compare-mt.py arguments, loaded once per file '''
+    for name in ('train_index', 'train_counts', 'train_file'):
+      fname = getattr(args, name)
+      if fname != None:
+        key = (name,) + file_key(fname + '.words.npy' if name == 'train_index' else fname)
+        return self._lru_get(self.freq_indices, key, Loaded).get(lambda: self.compare_mt.read_freq_index(args))
+    return None
+
+  def parse_args(self, parser, argv):
+    ''' Parse the arguments of a request, which are refused with a ValueError rather than exiting the thread
+
+    Bad arguments raise the error message of the parser, and arguments that
+    make it exit, such as --help, raise what it printed.
+    '''
+    with self.output.capture() as out:
+      try:
+        return parser.parse_args(argv)
+      except SystemExit:
+        pass
+    raise ValueError(out.getvalue())
+
+  def compare(self, argv):
+    cmt = self.compare_mt
+    args = self.parse_args(cmt.parser, argv)
+    reject_options(args, ('stats_cache', 'stats_out', 'merge_stats', 'cache_dir'))
+    entry = self.reference(args.ref_file)
+    freq_index = self.freq_index(args)
+    max_order = cmt.analysis_order(len(args.out_files), args.ngram)
+    with entry.lock:
+      reference = entry.encoded.get(max_order)
+      if reference is None:
+        reference = entry.encoded[max_order] = cmt.EncodedReference(args.ref_file, max_order, args.corpus_cache)
+      # A line cache can only be used by one request at a time, so any other
+      # request on the same reference meanwhile starts with an empty one
+      cache = None
+      if args.wer:
+        cache, entry.line_cache = entry.line_cache or cmt.LineStatsCache(), None
+    analysis = cmt.analyze_corpus(args.ref_file, args.out_files, args.ngram, args.sent_size, stats_cache=cache,
+                                  corpus_cache=args.corpus_cache, wer=args.wer, reference=reference)
+    if cache is not None:
+      cache = cache.renew()
+      with entry.lock:
+        entry.line_cache = cache
+    results = cmt.analysis_results(analysis, cmt.analysis_freqs(analysis, freq_index), args,
+                                   max_ngrams=None if args.json_out != None else args.ngram_size)
+    if args.json_out != None:
+      cmt.save_results(results, args.json_out)
+    with self.output.capture() as out:
+      cmt.print_reports(results, args)
+    return out.getvalue()
+
+  def bootstrap(self, argv):
+    pb = self.paired_bootstrap
+    args = self.parse_args(request_parser(pb.arg_parser(), 'paired-bootstrap.py'), argv)
+    reject_options(args, ('stats_cache', 'corpus_cache', 'stats_out', 'merge_stats'))
+    if len(args.sys) < 2:
+      raise ValueError('at least two system files are required')
+    entry = self.reference(args.gold)
+    with entry.lock:
+      gold = entry.gold.get(args.eval_type)
+      if gold is None:
+        with open(args.gold, 'r') as f:
+          gold = entry.gold[args.eval_type] = [pb.eval_preproc(x, args.eval_type) for x in f]
+      stats_cache = pb.StatsCache(args.eval_type)
+      stats_cache.rows = dict(entry.stats_rows.get(args.eval_type, {}))
+    systems = []
+    for sys_file in args.sys:
+      with open(sys_file, 'r') as f:
+        systems.append(f.readlines())
+    with self.output.capture() as out:
+      if len(systems) == 2:
+        pb.eval_with_paired_bootstrap(gold, systems[0], systems[1], eval_type=args.eval_type, num_samples=args.num_samples,
+                                      seed=args.seed, early_stop=args.early_stop, stats_cache=stats_cache)
+      else:
+        for i, sys_file in enumerate(args.sys):
+          print('sys%d: %s' % (i+1, sys_file))
+        print()
+        pb.eval_multi_with_paired_bootstrap(gold, systems, eval_type=args.eval_type, num_samples=args.num_samples,
+                                            seed=args.seed, early_stop=args.early_stop, stats_cache=stats_cache)
+    with entry.lock:
+      entry.stats_rows[args.eval_type] = stats_cache.used
+    return out.getvalue()
+
+  def status(self):
+    with self.lock:
+      return [{'file': key[0], 'size': key[1],
+               'compare_orders': sorted(entry.encoded), 'bootstrap_eval_types': sorted(entry.gold)}
+              for key, entry in self.references.items()]
+
+class ThreadedXMLRPCServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+  daemon_threads = True
+
+def logged(name, method):
+  # Log each request and how long it took to stderr, like serverfy.pl
+  def call(*args):
+    start = time.perf_counter()
+    try:
+      return method(*args)
+    finally:
+      print('%s %s (%.3fs)' % (name, ' '.join(*args), time.perf_counter() - start), file=sys.stderr)
+  return call
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter, allow_abbrev=False)
+  parser.add_argument('--host', type=str, default='localhost', help='The host name to listen on or connect to')
+  parser.add_argument('--port', type=int, default=9002, help='The port to listen on or connect to')
+  parser.add_argument('--max_references', type=int, default=16, help='How many references to keep in memory')
+  parser.add_argument('--call', type=str, default=None, choices=['compare', 'bootstrap', 'status'],
+                      help='Send a request to a running server instead of starting one, with the arguments that follow')
+  args, rest = parser.parse_known_args()
+
+  if args.call != None:
+    server = xmlrpc.client.ServerProxy('http://%s:%d' % (args.host, args.port), allow_none=True)
+    try:
+      if args.call == 'status':
+        for ref in server.status():
+          print('%s\tsize=%d\tcompare_orders=%s\tbootstrap_eval_types=%s' %
+                (ref['file'], ref['size'], ref['compare_orders'], ','.join(ref['bootstrap_eval_types'])))
+      else:
+        print(getattr(server, args.call)(rest), end='')
+    except xmlrpc.client.Fault as e:
+      print('Error: %s' % e.faultString, file=sys.stderr)
+      sys.exit(1)
+    return
+  if rest:
+    parser.error('unrecognized arguments: %s' % ' '.join(rest))
+
+  sys.stdout = output = ThreadOutput(sys.stdout)
+  evaluator = EvalServer(output, args.max_references)
+  server = ThreadedXMLRPCServer((args.host, args.port), logRequests=False, allow_none=True)
+  server.register_function(logged('compare', evaluator.compare), 'compare')
+  server.register_function(logged('bootstrap', evaluator.bootstrap), 'bootstrap')
+  server.register_function(evaluator.status, 'status')
+  print('Serving on %s:%d' % (args.host, args.port), file=sys.stderr)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()
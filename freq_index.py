@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+'''
+A compact on-disk index of training word frequencies.
+
+The index is stored as two NumPy files: PREFIX.words.npy, the sorted
+vocabulary as fixed-width UTF-8 byte strings, and PREFIX.counts.npy, the
+frequency of each word. Both are memory-mapped when loaded, so the index of
+even a very large training corpus loads instantly, and the frequencies of
+many words can be looked up at once with a vectorized binary search.
+
+Usage:
+  freq_index.py --train_file train.trg --out train.index
+  freq_index.py --train_counts train.counts --out train.index
+
+where train.counts is a tab-separated "word\\tfreq" file. The index can then
+be passed to compare-mt.py with --train_index train.index.
+'''
+
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+class FreqIndex(object):
+  ''' Word frequencies stored as a sorted vocabulary and a parallel count array '''
+
+  def __init__(self, words, counts):
+    self.words = words
+    self.counts = counts
+
+  @classmethod
+  def from_counts(cls, freq_counts):
+    ''' Create an index in memory from a dictionary of word frequencies '''
+    words = np.array([w.encode('utf-8') for w in freq_counts.keys()], dtype=bytes)
+    counts = np.array(list(freq_counts.values()), dtype=np.int64)
+    order = np.argsort(words, kind='stable')
+    return cls(words[order], counts[order])
+
+  @classmethod
+  def load(cls, prefix):
+    ''' Load a memory-mapped index written by save '''
+    return cls(np.load(prefix + '.words.npy', mmap_mode='r'),
+               np.load(prefix + '.counts.npy', mmap_mode='r'))
+
+  def save(self, prefix):
+    np.save(prefix + '.words.npy', self.words)
+    np.save(prefix + '.counts.npy', self.counts)
+
+  def lookup(self, words):
+    ''' Get the frequencies of a list of words, with 0 for unknown words '''
+    ret = np.zeros(len(words), dtype=np.int64)
+    if len(self.words) == 0 or len(words) == 0:
+      return ret
+    keys = [w.encode('utf-8') for w in words]
+    # words longer than any in the index can't be in it, and would be
+    # truncated when converted to the index's fixed-width type
+    max_len = self.words.dtype.itemsize
+    fits = np.array([len(k) <= max_len for k in keys])
+    keys = np.array(keys, dtype=self.words.dtype)
+    pos = np.minimum(np.searchsorted(self.words, keys), len(self.words)-1)
+    found = fits & (self.words[pos] == keys)
+    ret[found] = self.counts[pos[found]]
+    return ret
+
+def count_train_file(fname):
+  ''' Count the words in a tokenized training corpus '''
+  freq_counts = defaultdict(lambda: 0)
+  with open(fname, "r") as f:
+    for line in f:
+      for word in line.strip().split():
+        freq_counts[word] += 1
+  return freq_counts
+
+def read_train_counts(fname):
+  ''' Read a tab-separated "word\\tfreq" file '''
+  freq_counts = {}
+  with open(fname, "r") as f:
+    for line in f:
+      word, freq = line.strip().split('\t')
+      freq_counts[word] = int(freq)
+  return freq_counts
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--train_file', type=str, default=None, help='A link to the training corpus target file')
+  parser.add_argument('--train_counts', type=str, default=None, help='A link to the training word frequency counts as a tab-separated "word\\tfreq" file')
+  parser.add_argument('--out', type=str, required=True, help='The prefix of the index files to write')
+  args = parser.parse_args()
+  if (args.train_file == None) == (args.train_counts == None):
+    parser.error('exactly one of --train_file and --train_counts is required')
+  if args.train_counts != None:
+    freq_counts = read_train_counts(args.train_counts)
+  else:
+    freq_counts = count_train_file(args.train_file)
+  FreqIndex.from_counts(freq_counts).save(args.out)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+'''
+Word-level edit distance and error alignment, the Python counterpart of
+Levenshtein.pm.
+
+distance gives the same minimum edit path as Levenshtein::distance, as a
+string with one letter per step: d=delete, i=insert, s=substitute, e=equal,
+where insertions and deletions cost 1 and substitutions 1.1, and ties are
+broken in the same way, so deletions and insertions come before matches.
+Costs are floating point numbers added up in the same order as in the Perl
+code, as their rounding errors decide many ties between paths. Tokens can be
+any hashable values, such as the integer word IDs of an NgramVocab, and the
+table only keeps one byte per cell, for the step the path took to reach it.
+
+When only the cost is needed, distance_cost finds it without the path by
+only filling in a band of diagonals around the main one, which is widened
+until no path leaving it could be cheaper, and word_errors gives the plain
+unit-cost edit distance with a bit-parallel algorithm.
+
+Usage:
+  levenshtein.py ref.txt sys.txt --workers 4
+
+prints the edit path and cost of each line, like grade.pl, followed by the
+counts of each kind of step and the WER.
+'''
+
+import argparse
+import itertools
+import sys
+
+STEPS = 'dise'
+# Costs as in Levenshtein.pm
+INDEL_COST = 1
+SUB_COST = 1.1
+# The number of lines sent to a worker process at a time
+CHUNK_LINES = 1000
+# The width of the first band tried by distance_cost
+MIN_BAND = 4
+
+# The steps as bytes, as they are stored in the table
+_DEL, _INS, _SUB, _EQ = b'dise'
+
+def _fill(ref, test):
+  # The minimum costs of the last row and the step into every cell, in the
+  # order of Levenshtein::distance
+  m, n = len(ref), len(test)
+  width = n + 1
+  steps = bytearray(b'd') * ((m+1) * width)
+  steps[:width] = b'i' * width
+  prev = [float(j) for j in range(width)]
+  for i in range(1, m+1):
+    r = ref[i-1]
+    row = i * width
+    left = float(i)
+    cur = [left]
+    for j in range(1, width):
+      if r == test[j-1]:
+        c, step = prev[j-1], _EQ
+      else:
+        c, step = prev[j-1] + SUB_COST, _SUB
+      a = prev[j] + INDEL_COST
+      b = left + INDEL_COST
+      if a <= b and a <= c:
+        left = a
+        steps[row+j] = _DEL
+      elif b <= c:
+        left = b
+        steps[row+j] = _INS
+      else:
+        left = c
+        steps[row+j] = step
+      cur.append(left)
+    prev = cur
+  return prev, steps
+
+def distance(ref, test):
+  ''' The minimum edit path from ref to test and its cost
+
+  :param ref: the reference tokens
+  :param test: the system output tokens
+  :returns: the path as a string of d, i, s and e, and its cost
+  '''
+  if ref == test:
+    return 'e' * len(ref), 0.0
+  last, steps = _fill(ref, test)
+  width = len(test) + 1
+  i, j = len(ref), len(test)
+  path = bytearray()
+  while i or j:
+    step = steps[i*width+j]
+    path.append(step)
+    if step != _INS:
+      i -= 1
+    if step != _DEL:
+      j -= 1
+  path.reverse()
+  return path.decode('ascii'), last[-1]
+
+def _band_cost(ref, test, lo, hi):
+  # The minimum cost of a path from the start to the end that stays on the
+  # diagonals j-i from lo to hi
+  m, n = len(ref), len(test)
+  inf = float('inf')
+  prev = [float(j) if j <= hi else inf for j in range(n+1)]
+  for i in range(1, m+1):
+    r = ref[i-1]
+    start, end = max(0, i+lo), min(n, i+hi)
+    cur = [inf] * (n+1)
+    left = cur[start] = float(i) if start == 0 else inf
+    for j in range(max(1, start), end+1):
+      c = prev[j-1] if r == test[j-1] else prev[j-1] + SUB_COST
+      a = prev[j] + INDEL_COST
+      if a < c:
+        c = a
+      b = left + INDEL_COST
+      left = cur[j] = b if b < c else c
+    prev = cur
+  return prev[n]
+
+def distance_cost(ref, test):
+  ''' The cost of the minimum edit path from ref to test, as given by distance
+
+  A path that strays w diagonals beyond those between the start and the end
+  has at least 2*(w+1) insertions and deletions, so the cost of the best path
+  within the band is exact once it is no more than that.
+
+  :param ref: the reference tokens
+  :param test: the system output tokens
+  :returns: the cost
+  '''
+  if ref == test:
+    return 0.0
+  diff = len(test) - len(ref)
+  w = MIN_BAND
+  while True:
+    lo, hi = min(0, diff) - w, max(0, diff) + w
+    cost = _band_cost(ref, test, lo, hi)
+    if cost <= 2 * (w+1) or (lo <= -len(ref) and hi >= len(test)):
+      return cost
+    w *= 2
+
+def word_errors(ref, test):
+  ''' The unit-cost edit distance between ref and test
+
+  This is found with the bit-parallel algorithm of Myers (1999), with one
+  bit per reference token held in a Python integer, so it takes a few
+  integer operations per system output token.
+
+  :param ref: the reference tokens
+  :param test: the system output tokens
+  :returns: the minimum number of insertions, deletions and substitutions
+  '''
+  m = len(ref)
+  if m == 0:
+    return len(test)
+  peq = {}
+  for i, token in enumerate(ref):
+    peq[token] = peq.get(token, 0) | (1 << i)
+  mask = (1 << m) - 1
+  high = 1 << (m-1)
+  pv, mv, score = mask, 0, m
+  for token in test:
+    eq = peq.get(token, 0)
+    xv = eq | mv
+    xh = ((((eq & pv) + pv) & mask) ^ pv) | eq
+    ph = mv | (~(xh | pv) & mask)
+    mh = pv & xh
+    if ph & high:
+      score += 1
+    elif mh & high:
+      score -= 1
+    ph = ((ph << 1) | 1) & mask
+    mh = (mh << 1) & mask
+    pv = mh | (~(xv | ph) & mask)
+    mv = ph & xv
+  return score
+
+def divide(ref, test, path):
+  ''' Divide aligned token sequences into corresponding parts, like Levenshtein::divide
+
+  :param ref: the reference tokens
+  :param test: the system output tokens
+  :param path: the edit path from distance
+  :returns: a list of (reference tokens, output tokens) for each run of
+    equal tokens and each run of differences between them
+  '''
+  ret = []
+  r = t = 0
+  for _, steps in itertools.groupby(path, lambda x: x == 'e'):
+    steps = list(steps)
+    r_len = sum(1 for x in steps if x != 'i')
+    t_len = sum(1 for x in steps if x != 'd')
+    ret.append((ref[r:r+r_len], test[t:t+t_len]))
+    r, t = r + r_len, t + t_len
+  return ret
+
+def _distance_pair(pair):
+  return distance(*pair)
+
+def _cost_pair(pair):
+  return distance_cost(*pair)
+
+def batch_distances(pairs, workers=1, cost_only=False):
+  ''' Find the edit paths of many pairs of token sequences, in order
+
+  :param pairs: an iterable of (reference tokens, output tokens)
+  :param workers: the number of worker processes to split the pairs across
+  :param cost_only: if True, give only the costs from distance_cost
+  :returns: an iterator over the results of distance (or distance_cost) for each pair
+  '''
+  func = _cost_pair if cost_only else _distance_pair
+  if workers <= 1:
+    yield from map(func, pairs)
+    return
+  import multiprocessing
+  with multiprocessing.Pool(workers) as pool:
+    yield from pool.imap(func, pairs, chunksize=CHUNK_LINES)
+
+def step_counts(path):
+  ''' The number of each kind of step in an edit path, as a dictionary '''
+  return {x: path.count(x) for x in STEPS}
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('ref_file', help='The reference file')
+  parser.add_argument('test_file', help='The system output file')
+  parser.add_argument('--workers', type=int, default=1, help='How many worker processes to align the lines with')
+  parser.add_argument('--cost_only', action='store_true', help='Only print the cost of each line, which is faster')
+  args = parser.parse_args()
+  with open(args.ref_file, 'r') as ref_in, open(args.test_file, 'r') as test_in:
+    pairs = ((r.split(), t.split()) for r, t in zip(ref_in, test_in))
+    if args.cost_only:
+      for cost in batch_distances(pairs, args.workers, cost_only=True):
+        print('%.15g' % cost)
+      sys.exit(0)
+    counts = dict.fromkeys(STEPS, 0)
+    ref_len = 0
+    for path, cost in batch_distances(pairs, args.workers):
+      print('%s\t%.15g' % (path, cost))
+      for step, count in step_counts(path).items():
+        counts[step] += count
+      ref_len += len(path) - path.count('i')
+  total = sum(counts.values())
+  for step in STEPS:
+    print('%s: %d (%.2f%%)' % (step, counts[step], 100. * counts[step] / total if total else 0.))
+  print('WER: %.2f%%' % (100. * (counts['s'] + counts['i'] + counts['d']) / ref_len if ref_len else 0.))
@@ -0,0 +1,338 @@
+'''
+Array-backed n-gram counting, shared by the evaluation scripts.
+
+Words are interned to integer IDs, and every n-gram is identified by a
+64-bit key hashed from the words it is made of, so the keys of all the
+n-grams in a batch of lines are computed at once with array operations, and
+are the same in every process. Counts are kept in arrays sorted by key
+instead of dictionaries, so a distinct n-gram takes a few dozen bytes
+rather than a tuple and a dictionary entry, and a batch of lines is counted
+with a sort and merged with the counts so far.
+'''
+
+import hashlib
+import itertools
+import math
+
+import numpy as np
+
+# The multiplier that combines the key of an n-gram with the next word
+KEY_MULT = np.uint64(0x9E3779B97F4A7C15)
+# The multiplier that combines an n-gram key with the index of a line
+LINE_MULT = np.uint64(0xC2B2AE3D27D4EB4F)
+# The dtype of the word IDs kept with each n-gram
+WORD_DTYPE = np.int32
+# The names of the arrays of a table of NgramCounts, in order
+TABLE_NAMES = ('keys', 'counts', 'first', 'words')
+
+def word_hash(word):
+  ''' The 64-bit hash of a word that n-gram keys are built from '''
+  return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+class NgramVocab(object):
+  ''' A vocabulary of words mapped to dense integer IDs, with the hash of each '''
+
+  def __init__(self):
+    self.word_ids = {}
+    self.words = []
+    self._hashes = np.zeros(1024, dtype=np.int64)
+
+  def __len__(self):
+    ''' The number of words in the vocabulary '''
+    return len(self.words)
+
+  def __getstate__(self):
+    # The lookup dictionary can be rebuilt from the words, so leave it out
+    # to keep vocabularies small when sent between processes
+    return {'words': self.words, 'hashes': self.hashes()}
+
+  def __setstate__(self, state):
+    self.words = state['words']
+    self.word_ids = {w: i for i, w in enumerate(self.words)}
+    self._hashes = np.array(state['hashes'], dtype=np.int64)
+
+  @classmethod
+  def from_words(cls, words, hashes):
+    ''' A vocabulary of words in order of ID, with the hashes given by hashes() '''
+    ret = cls()
+    ret.__setstate__({'words': list(words), 'hashes': hashes})
+    return ret
+
+  def copy(self):
+    ''' A copy of the vocabulary, which words can be added to separately '''
+    ret = NgramVocab()
+    ret.word_ids = self.word_ids.copy()
+    ret.words = self.words.copy()
+    ret._hashes = self._hashes.copy()
+    return ret
+
+  def word_id(self, word):
+    ''' Get the ID of a word, adding it if it doesn't exist '''
+    wid = self.word_ids.get(word)
+    if wid is None:
+      wid = self.word_ids[word] = len(self.words)
+      self.words.append(word)
+      if wid == len(self._hashes):
+        self._hashes = np.concatenate([self._hashes, np.zeros(len(self._hashes), dtype=np.int64)])
+      self._hashes[wid] = word_hash(word)
+    return wid
+
+  def encode_words(self, sent):
+    ''' Get the word IDs of a sentence '''
+    return [self.word_id(x) for x in sent]
+
+  def encode_lines(self, lines):
+    ''' Get the word IDs of lines of tokens
+
+    :param lines: a list of lines, each a list of tokens
+    :returns: the word IDs of all the tokens, and the offset of each line
+      in them followed by the total number of tokens
+    '''
+    tokens = list(itertools.chain.from_iterable(lines))
+    wids = list(map(self.word_ids.get, tokens))
+    if None in wids:
+      # new words are added in the order they appear
+      wids = [self.word_id(x) if wid is None else wid for x, wid in zip(tokens, wids)]
+    offsets = np.zeros(len(lines)+1, dtype=np.int64)
+    np.cumsum([len(x) for x in lines], out=offsets[1:])
+    return np.array(wids, dtype=np.int64), offsets
+
+  def hashes(self):
+    ''' The hash of every word, as an array indexed by word ID '''
+    return self._hashes[:len(self.words)]
+
+  def merge(self, other):
+    ''' Add the words of another vocabulary to this one
+
+    :param other: the other vocabulary
+    :returns: an array mapping the other's word IDs to this one's
+    '''
+    return np.array([self.word_id(w) for w in other.words], dtype=np.int64)
+
+  def ngram(self, wids):
+    ''' Get an n-gram as a tuple of words from its word IDs '''
+    return tuple(self.words[x] for x in wids)
+
+def ngram_keys(hashes, offsets, max_order):
+  ''' The keys of the n-grams in lines of words
+
+  :param hashes: the word hash of every token, e.g. NgramVocab.hashes()[wids]
+  :param offsets: the offset of each line, followed by the number of tokens
+  :param max_order: the maximum n-gram order
+  :returns: for each order, the keys of its n-grams and the positions of their
+    first tokens, in order of position
+  '''
+  ends = np.repeat(offsets[1:], np.diff(offsets))
+  words = keys = hashes.view(np.uint64)
+  ret = []
+  for n in range(1, max_order+1):
+    if n > 1:
+      keys = keys[:-1] * KEY_MULT + words[n-1:]
+    # keep the n-grams that end in the line they start in
+    pos = np.flatnonzero(np.arange(len(keys)) + n <= ends[:len(keys)])
+    ret.append((keys[pos].view(np.int64), pos))
+  return ret
+
+def line_keys(keys, lines):
+  ''' Keys for n-grams in particular lines, to count n-grams within each line '''
+  return (keys.view(np.uint64) + lines.astype(np.uint64) * LINE_MULT).view(np.int64)
+
+def ngram_words(wids, pos, order):
+  ''' The word IDs of the n-grams of one order starting at the given token positions '''
+  return wids[pos[:, None] + np.arange(order)].astype(WORD_DTYPE)
+
+def group_keys(keys, order=None):
+  ''' Sort keys and find the start of each run of equal keys
+
+  :param keys: the keys
+  :param order: the order that sorts the keys, if it is already known
+  :returns: the order that sorts the keys, and the starting index of each
+    distinct key in the sorted keys
+  '''
+  if order is None:
+    order = np.argsort(keys)
+  sorted_keys = keys[order]
+  starts = np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]])) if len(keys) else np.zeros(0, dtype=np.int64)
+  return order, starts
+
+def _merge_runs(a, b):
+  keys = np.concatenate([a[0], b[0]])
+  # both runs are sorted, which a stable sort takes advantage of
+  order, starts = group_keys(keys, np.argsort(keys, kind='stable'))
+  counts = np.concatenate([a[1], b[1]])[order]
+  first = np.concatenate([a[2], b[2]])[order]
+  words = np.concatenate([a[3], b[3]])
+  return (keys[order[starts]], np.add.reduceat(counts, starts), np.minimum.reduceat(first, starts), words[order[starts]])
+
+class NgramCounts(object):
+  ''' Counts of distinct n-grams, kept in arrays sorted by n-gram key
+
+  Each n-gram has one or more counts, the least position it was counted at,
+  which orders n-grams the way they first appear in a corpus, and its word
+  IDs. The n-grams of each order are kept in a few sorted runs of distinct
+  keys, and the last two are merged whenever the older is no more than twice
+  the size of the newer, so each n-gram is only merged a few times and the
+  runs never hold many more entries than there are distinct n-grams.
+  '''
+
+  def __init__(self, max_order, num_columns=1):
+    ''' :param max_order: the maximum n-gram order
+    :param num_columns: the number of counts kept for each n-gram
+    '''
+    self.max_order = max_order
+    self.num_columns = num_columns
+    self.runs = [[] for _ in range(max_order)]
+
+  def add(self, order, keys, counts, first, wids, starts):
+    ''' Add counts for n-grams of one order
+
+    :param order: the n-gram order
+    :param keys: the n-gram keys, which can repeat
+    :param counts: the counts to add, with one row per key and one column per count
+    :param first: the position of each key, of which the least is kept
+    :param wids: the word IDs of the tokens the n-grams were taken from
+    :param starts: the position in wids of the first word of each key
+    '''
+    if len(keys):
+      perm, groups = group_keys(keys)
+      rep = perm[groups]
+      # only the words of one occurrence of each distinct n-gram are kept
+      self._add_run(order, (keys[rep], np.add.reduceat(counts[perm], groups),
+                            np.minimum.reduceat(first[perm], groups), ngram_words(wids, starts[rep], order)))
+
+  def add_table(self, order, keys, counts, first, words):
+    ''' Add counts for distinct n-grams of one order, sorted by key, as given by table '''
+    if len(keys):
+      self._add_run(order, (keys, counts, first, words))
+
+  def _add_run(self, order, run):
+    runs = self.runs[order-1]
+    runs.append(run)
+    while len(runs) > 1 and len(runs[-2][0]) <= 2 * len(runs[-1][0]):
+      b = runs.pop()
+      runs.append(_merge_runs(runs.pop(), b))
+
+  def merge(self, other, word_remap, first_offset=0):
+    ''' Add the counts of another NgramCounts
+
+    :param other: the other counts
+    :param word_remap: an array mapping the other's word IDs to this one's
+    :param first_offset: the offset to add to the other's positions
+    '''
+    for order, runs in enumerate(other.runs, 1):
+      for keys, counts, first, words in runs:
+        self._add_run(order, (keys, counts, first + first_offset, word_remap[words].astype(WORD_DTYPE)))
+
+  def table(self, order):
+    ''' The n-grams of one order
+
+    :param order: the n-gram order
+    :returns: the keys in sorted order, their counts, their least positions
+      and their word IDs
+    '''
+    runs = self.runs[order-1]
+    while len(runs) > 1:
+      b = runs.pop()
+      runs.append(_merge_runs(runs.pop(), b))
+    if not runs:
+      return (np.zeros(0, dtype=np.int64), np.zeros((0, self.num_columns), dtype=np.int64),
+              np.zeros(0, dtype=np.int64), np.zeros((0, order), dtype=WORD_DTYPE))
+    return runs[0]
+
+  def arrays(self, prefix=''):
+    ''' The tables of every order as arrays by name, which add_arrays adds to another NgramCounts
+
+    :param prefix: a prefix for the names, to keep several NgramCounts in one file
+    '''
+    ret = {}
+    for n in range(1, self.max_order+1):
+      for name, x in zip(TABLE_NAMES, self.table(n)):
+        ret['%s%s%d' % (prefix, name, n)] = x
+    return ret
+
+  def add_arrays(self, arrays, prefix=''):
+    ''' Add counts saved as given by arrays, from a mapping of names to arrays such as a loaded .npz file '''
+    for n in range(1, self.max_order+1):
+      self.add_table(n, *(arrays['%s%s%d' % (prefix, name, n)] for name in TABLE_NAMES))
+
+  def tables(self, max_order=None):
+    ''' The counts and least positions of the n-grams of every order up to max_order, concatenated
+
+    :returns: the counts, the least positions, and the word IDs of each order
+      in a list, in the same order as the counts
+    '''
+    tables = [self.table(n) for n in range(1, (max_order or self.max_order)+1)]
+    return (np.concatenate([x[1] for x in tables]), np.concatenate([x[2] for x in tables]), [x[3] for x in tables])
+
+class WordCounts(object):
+  ''' Counts indexed by word ID, in an array that grows with the vocabulary '''
+
+  def __init__(self):
+    self.counts = np.zeros(0, dtype=np.int64)
+
+  def add(self, ids, weights=None):
+    ''' Add word occurrences, optionally each with an integer weight '''
+    counts = np.bincount(ids, weights=weights, minlength=len(self.counts)).astype(np.int64)
+    self.counts = self.array(len(counts))
+    self.counts += counts
+
+  def array(self, size):
+    ''' Get the counts as an array of at least the given size '''
+    if size > len(self.counts):
+      self.counts = np.concatenate([self.counts, np.zeros(size - len(self.counts), dtype=np.int64)])
+    return self.counts
+
+  def merge(self, other, remap):
+    ''' Add the counts of another WordCounts, with IDs mapped through remap '''
+    ids = np.flatnonzero(other.counts)
+    self.add(remap[ids], other.counts[ids])
+
+def sentence_bleu_plus1(matches, hyp_len, ref_len):
+  ''' Sentence-level BLEU+1 from n-gram match counts
+
+  This gives the same result as nltk.translate.bleu_score.sentence_bleu with
+  SmoothingFunction().method2 and uniform weights: all precisions except the
+  unigram one have 1 added to their numerator and denominator.
+
+  :param matches: the number of clipped n-gram matches for each order
+  :param hyp_len: the length of the hypothesis
+  :param ref_len: the length of the reference
+  :returns: the BLEU+1 score
+  '''
+  if matches[0] == 0:
+    return 0
+  max_order = len(matches)
+  precs = [matches[0] / float(hyp_len)]
+  for n in range(2, max_order+1):
+    precs.append((matches[n-1] + 1) / float(max(1, hyp_len-n+1) + 1))
+  if hyp_len > ref_len:
+    bp = 1.0
+  else:
+    bp = math.exp(1 - ref_len / float(hyp_len))
+  return bp * math.exp(math.fsum(math.log(p) / max_order for p in precs))
+
+def sentence_bleus_plus1(matches, hyp_lens, ref_lens):
+  ''' Sentence-level BLEU+1 of many sentences at once, the same as sentence_bleu_plus1 gives
+
+  The arithmetic is done on arrays, but logarithms and exponentials are taken
+  with the math module, as NumPy's can differ from it in the last bit.
+
+  :param matches: the clipped n-gram match counts, one row per sentence and
+    one column per order
+  :param hyp_lens: the length of each hypothesis
+  :param ref_lens: the length of each reference
+  :returns: an array of the BLEU+1 scores
+  '''
+  ret = np.zeros(len(matches))
+  max_order = matches.shape[1]
+  # sentences without unigram matches score 0
+  matched = np.flatnonzero(matches[:, 0])
+  matches, hyp_lens, ref_lens = matches[matched], hyp_lens[matched], ref_lens[matched]
+  precs = (matches + 1) / (np.maximum(1, hyp_lens[:, None] - np.arange(max_order)) + 1)
+  precs[:, 0] = matches[:, 0] / hyp_lens
+  logs = np.array(list(map(math.log, precs.ravel().tolist()))).reshape(precs.shape) / max_order
+  bp = np.ones(len(matched))
+  short = np.flatnonzero(hyp_lens <= ref_lens)
+  bp[short] = list(map(math.exp, (1 - ref_lens[short] / hyp_lens[short]).tolist()))
+  ret[matched] = bp * list(map(math.exp, map(math.fsum, logs.tolist())))
+  return ret
@@ -11,18 +11,45 @@
 #                                                                    #
 ######################################################################
 
+import functools
+import hashlib
+import os
+from collections import Counter
+
 import numpy as np
 
+from phase_timer import PhaseTimer, NO_TIMER
+
 
 EVAL_TYPE_ACC = "acc"
 EVAL_TYPE_BLEU = "bleu"
 EVAL_TYPE_BLEU_DETOK = "bleu_detok"
 EVAL_TYPE_PEARSON = "pearson"
+EVAL_TYPE_CHRF = "chrf"
+EVAL_TYPE_TER = "ter"
 
 EVAL_TYPES = [EVAL_TYPE_ACC,
               EVAL_TYPE_BLEU,
               EVAL_TYPE_BLEU_DETOK,
-              EVAL_TYPE_PEARSON]
+              EVAL_TYPE_PEARSON,
+              EVAL_TYPE_CHRF,
+              EVAL_TYPE_TER]
+
+# Evaluation types where a lower score is better
+LOWER_IS_BETTER = [EVAL_TYPE_TER]
+
+BLEU_MAX_ORDER = 4
+# The character n-gram order and recall weight of chrF, as in sacrebleu
+CHRF_CHAR_ORDER = 6
+CHRF_BETA = 2
+
+# The maximum number of sampled indices to hold in memory at once
+MAX_CHUNK_INDICES = 2**22
+# The maximum number of bootstrap samples drawn from one random generator
+MAX_BLOCK_SAMPLES = 256
+# When stopping early, how often to check and the z value of the p value bounds
+EARLY_STOP_CHECK_SAMPLES = 1000
+EARLY_STOP_Z = 2.576
 
 
 def eval_preproc(data, eval_type='acc'):
@@ -35,6 +62,23 @@ def eval_preproc(data, eval_type='acc'):
       data = float(data)
   return data
 
+@functools.lru_cache(maxsize=None)
+def sacrebleu_tokenizer():
+  ''' The tokenizer of sacrebleu.corpus_bleu, created once on first use
+
+  sacrebleu is slow to import, so it is only imported for bleu_detok. Using
+  a single tokenizer also keeps its cache of tokenized lines, so the gold
+  data is only tokenized once however many systems are compared.
+  '''
+  import sacrebleu
+  return sacrebleu.metrics.BLEU().tokenizer
+
+@functools.lru_cache(maxsize=None)
+def sacrebleu_ter():
+  ''' The sacrebleu TER metric with its default options, created once on first use '''
+  import sacrebleu
+  return sacrebleu.metrics.TER()
+
 def eval_measure(gold, sys, eval_type='acc'):
   ''' Evaluation measure
   
@@ -44,10 +88,12 @@ def eval_measure(gold, sys, eval_type='acc'):
   * Pearson's correlation coefficient (pearson)
   * BLEU score (bleu)
   * BLEU_detok, on detokenized references and translations, with internal tokenization
+  * chrF (chrf), the character n-gram F-score, on detokenized text
+  * TER (ter), the translation edit rate, on detokenized text, where lower is better
 
   :param gold: the correct labels
   :param sys: the system outputs
-  :param eval_type: The type of evaluation to do (acc, pearson, bleu, bleu_detok)
+  :param eval_type: The type of evaluation to do (acc, pearson, bleu, bleu_detok, chrf, ter)
   '''
   if eval_type == EVAL_TYPE_ACC:
     return sum([1 if g == s else 0 for g, s in zip(gold, sys)]) / float(len(gold))
@@ -61,12 +107,371 @@ def eval_measure(gold, sys, eval_type='acc'):
     import sacrebleu
     # make sure score is 0-based instead of 100-based
     return sacrebleu.corpus_bleu(sys, [gold]).score / 100.
+  elif eval_type == EVAL_TYPE_CHRF:
+    import sacrebleu
+    return sacrebleu.corpus_chrf(sys, [gold]).score / 100.
+  elif eval_type == EVAL_TYPE_TER:
+    import sacrebleu
+    return sacrebleu.corpus_ter(sys, [gold]).score / 100.
   else:
     raise NotImplementedError('Unknown eval type in eval_measure: %s' % eval_type)
 
+def bleu_sent_stats(hyp, ref, max_order=BLEU_MAX_ORDER, min_total=0):
+  ''' BLEU sufficient statistics for a single tokenized sentence
+
+  :param hyp: the system output, as a list of tokens
+  :param ref: the reference, as a list of tokens
+  :param max_order: the maximum n-gram order
+  :param min_total: lower bound on the n-gram totals (NLTK uses 1, sacrebleu 0)
+  :returns: a list [hyp_len, ref_len, matches_1..N, totals_1..N]
+  '''
+  matches, totals = [], []
+  for n in range(1, max_order+1):
+    hyp_ngrams = Counter(tuple(hyp[i:i+n]) for i in range(len(hyp)-n+1))
+    ref_ngrams = Counter(tuple(ref[i:i+n]) for i in range(len(ref)-n+1))
+    matches.append(sum(min(v, ref_ngrams[k]) for k, v in hyp_ngrams.items() if k in ref_ngrams))
+    totals.append(max(min_total, len(hyp)-n+1))
+  return [len(hyp), len(ref)] + matches + totals
+
+def chrf_sent_stats(hyp, ref, char_order=CHRF_CHAR_ORDER):
+  ''' chrF sufficient statistics for a single sentence, as sacrebleu calculates them
+
+  :param hyp: the system output
+  :param ref: the reference
+  :param char_order: the maximum character n-gram order
+  :returns: a list [hyp_count, ref_count, matches] for each order, flattened
+  '''
+  # sacrebleu leaves out whitespace from character n-grams
+  hyp, ref = ''.join(hyp.split()), ''.join(ref.split())
+  stats = []
+  for n in range(1, char_order+1):
+    hyp_ngrams = Counter(hyp[i:i+n] for i in range(len(hyp)-n+1))
+    ref_ngrams = Counter(ref[i:i+n] for i in range(len(ref)-n+1))
+    matches = sum(min(v, ref_ngrams[k]) for k, v in hyp_ngrams.items() if k in ref_ngrams)
+    # hypothesis n-grams aren't counted when the reference has none of that order
+    stats.extend([max(0, len(hyp)-n+1) if ref_ngrams else 0, max(0, len(ref)-n+1), matches])
+  return stats
+
+def eval_stats(gold, sys, eval_type='acc'):
+  ''' Per-example sufficient statistics
+
+  The statistics are calculated once, and the score of any subset of the
+  examples can then be found by summing the corresponding rows and calling
+  eval_from_stats. This is much faster than re-running eval_measure on every
+  bootstrap sample.
+
+  :param gold: the correct labels (preprocessed by eval_preproc)
+  :param sys: the system outputs (preprocessed by eval_preproc)
+  :param eval_type: The type of evaluation to do (acc, pearson, bleu, bleu_detok, chrf, ter)
+  :returns: a numpy array with one row of statistics per example
+  '''
+  if eval_type == EVAL_TYPE_ACC:
+    return np.array([[1 if g == s else 0, 1] for g, s in zip(gold, sys)], dtype=np.int64).reshape((len(gold), 2))
+  elif eval_type == EVAL_TYPE_PEARSON:
+    # center the values, which doesn't change the correlation but avoids
+    # cancellation when calculating it from sums of squares
+    gold = np.array(gold, dtype=np.float64)
+    sys = np.array(sys, dtype=np.float64)
+    gold -= gold.mean()
+    sys -= sys.mean()
+    return np.stack([np.ones_like(gold), gold, sys, gold*gold, sys*sys, gold*sys], axis=-1)
+  elif eval_type == EVAL_TYPE_BLEU:
+    stats = [bleu_sent_stats(s, g, min_total=1) for g, s in zip(gold, sys)]
+  elif eval_type == EVAL_TYPE_BLEU_DETOK:
+    # tokenize once up front in the same way as sacrebleu.corpus_bleu
+    tokenize = sacrebleu_tokenizer()
+    stats = [bleu_sent_stats(tokenize(s.rstrip()).split(), tokenize(g.rstrip()).split())
+             for g, s in zip(gold, sys)]
+  elif eval_type == EVAL_TYPE_CHRF:
+    stats = [chrf_sent_stats(s, g) for g, s in zip(gold, sys)]
+    return np.array(stats, dtype=np.int64).reshape((len(gold), 3*CHRF_CHAR_ORDER))
+  elif eval_type == EVAL_TYPE_TER:
+    # the number of edits and the reference length, from sacrebleu's TER
+    # with shifts, which is too slow to run on every sample
+    ter = sacrebleu_ter()
+    stats = [ter.sentence_score(s, [g]) for g, s in zip(gold, sys)]
+    return np.array([[x.num_edits, int(x.ref_length)] for x in stats], dtype=np.int64).reshape((len(gold), 2))
+  else:
+    raise NotImplementedError('Unknown eval type in eval_stats: %s' % eval_type)
+  return np.array(stats, dtype=np.int64).reshape((len(gold), 2+2*BLEU_MAX_ORDER))
+
+def eval_from_stats(stats, eval_type='acc'):
+  ''' Evaluation measure calculated from summed statistics
+
+  This gives the same result as eval_measure, but takes in statistics
+  summed over the examples from eval_stats. Several scores can be calculated
+  at once by passing in a 2D array with one row per set of examples.
+
+  :param stats: the summed statistics
+  :param eval_type: The type of evaluation to do (acc, pearson, bleu, bleu_detok, chrf, ter)
+  :returns: the score, or an array of scores for 2D input
+  '''
+  stats = np.asarray(stats, dtype=np.float64)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    if eval_type == EVAL_TYPE_ACC:
+      score = stats[...,0] / stats[...,1]
+    elif eval_type == EVAL_TYPE_PEARSON:
+      n, sum_g, sum_s, sum_gg, sum_ss, sum_gs = [stats[...,i] for i in range(6)]
+      cov = sum_gs - sum_g * sum_s / n
+      var_g = sum_gg - sum_g * sum_g / n
+      var_s = sum_ss - sum_s * sum_s / n
+      score = cov / np.sqrt(var_g * var_s)
+    elif eval_type == EVAL_TYPE_BLEU:
+      # Matches nltk.translate.bleu_score.corpus_bleu without smoothing,
+      # where zero precisions are floored to the smallest float
+      sys_len, ref_len, matches, totals = _split_bleu_stats(stats)
+      bp = np.where(sys_len > ref_len, 1.0, np.exp(1 - ref_len / sys_len))
+      bp = np.where(sys_len == 0, 0.0, bp)
+      prec = np.where(matches > 0, matches / totals, np.finfo(np.float64).tiny)
+      score = bp * np.exp(np.log(prec).mean(axis=-1))
+      score = np.where(matches[...,0] == 0, 0.0, score)
+    elif eval_type == EVAL_TYPE_BLEU_DETOK:
+      # Matches sacrebleu.corpus_bleu with the default "exp" smoothing,
+      # made 0-based instead of 100-based
+      sys_len, ref_len, matches, totals = _split_bleu_stats(stats)
+      bp = np.where(sys_len < ref_len, np.exp(1 - ref_len / sys_len), 1.0)
+      bp = np.where(sys_len == 0, 0.0, bp)
+      smooth = np.cumprod(np.where(matches == 0, 2.0, 1.0), axis=-1)
+      prec = np.where(matches > 0, 100. * matches / totals, 100. / (smooth * totals))
+      logs = np.where(totals > 0, np.log(prec), -9999999999)
+      score = bp * np.exp(logs.mean(axis=-1)) / 100.
+      score = np.where(matches.sum(axis=-1) == 0, 0.0, score)
+    elif eval_type == EVAL_TYPE_CHRF:
+      # Matches sacrebleu.corpus_chrf, which averages the precision and
+      # recall over the orders with n-grams on both sides, made 0-based
+      # instead of 100-based
+      n_hyp, n_ref, matches = stats[...,0::3], stats[...,1::3], stats[...,2::3]
+      found = (n_hyp > 0) & (n_ref > 0)
+      orders = found.sum(axis=-1)
+      prec = np.where(found, matches / n_hyp, 0.0).sum(axis=-1) / orders
+      rec = np.where(found, matches / n_ref, 0.0).sum(axis=-1) / orders
+      factor = CHRF_BETA ** 2
+      score = np.where((orders > 0) & (prec + rec > 0), (1 + factor) * prec * rec / (factor * prec + rec), 0.0)
+    elif eval_type == EVAL_TYPE_TER:
+      # Matches sacrebleu.corpus_ter, made 0-based instead of 100-based
+      edits, ref_len = stats[...,0], stats[...,1]
+      score = np.where(ref_len > 0, edits / ref_len, np.where(edits > 0, 1.0, 0.0))
+    else:
+      raise NotImplementedError('Unknown eval type in eval_from_stats: %s' % eval_type)
+  return score if score.ndim else float(score)
+
+def _split_bleu_stats(stats):
+  return (stats[...,0], stats[...,1],
+          stats[...,2:2+BLEU_MAX_ORDER], stats[...,2+BLEU_MAX_ORDER:2+2*BLEU_MAX_ORDER])
+
+class StatsCache(object):
+  ''' Per-example statistics saved between runs
+
+  The statistics from eval_stats are stored by a hash of each example, so
+  when a new system output is evaluated against the same gold data, only
+  the examples that changed since the last run need to be calculated
+  again. Saving the cache keeps only the examples used since it was loaded.
+  Pearson statistics depend on the mean of all the examples, so they are
+  always calculated from scratch.
+  '''
+
+  def __init__(self, eval_type):
+    self.eval_type = eval_type
+    self.rows = {}
+    self.used = {}
+
+  @classmethod
+  def load(cls, fname, eval_type):
+    ''' Load a cache, or start an empty one if it doesn't exist or is for another eval type '''
+    cache = cls(eval_type)
+    if os.path.exists(fname):
+      with np.load(fname) as data:
+        if str(data['eval_type']) == eval_type:
+          keys = data['keys'].tobytes()
+          cache.rows = {keys[i*16:(i+1)*16]: row for i, row in enumerate(data['stats'])}
+    return cache
+
+  def save(self, fname):
+    with open(fname + '.tmp', 'wb') as f:
+      np.savez(f, eval_type=self.eval_type,
+               keys=np.frombuffer(b''.join(self.used.keys()), dtype=np.uint8),
+               stats=np.array(list(self.used.values())))
+    os.replace(fname + '.tmp', fname)
+
+  def eval_stats(self, gold, sys):
+    ''' Get the same statistics as eval_stats, calculating only those not in the cache '''
+    if self.eval_type == EVAL_TYPE_PEARSON or len(gold) == 0:
+      return eval_stats(gold, sys, self.eval_type)
+    keys = [hashlib.blake2b(repr((g, s)).encode('utf-8'), digest_size=16).digest() for g, s in zip(gold, sys)]
+    missing = [i for i, k in enumerate(keys) if k not in self.rows]
+    if missing:
+      stats = eval_stats([gold[i] for i in missing], [sys[i] for i in missing], self.eval_type)
+      self.rows.update(zip([keys[i] for i in missing], stats))
+    rows = [self.rows[k] for k in keys]
+    self.used.update(zip(keys, rows))
+    return np.array(rows, dtype=np.int64)
+
+def bootstrap_scores(all_stats, num_samples, sample_size, eval_type='acc', seed=None, workers=1,
+                     early_stop=None, check_every=EARLY_STOP_CHECK_SAMPLES):
+  ''' Calculate scores on bootstrap samples
+
+  The samples are split into blocks of at most MAX_BLOCK_SAMPLES samples
+  (and MAX_CHUNK_INDICES indices, to bound memory). Each block draws its
+  indices at once as a matrix from its own random generator, derived from
+  the seed with a SeedSequence, and every system is scored on each sample
+  by summing its per-example statistics. As the blocks don't depend on the
+  number of workers, the scores for a given seed are identical no matter
+  how many workers are used.
+
+  :param all_stats: A list of per-example statistics from eval_stats, one per system
+  :param num_samples: The number of bootstrap samples to take
+  :param sample_size: The number of examples in each sample
+  :param eval_type: The type of evaluation to do (acc, pearson, bleu, bleu_detok, chrf, ter)
+  :param seed: The random seed, or None to use fresh entropy
+  :param workers: The number of worker processes
+  :param early_stop: If set, a significance level; sampling stops once every
+                     pairwise p value is decisively above or below it
+  :param check_every: How often (in samples) to check whether to stop early
+  :returns: an array of scores with one row per sample and one column per system,
+            which has fewer than num_samples rows if sampling stopped early
+  '''
+  block_size = max(1, min(MAX_BLOCK_SAMPLES, MAX_CHUNK_INDICES // max(1, sample_size)))
+  block_lens = [min(block_size, num_samples-start) for start in range(0, num_samples, block_size)]
+  seeds = np.random.SeedSequence(seed).spawn(len(block_lens))
+  blocks = [(s, l, sample_size) for s, l in zip(seeds, block_lens)]
+  all_cols = [[np.ascontiguousarray(col) for col in stats.T] for stats in all_stats]
+  # Without early stopping, all blocks are done in one round
+  round_size = max(1, check_every // block_size) if early_stop is not None else max(1, len(blocks))
+  pool = None
+  if workers > 1 and len(blocks) > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(workers, initializer=_init_block_worker, initargs=(all_cols, eval_type))
+  else:
+    _init_block_worker(all_cols, eval_type)
+  try:
+    block_scores = []
+    for start in range(0, len(blocks), round_size):
+      round_blocks = blocks[start:start+round_size]
+      if pool is not None:
+        block_scores.extend(pool.map(_bootstrap_block, round_blocks))
+      else:
+        block_scores.extend([_bootstrap_block(block) for block in round_blocks])
+      if early_stop is not None and bootstrap_decided(np.concatenate(block_scores), early_stop):
+        break
+  finally:
+    if pool is not None:
+      pool.terminate()
+  return np.concatenate(block_scores) if block_scores else np.empty((0, len(all_stats)))
+
+def bootstrap_decided(scores, significance, z=EARLY_STOP_Z):
+  ''' Check whether the bootstrap samples so far decide every comparison
+
+  For every pair of systems, the p value is the ratio of samples where
+  the winning system did not win. A comparison is decided when the Wilson
+  score interval of that ratio lies entirely above or below the significance
+  level.
+
+  :param scores: The scores so far, with one column per system
+  :param significance: The significance level
+  :param z: The z value of the confidence interval around each p value
+  :returns: True if all comparisons are decided
+  '''
+  n = len(scores)
+  for i in range(scores.shape[1]):
+    for j in range(i+1, scores.shape[1]):
+      wins = max(np.sum(scores[:,i] > scores[:,j]), np.sum(scores[:,i] < scores[:,j]))
+      p = (n - wins) / float(n)
+      center = (p + z*z/(2*n)) / (1 + z*z/n)
+      margin = z / (1 + z*z/n) * np.sqrt(p*(1-p)/n + z*z/(4*n*n))
+      if center - margin <= significance <= center + margin:
+        return False
+  return True
+
+_block_cols, _block_eval_type = None, None
+
+def _init_block_worker(all_cols, eval_type):
+  global _block_cols, _block_eval_type
+  _block_cols, _block_eval_type = all_cols, eval_type
+
+def _bootstrap_block(block):
+  seed, num_samples, sample_size = block
+  rng = np.random.default_rng(seed)
+  ids = rng.integers(0, len(_block_cols[0][0]), size=(num_samples, sample_size))
+  scores = np.empty((num_samples, len(_block_cols)))
+  for i, cols in enumerate(_block_cols):
+    summed = np.stack([col[ids].sum(axis=1) for col in cols], axis=-1)
+    scores[:,i] = eval_from_stats(summed, _block_eval_type)
+  return scores
+
+def system_stats(gold, systems, eval_type='acc', stats_cache=None, timer=NO_TIMER):
+  ''' Preprocess the gold data and system outputs, and calculate the per-example statistics of each system
+
+  :param gold: The correct labels
+  :param systems: A list of outputs, one for each system
+  :param eval_type: The type of evaluation to do (acc, pearson, bleu, bleu_detok, chrf, ter)
+  :param stats_cache: A StatsCache to get the per-example statistics from, if any
+  :param timer: A PhaseTimer to add the time of preprocessing and statistics to
+  :returns: a list of statistics from eval_stats, one per system
+  '''
+  # Preprocess the data appropriately for they type of eval
+  with timer.phase('load'):
+    gold = [eval_preproc(x, eval_type) for x in gold]
+    systems = [[eval_preproc(x, eval_type) for x in sys] for sys in systems]
+
+  # Calculate sufficient statistics once, and score all samples from them
+  with timer.phase('stats'):
+    if stats_cache is not None:
+      return [stats_cache.eval_stats(gold, sys) for sys in systems]
+    return [eval_stats(gold, sys, eval_type) for sys in systems]
+
+def save_shard_stats(fname, gold, systems, sys_names, eval_type='acc', stats_cache=None, timer=NO_TIMER):
+  ''' Save the per-example statistics of a shard of the data, to be merged with load_shard_stats
+
+  Pearson statistics depend on the mean of all the examples, so the values
+  themselves are saved instead, and the statistics are calculated once the
+  shards are merged.
+
+  :param fname: The file to save the statistics to
+  :param gold: The correct labels of the shard
+  :param systems: A list of outputs of the shard, one for each system
+  :param sys_names: The names of the systems
+  :param eval_type: The type of evaluation to do (acc, pearson, bleu, bleu_detok, chrf, ter)
+  :param stats_cache: A StatsCache to get the per-example statistics from, if any
+  :param timer: A PhaseTimer to add the time of preprocessing and statistics to
+  '''
+  for sys in systems:
+    assert(len(gold) == len(sys))
+
+  if eval_type == EVAL_TYPE_PEARSON:
+    with timer.phase('load'):
+      gold = [eval_preproc(x, eval_type) for x in gold]
+      all_stats = [np.stack([gold, [eval_preproc(x, eval_type) for x in sys]], axis=-1) for sys in systems]
+  else:
+    all_stats = system_stats(gold, systems, eval_type=eval_type, stats_cache=stats_cache, timer=timer)
+  with timer.phase('output'):
+    with open(fname + '.tmp', 'wb') as f:
+      np.savez_compressed(f, eval_type=eval_type, sys_names=np.array(sys_names), stats=np.stack(all_stats))
+    os.replace(fname + '.tmp', fname)
+
+def load_shard_stats(fnames):
+  ''' Merge the per-example statistics of the shards of the data saved with save_shard_stats
+
+  :param fnames: The files of the shards, in order
+  :returns: the eval type, the names of the systems in the first shard,
+            and the statistics of each system on the whole data
+  '''
+  eval_type, sys_names, shards = None, None, []
+  for fname in fnames:
+    with np.load(fname) as data:
+      if eval_type is None:
+        eval_type, sys_names = str(data['eval_type']), data['sys_names'].tolist()
+      elif (str(data['eval_type']), len(data['sys_names'])) != (eval_type, len(sys_names)):
+        raise ValueError('%s has a different eval type or number of systems from %s' % (fname, fnames[0]))
+      shards.append(data['stats'])
+  stats = np.concatenate(shards, axis=1)
+  if eval_type == EVAL_TYPE_PEARSON:
+    return eval_type, sys_names, [eval_stats(x[:,0], x[:,1], eval_type) for x in stats]
+  return eval_type, sys_names, list(stats)
+
 def eval_with_paired_bootstrap(gold, sys1, sys2,
                                num_samples=10000, sample_ratio=0.5,
-                               eval_type='acc'):
+                               eval_type='acc',
+                               seed=None, workers=1, early_stop=None, stats_cache=None, timer=NO_TIMER):
   ''' Evaluate with paired boostrap
 
   This compares two systems, performing a significance tests with
@@ -77,39 +482,41 @@ def eval_with_paired_bootstrap(gold, sys1, sys2,
   :param sys2: The output of system 2
   :param num_samples: The number of bootstrap samples to take
   :param sample_ratio: The ratio of samples to take every time
-  :param eval_type: The type of evaluation to do (acc, pearson, bleu, bleu_detok)
+  :param eval_type: The type of evaluation to do (acc, pearson, bleu, bleu_detok, chrf, ter)
+  :param seed: The random seed, or None to use fresh entropy
+  :param workers: The number of worker processes to split the samples across
+  :param early_stop: If set, a significance level at which to stop sampling early,
+                     with num_samples as the maximum
+  :param stats_cache: A StatsCache to get the per-example statistics from, if any
+  :param timer: A PhaseTimer to add the time of preprocessing, statistics and sampling to
   '''
   assert(len(gold) == len(sys1))
   assert(len(gold) == len(sys2))
-  
-  # Preprocess the data appropriately for they type of eval
-  gold = [eval_preproc(x, eval_type) for x in gold]
-  sys1 = [eval_preproc(x, eval_type) for x in sys1]
-  sys2 = [eval_preproc(x, eval_type) for x in sys2]
-
-  sys1_scores = []
-  sys2_scores = []
-  wins = [0, 0, 0]
-  n = len(gold)
-  ids = list(range(n))
-
-  for _ in range(num_samples):
-    # Subsample the gold and system outputs
-    reduced_ids = np.random.choice(ids,int(len(ids)*sample_ratio),replace=True)
-    reduced_gold = [gold[i] for i in reduced_ids]
-    reduced_sys1 = [sys1[i] for i in reduced_ids]
-    reduced_sys2 = [sys2[i] for i in reduced_ids]
-    # Calculate accuracy on the reduced sample and save stats
-    sys1_score = eval_measure(reduced_gold, reduced_sys1, eval_type=eval_type)
-    sys2_score = eval_measure(reduced_gold, reduced_sys2, eval_type=eval_type)
-    if sys1_score > sys2_score:
-      wins[0] += 1
-    elif sys1_score < sys2_score:
-      wins[1] += 1
-    else:
-      wins[2] += 1
-    sys1_scores.append(sys1_score)
-    sys2_scores.append(sys2_score)
+
+  stats1, stats2 = system_stats(gold, [sys1, sys2], eval_type=eval_type, stats_cache=stats_cache, timer=timer)
+  paired_bootstrap_from_stats(stats1, stats2, num_samples=num_samples, sample_ratio=sample_ratio, eval_type=eval_type,
+                              seed=seed, workers=workers, early_stop=early_stop, timer=timer)
+
+def paired_bootstrap_from_stats(stats1, stats2,
+                                num_samples=10000, sample_ratio=0.5,
+                                eval_type='acc',
+                                seed=None, workers=1, early_stop=None, timer=NO_TIMER):
+  ''' Compare two systems with paired bootstrap, given their per-example statistics
+
+  :param stats1: The statistics of system 1 from system_stats
+  :param stats2: The statistics of system 2 from system_stats
+  The other parameters are as for eval_with_paired_bootstrap.
+  '''
+  with timer.phase('sample'):
+    scores = bootstrap_scores([stats1, stats2], num_samples, int(len(stats1)*sample_ratio),
+                              eval_type=eval_type, seed=seed, workers=workers, early_stop=early_stop)
+  if early_stop is not None:
+    print('Used %d of a maximum of %d samples' % (len(scores), num_samples))
+  num_samples = len(scores)
+  sys1_scores, sys2_scores = scores[:,0], scores[:,1]
+  sign = -1 if eval_type in LOWER_IS_BETTER else 1
+  wins = [np.sum(sign*sys1_scores > sign*sys2_scores), np.sum(sign*sys1_scores < sign*sys2_scores)]
+  wins.append(num_samples - wins[0] - wins[1])
 
   # Print win stats
   wins = [x/float(num_samples) for x in wins]
@@ -120,28 +527,154 @@ def eval_with_paired_bootstrap(gold, sys1, sys2,
     print('(sys2 is superior with p value p=%.3f)\n' % (1-wins[1]))
 
   # Print system stats
-  sys1_scores.sort()
-  sys2_scores.sort()
-  print('sys1 mean=%.3f, median=%.3f, 95%% confidence interval=[%.3f, %.3f]' %
-          (np.mean(sys1_scores), np.median(sys1_scores), sys1_scores[int(num_samples * 0.025)], sys1_scores[int(num_samples * 0.975)]))
-  print('sys2 mean=%.3f, median=%.3f, 95%% confidence interval=[%.3f, %.3f]' %
-          (np.mean(sys2_scores), np.median(sys2_scores), sys2_scores[int(num_samples * 0.025)], sys2_scores[int(num_samples * 0.975)]))
+  print_system_stats('sys1', sys1_scores)
+  print_system_stats('sys2', sys2_scores)
 
-if __name__ == "__main__":
-  # execute only if run as a script
+def eval_multi_with_paired_bootstrap(gold, systems,
+                                     num_samples=10000, sample_ratio=0.5,
+                                     eval_type='acc',
+                                     seed=None, workers=1, early_stop=None, stats_cache=None, timer=NO_TIMER):
+  ''' Evaluate multiple systems with paired boostrap
+
+  This compares every pair of systems like eval_with_paired_bootstrap,
+  but draws each bootstrap sample once and scores every system on it, so
+  the cost grows with the number of systems rather than the number of pairs.
+
+  :param gold: The correct labels
+  :param systems: A list of outputs, one for each system
+  :param num_samples: The number of bootstrap samples to take
+  :param sample_ratio: The ratio of samples to take every time
+  :param eval_type: The type of evaluation to do (acc, pearson, bleu, bleu_detok, chrf, ter)
+  :param seed: The random seed, or None to use fresh entropy
+  :param workers: The number of worker processes to split the samples across
+  :param early_stop: If set, a significance level at which to stop sampling early,
+                     with num_samples as the maximum
+  :param stats_cache: A StatsCache to get the per-example statistics from, if any
+  :param timer: A PhaseTimer to add the time of preprocessing, statistics and sampling to
+  '''
+  for sys in systems:
+    assert(len(gold) == len(sys))
+
+  all_stats = system_stats(gold, systems, eval_type=eval_type, stats_cache=stats_cache, timer=timer)
+  multi_paired_bootstrap_from_stats(all_stats, num_samples=num_samples, sample_ratio=sample_ratio, eval_type=eval_type,
+                                    seed=seed, workers=workers, early_stop=early_stop, timer=timer)
+
+def multi_paired_bootstrap_from_stats(all_stats,
+                                      num_samples=10000, sample_ratio=0.5,
+                                      eval_type='acc',
+                                      seed=None, workers=1, early_stop=None, timer=NO_TIMER):
+  ''' Compare multiple systems with paired bootstrap, given their per-example statistics
+
+  :param all_stats: The statistics of each system from system_stats
+  The other parameters are as for eval_multi_with_paired_bootstrap.
+  '''
+  with timer.phase('sample'):
+    scores = bootstrap_scores(all_stats, num_samples, int(len(all_stats[0])*sample_ratio),
+                              eval_type=eval_type, seed=seed, workers=workers, early_stop=early_stop)
+  if early_stop is not None:
+    print('Used %d of a maximum of %d samples' % (len(scores), num_samples))
+  num_samples = len(scores)
+  names = ['sys%d' % (i+1) for i in range(len(all_stats))]
+
+  # Print win stats, where each row is the ratio of samples in which
+  # that system beat the system in each column
+  better = -scores if eval_type in LOWER_IS_BETTER else scores
+  wins = np.array([[np.sum(better[:,i] > better[:,j]) / float(num_samples) for j in range(len(names))]
+                   for i in range(len(names))])
+  print('Win ratio (row system beats column system):')
+  print('\t'.join([''] + names))
+  for i, name in enumerate(names):
+    print('\t'.join([name] + ['-' if i == j else '%.3f' % wins[i,j] for j in range(len(names))]))
+  print('\np value (row system is superior to column system):')
+  print('\t'.join([''] + names))
+  for i, name in enumerate(names):
+    print('\t'.join([name] + ['-' if i == j else '%.3f' % (1-wins[i,j]) for j in range(len(names))]))
+  print()
+
+  # Print system stats
+  for i, name in enumerate(names):
+    print_system_stats(name, scores[:,i])
+
+def print_system_stats(name, scores):
+  ''' Print the mean, median and 95% confidence interval of bootstrap scores '''
+  num_samples = len(scores)
+  scores = np.sort(scores)
+  print('%s mean=%.3f, median=%.3f, 95%% confidence interval=[%.3f, %.3f]' %
+          (name, np.mean(scores), np.median(scores), scores[int(num_samples * 0.025)], scores[int(num_samples * 0.975)]))
+
+def arg_parser():
+  ''' The command line options of this script '''
   import argparse
   parser = argparse.ArgumentParser()
   parser.add_argument('gold', help='File of the correct answers')
-  parser.add_argument('sys1', help='File of the answers for system 1')
-  parser.add_argument('sys2', help='File of the answers for system 2')
-  parser.add_argument('--eval_type', help='The evaluation type (acc/pearson/bleu/bleu_detok)', type=str, default='acc', choices=EVAL_TYPES)
+  parser.add_argument('sys', nargs='*', help='Files of the answers for each system. With more than two systems, every pair is compared on the same samples')
+  parser.add_argument('--eval_type', help='The evaluation type (acc/pearson/bleu/bleu_detok/chrf/ter)', type=str, default='acc', choices=EVAL_TYPES)
   parser.add_argument('--num_samples', help='Number of samples to use', type=int, default=10000)
+  parser.add_argument('--seed', help='Random seed, for reproducible results', type=int, default=None)
+  parser.add_argument('--workers', help='Number of worker processes to use for sampling', type=int, default=1)
+  parser.add_argument('--stats_cache', help='A file to keep per-example statistics in between runs, so that only examples that changed since the last run are evaluated again', type=str, default=None)
+  parser.add_argument('--corpus_cache', help='A directory of tokenized corpora built with corpus_cache.py, which are read instead of the gold and system files for bleu, and added to it if they are not there yet', type=str, default=None)
+  parser.add_argument('--profile', help='Print the time spent loading, calculating statistics, sampling and writing output to stderr', action='store_true')
+  parser.add_argument('--early_stop', help='Stop sampling once all p values are decisively above or below this significance level (e.g. 0.05), using --num_samples as the maximum', type=float, default=None)
+  parser.add_argument('--stats_out', help='Write the per-example statistics to this file instead of comparing the systems, so that the statistics of shards of a larger test set can be combined with --merge_stats', type=str, default=None)
+  parser.add_argument('--merge_stats', help='Compare the systems on the statistics of the shards of a test set, written with --stats_out and given in order instead of the gold and system files', action='store_true')
+  return parser
+
+if __name__ == "__main__":
+  # execute only if run as a script
+  parser = arg_parser()
   args = parser.parse_args()
+  if args.merge_stats and args.stats_out:
+    parser.error('--stats_out can not be used with --merge_stats')
+  if len(args.sys) < 2 and not args.merge_stats:
+    parser.error('at least two system files are required')
+  timer = PhaseTimer(args.profile)
   
-  with open(args.gold, 'r') as f:
-    gold = f.readlines() 
-  with open(args.sys1, 'r') as f:
-    sys1 = f.readlines() 
-  with open(args.sys2, 'r') as f:
-    sys2 = f.readlines() 
-  eval_with_paired_bootstrap(gold, sys1, sys2, eval_type=args.eval_type, num_samples=args.num_samples)
+  stats_cache = None
+  if args.merge_stats:
+    with timer.phase('load'):
+      args.eval_type, sys_names, all_stats = load_shard_stats([args.gold] + args.sys)
+  else:
+    with timer.phase('load'):
+      if args.corpus_cache and args.eval_type == EVAL_TYPE_BLEU:
+        # Cached corpora are already split into the tokens eval_preproc would give
+        from corpus_cache import load_corpus
+        gold = list(load_corpus(args.gold, args.corpus_cache).lines())
+        systems = [list(load_corpus(x, args.corpus_cache).lines()) for x in args.sys]
+      else:
+        with open(args.gold, 'r') as f:
+          gold = f.readlines() 
+        systems = []
+        for sys_file in args.sys:
+          with open(sys_file, 'r') as f:
+            systems.append(f.readlines())
+      stats_cache = StatsCache.load(args.stats_cache, args.eval_type) if args.stats_cache else None
+    sys_names = args.sys
+  if args.stats_out:
+    save_shard_stats(args.stats_out, gold, systems, sys_names, eval_type=args.eval_type, stats_cache=stats_cache, timer=timer)
+    if stats_cache is not None:
+      stats_cache.save(args.stats_cache)
+  else:
+    # Time not spent in the phases inside the evaluation is spent on output
+    with timer.phase('output'):
+      if args.merge_stats and len(all_stats) == 2:
+        paired_bootstrap_from_stats(all_stats[0], all_stats[1], eval_type=args.eval_type, num_samples=args.num_samples,
+                                    seed=args.seed, workers=args.workers, early_stop=args.early_stop, timer=timer)
+      elif len(sys_names) == 2:
+        eval_with_paired_bootstrap(gold, systems[0], systems[1], eval_type=args.eval_type, num_samples=args.num_samples,
+                                   seed=args.seed, workers=args.workers, early_stop=args.early_stop,
+                                   stats_cache=stats_cache, timer=timer)
+      else:
+        for i, sys_file in enumerate(sys_names):
+          print('sys%d: %s' % (i+1, sys_file))
+        print()
+        if args.merge_stats:
+          multi_paired_bootstrap_from_stats(all_stats, eval_type=args.eval_type, num_samples=args.num_samples,
+                                            seed=args.seed, workers=args.workers, early_stop=args.early_stop, timer=timer)
+        else:
+          eval_multi_with_paired_bootstrap(gold, systems, eval_type=args.eval_type, num_samples=args.num_samples,
+                                           seed=args.seed, workers=args.workers, early_stop=args.early_stop,
+                                           stats_cache=stats_cache, timer=timer)
+      if stats_cache is not None:
+        stats_cache.save(args.stats_cache)
+  timer.report()
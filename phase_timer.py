@@ -0,0 +1,76 @@
+'''
+Per-phase timings for the --profile option of the evaluation scripts.
+
+Each script marks the phases of its work (e.g. load, count, score, output)
+and a timer adds up the wall-clock time spent in each of them, which is
+printed to stderr so it doesn't mix with the report on stdout. Phases can
+be nested, e.g. reading lines from a file while they are counted, and the
+time of an inner phase is then only counted for the inner one. A disabled
+timer does nothing, so the scripts aren't slowed down without --profile.
+'''
+
+import contextlib
+import sys
+import time
+
+class PhaseTimer(object):
+  ''' Wall-clock time spent in each named phase '''
+
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+    self.times = {}
+    self.start = time.perf_counter()
+    # The time spent in inner phases of each phase being timed
+    self._inner = []
+
+  def _begin(self):
+    self._inner.append(0.0)
+    return time.perf_counter()
+
+  def _end(self, name, start):
+    elapsed = time.perf_counter() - start
+    self.times[name] = self.times.get(name, 0.0) + elapsed - self._inner.pop()
+    if self._inner:
+      self._inner[-1] += elapsed
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    ''' Time the body of a with statement as part of a phase '''
+    if not self.enabled:
+      yield
+      return
+    start = self._begin()
+    try:
+      yield
+    finally:
+      self._end(name, start)
+
+  def iterate(self, name, iterable):
+    ''' Iterate over iterable, timing the getting of each item as part of a phase '''
+    if not self.enabled:
+      return iterable
+    return self._timed(name, iter(iterable))
+
+  def _timed(self, name, it):
+    while True:
+      start = self._begin()
+      try:
+        x = next(it)
+      except StopIteration:
+        return
+      finally:
+        self._end(name, start)
+      yield x
+
+  def report(self, out=sys.stderr):
+    ''' Print the time of each phase in the order they started, and the total time '''
+    if not self.enabled:
+      return
+    total = time.perf_counter() - self.start
+    print('--- Profile ---', file=out)
+    for name, seconds in self.times.items():
+      print('%s\t%.3fs\t%.1f%%' % (name, seconds, 100. * seconds / total if total else 0.), file=out)
+    print('total\t%.3fs' % total, file=out)
+
+# A timer that does nothing, for functions called without profiling
+NO_TIMER = PhaseTimer(enabled=False)
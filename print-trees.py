@@ -2,19 +2,148 @@
 
 '''A program to display parse trees (in Penn treebank format)
 with the NLTK.
+
+With --out_dir, the trees are instead laid out and written to one SVG (or
+PNG) file per line, without NLTK or a display:
+  print-trees.py --out_dir trees --workers 8 < trees.txt
 '''
 
 import sys
+import argparse
+import functools
+import os
+import re
+from xml.sax.saxutils import escape
+
+from chunk_pool import map_chunks
+
+# The number of lines rendered at once by each worker process
+CHUNK_LINES = 1000
+# The number of laid out subtrees to keep for reuse in each process
+LAYOUT_CACHE_SIZE = 100000
+
+# Sizes in the rendered images, in pixels
+FONT_SIZE = 12
+CHAR_WIDTH = 7.5
+NODE_GAP = 12
+LEVEL_HEIGHT = 40
+MARGIN = 10
+
+# Opening brackets with their labels, closing brackets, and leaves
+TOKEN_RE = re.compile(r'\(\s*[^\s()]*|\)|[^\s()]+')
+
+def parse_tree(line):
+  ''' Parse a tree in Penn treebank format into nested tuples
+
+  :param line: the tree
+  :returns: a (label, children) tuple, where leaves are strings
+  '''
+  stack = [('', [])]
+  for token in TOKEN_RE.findall(line):
+    if token[0] == '(':
+      stack.append((token[1:].lstrip(), []))
+    elif token == ')':
+      if len(stack) == 1:
+        raise ValueError('Unbalanced brackets in tree: %s' % line.strip())
+      label, children = stack.pop()
+      stack[-1][1].append((label, tuple(children)))
+    else:
+      stack[-1][1].append(token)
+  if len(stack) != 1 or len(stack[0][1]) != 1 or isinstance(stack[0][1][0], str):
+    raise ValueError('Not a single bracketed tree: %s' % line.strip())
+  return stack[0][1][0]
+
+def text_width(text):
+  return max(1, len(text)) * CHAR_WIDTH
 
-try:
-  from nltk.tree import Tree
-except ImportError:
-  print('Error: cannot import the NLTK!')
-  print('You need to install the NLTK. Please visit http://nltk.org/install.html for details.')
-  print("On Ubuntu, the installation can be done via 'sudo apt-get install python-nltk'")
-  sys.exit()
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def layout(tree):
+  ''' Lay out a tree, or get the layout of an identical tree done before
+
+  :param tree: a tree from parse_tree
+  :returns: the width and height of the tree, and its SVG elements relative
+            to its top left corner, with its label centered at the top
+  '''
+  if isinstance(tree, str):
+    width = text_width(tree)
+    return width, LEVEL_HEIGHT, '<text x="%g" y="%g">%s</text>' % (width/2, FONT_SIZE, escape(tree))
+  label, children = tree
+  child_layouts = [layout(x) for x in children]
+  children_width = sum(x[0] for x in child_layouts) + NODE_GAP * max(0, len(children)-1)
+  width = max(text_width(label), children_width)
+  height = LEVEL_HEIGHT + max([x[1] for x in child_layouts] or [0])
+  elements = ['<text x="%g" y="%g">%s</text>' % (width/2, FONT_SIZE, escape(label))]
+  x = (width - children_width) / 2
+  for child_width, _, child_elements in child_layouts:
+    elements.append('<line x1="%g" y1="%g" x2="%g" y2="%g" stroke="black"/>' % (width/2, FONT_SIZE+4, x+child_width/2, LEVEL_HEIGHT))
+    elements.append('<g transform="translate(%g,%d)">%s</g>' % (x, LEVEL_HEIGHT, child_elements))
+    x += child_width + NODE_GAP
+  return width, height, ''.join(elements)
+
+def render_svg(tree):
+  ''' Render a tree from parse_tree as an SVG document '''
+  width, height, elements = layout(tree)
+  return ('<svg xmlns="http://www.w3.org/2000/svg" width="%g" height="%g" font-family="sans-serif" font-size="%d">'
+          '<g text-anchor="middle" transform="translate(%d,%d)">%s</g></svg>\n' %
+          (width + 2*MARGIN, height + 2*MARGIN - LEVEL_HEIGHT + FONT_SIZE + 4, FONT_SIZE, MARGIN, MARGIN, elements))
+
+def render_chunk(chunk):
+  ''' Render numbered lines to files, returning the number of trees rendered '''
+  out_dir, fmt, lines = chunk
+  for i, line in lines:
+    svg = render_svg(parse_tree(line))
+    fname = os.path.join(out_dir, 'tree-%06d.%s' % (i, fmt))
+    if fmt == 'svg':
+      with open(fname, 'w') as f:
+        f.write(svg)
+    else:
+      import cairosvg
+      cairosvg.svg2png(bytestring=svg.encode('utf-8'), write_to=fname)
+  return len(lines)
+
+def read_chunks(lines, out_dir, fmt, chunk_lines=CHUNK_LINES):
+  # Non-empty lines numbered from 1, in chunks. The lines are parsed in the
+  # worker that renders them.
+  chunk = []
+  for i, line in enumerate(lines, 1):
+    if line.strip():
+      chunk.append((i, line))
+    if len(chunk) == chunk_lines:
+      yield out_dir, fmt, chunk
+      chunk = []
+  if chunk:
+    yield out_dir, fmt, chunk
+
+def render_all(lines, out_dir, fmt='svg', workers=1):
+  ''' Render every tree to a file in out_dir, returning the number of trees rendered '''
+  os.makedirs(out_dir, exist_ok=True)
+  return sum(map_chunks(render_chunk, read_chunks(lines, out_dir, fmt), workers))
 
 def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--out_dir', type=str, default=None, help='Write the trees to files in this directory instead of displaying them, named tree-NNNNNN by line number')
+  parser.add_argument('--format', type=str, default='svg', choices=['svg', 'png'], help='The format of the files to write (png needs cairosvg)')
+  parser.add_argument('--workers', type=int, default=1, help='How many processes to render the trees with')
+  args = parser.parse_args()
+
+  if args.out_dir != None:
+    if args.format == 'png':
+      try:
+        import cairosvg
+      except ImportError:
+        print('Error: cannot import cairosvg, which is needed to write PNG files!')
+        print('You can install it with "pip install cairosvg", or write SVG files instead.')
+        sys.exit()
+    render_all(sys.stdin, args.out_dir, args.format, args.workers)
+    return
+
+  try:
+    from nltk.tree import Tree
+  except ImportError:
+    print('Error: cannot import the NLTK!')
+    print('You need to install the NLTK. Please visit http://nltk.org/install.html for details.')
+    print("On Ubuntu, the installation can be done via 'sudo apt-get install python-nltk'")
+    sys.exit()
   for line in sys.stdin:
     t = Tree.fromstring(line)
     t.draw()
@@ -1,107 +1,260 @@
 #!/usr/bin/env python
 
 '''
-A program to calculate syntactic complexity of parse trees. (Relies on NLTK)
+A program to calculate syntactic complexity of parse trees.
 This is an implementation of some of the methods in:
 
 Syntactic complexity measures for detecting Mild Cognitive Impairment
 Brian Roark, Margaret Mitchell and Kristy Hollingshead
 Proc BioNLP 2007.
+
+Trees are read one per line in Penn treebank format, and parsed into flat
+arrays of nodes. The measures are then calculated for many trees at once,
+one tree depth at a time, without building a tree object for each sentence.
+
+Usage:
+  syntactic-complexity.py [--workers N] [--per_sentence text|tsv|json] [--profile] < trees.txt
 '''
 
+import argparse
+import json
 import sys
 
-try:
-  from nltk.tree import Tree
-  from nltk.draw.tree import TreeWidget
-  from nltk.draw.util import (CanvasFrame, CanvasWidget, BoxWidget,
-                              TextWidget, ParenWidget, OvalWidget)
-except ImportError:
-  print 'Error: cannot import the NLTK!'
-  print 'You need to install the NLTK. Please visit http://nltk.org/install.html for details.'
-  print "On Ubuntu, the installation can be done via 'sudo apt-get install python-nltk'"
-  sys.exit()
-
-def calc_words(t):
-    if type(t) == str:
-        return 1
-    else:
-        val = 0
-        for child in t:
-            val += calc_words(child)
-        return val
-
-def calc_nodes(t):
-    if type(t) == str:
-        return 0
-    else:
-        val = 0
-        for child in t:
-            val += calc_nodes(child)+1
-        return val
-
-def calc_yngve(t, par):
-    if type(t) == str:
-        return par
-    else:
-        val = 0
-        for i, child in enumerate(reversed(t)):
-            val += calc_yngve(child, par+i)
-        return val
-
-def is_sent(val):
-    return len(val) > 0 and val[0] == "S"
-
-def calc_frazier(t, par, par_lab):
-    # print t
-    # print par
-    if type(t) == str:
-        # print par-1
-        return par-1
+import numpy as np
+
+from chunk_pool import map_chunks
+from phase_timer import PhaseTimer
+
+# The number of trees whose measures are calculated at once
+CHUNK_LINES = 10000
+
+# The kinds of tokens in the text of the trees
+OPEN, CLOSE, NEWLINE, LEAF = 1, 2, 3, 4
+
+class TreeArrays(object):
+    ''' The nodes of many trees in flat arrays, in pre-order
+
+    Each node has the index of its parent (-1 for roots), its position among
+    its parent's children, its number of children, its depth, the index of
+    the tree it belongs to, and the byte offsets of its label (the word for
+    leaves) in the text. The trees are tokenized and their brackets matched
+    with array operations on the bytes of the text, so no Python code is run
+    for each node.
+    '''
+
+    def __init__(self, lines):
+        ''' :param lines: trees in Penn treebank format, one per line, as bytes '''
+        lines = [line.strip() for line in lines]
+        self.text = b'\n'.join(lines) + b'\n'
+        buf = np.frombuffer(self.text, dtype=np.uint8)
+        is_space = (buf == ord(' ')) | ((buf >= ord('\t')) & (buf <= ord('\r')))
+        is_open = buf == ord('(')
+        is_close = buf == ord(')')
+        is_word = ~(is_space | is_open | is_close)
+        word_starts = np.nonzero(is_word & ~np.concatenate([[False], is_word[:-1]]))[0]
+        word_ends = np.nonzero(is_word & ~np.concatenate([is_word[1:], [False]]))[0] + 1
+        # A word right after an opening bracket is its label, and any other word is a leaf
+        non_space = np.nonzero(~is_space)[0]
+        before = non_space[np.maximum(np.searchsorted(non_space, word_starts) - 1, 0)]
+        is_label = (word_starts > 0) & is_open[before]
+        kinds = np.zeros(len(buf), dtype=np.int8)
+        kinds[is_open] = OPEN
+        kinds[is_close] = CLOSE
+        kinds[buf == ord('\n')] = NEWLINE
+        kinds[word_starts[~is_label]] = LEAF
+        token_pos = np.nonzero(kinds)[0]
+        token_kinds = kinds[token_pos]
+        is_node = (token_kinds == OPEN) | (token_kinds == LEAF)
+        is_newline = token_kinds == NEWLINE
+        depth_after = np.cumsum((token_kinds == OPEN).astype(np.int64) - (token_kinds == CLOSE))
+        line = np.cumsum(is_newline) - is_newline
+        token_depth = depth_after - (token_kinds == OPEN)
+        # Every line must have balanced brackets and a single bracketed root
+        roots = is_node & (token_depth == 0)
+        bad = (depth_after < 0) | (is_newline & (depth_after != 0)) | (roots & (token_kinds != OPEN))
+        num_roots = np.bincount(line[roots], minlength=len(lines))
+        bad_lines = np.union1d(line[bad], np.nonzero(num_roots != 1)[0])
+        if len(bad_lines):
+            raise ValueError('Not a single bracketed tree: %s' % lines[bad_lines[0]].decode('utf-8', 'replace'))
+
+        node_tokens = np.nonzero(is_node)[0]
+        num_nodes = len(node_tokens)
+        self.num_trees = len(lines)
+        self.depth = token_depth[node_tokens]
+        self.tree = line[node_tokens]
+        self.is_leaf = token_kinds[node_tokens] == LEAF
+        # Label offsets, which are empty for brackets without a label
+        node_pos = token_pos[node_tokens]
+        self.label_start = node_pos.copy()
+        self.label_end = node_pos.copy()
+        self.label_end[self.is_leaf] = word_ends[~is_label]
+        labeled = np.searchsorted(node_pos, before[is_label])
+        self.label_start[labeled] = word_starts[is_label]
+        self.label_end[labeled] = word_ends[is_label]
+        self.label_start[~self.is_leaf & (self.label_start == node_pos)] += 1
+        self.label_end[~self.is_leaf & (self.label_end == node_pos)] += 1
+        # The parent of a node is the last bracket before it one level up
+        node_ids = np.cumsum(is_node) - 1
+        self.parent = np.full(num_nodes, -1, dtype=np.int64)
+        by_depth = self.levels()
+        for level, parents in zip(by_depth[1:], by_depth):
+            candidates = node_tokens[parents[~self.is_leaf[parents]]]
+            parent_tokens = candidates[np.searchsorted(candidates, node_tokens[level]) - 1]
+            self.parent[level] = node_ids[parent_tokens]
+        self.num_children = np.bincount(self.parent[self.parent >= 0], minlength=num_nodes)
+        # Siblings are in pre-order, so sorting by parent gives each one's position
+        order = np.argsort(self.parent, kind='stable')
+        group_starts = np.searchsorted(self.parent[order], self.parent[order])
+        self.position = np.empty(num_nodes, dtype=np.int64)
+        self.position[order] = np.arange(num_nodes) - group_starts
+        self.position[self.parent < 0] = 0
+
+    def levels(self):
+        ''' The indices of the nodes at each depth, in pre-order '''
+        order = np.argsort(self.depth, kind='stable')
+        starts = np.searchsorted(self.depth[order], np.arange(self.depth.max() + 2 if len(order) else 1))
+        return [order[s:e] for s, e in zip(starts, starts[1:])]
+
+    @property
+    def labels(self):
+        ''' The labels of all the nodes as strings '''
+        return [self.text[s:e].decode('utf-8') for s, e in zip(self.label_start.tolist(), self.label_end.tolist())]
+
+    def label_is(self, labels):
+        ''' Find the bracket nodes with any of the given labels '''
+        buf = np.frombuffer(self.text, dtype=np.uint8)
+        lens = self.label_end - self.label_start
+        ret = np.zeros(len(lens), dtype=bool)
+        for label in labels:
+            label = np.frombuffer(label.encode('utf-8'), dtype=np.uint8)
+            match = lens == len(label)
+            for i, c in enumerate(label):
+                match &= buf[np.minimum(self.label_start + i, len(buf) - 1)] == c
+            ret |= match
+        return ret & ~self.is_leaf
+
+    def label_starts_with(self, char):
+        ''' Find the bracket nodes whose label starts with a character '''
+        buf = np.frombuffer(self.text, dtype=np.uint8)
+        return ((self.label_end > self.label_start) & (buf[np.minimum(self.label_start, len(buf) - 1)] == ord(char))
+                & ~self.is_leaf)
+
+def calc_measures(trees):
+    ''' Calculate the measures of every tree
+
+    The Yngve score of a word is the sum over its ancestors of the number of
+    younger siblings, and the Frazier score adds 1 for each ancestor that
+    is the leftmost child of its parent (1.5 for sentence nodes that are not
+    directly under another sentence node) until a node that is not leftmost.
+    Both are found top-down, one depth at a time, for all trees at once.
+
+    :param trees: the TreeArrays of the trees
+    :returns: arrays with the number of words, nodes (including words but
+              not the root), and the total Yngve and Frazier scores of each tree
+    '''
+    parent, position, num_children = trees.parent, trees.position, trees.num_children
+    tree, is_leaf = trees.tree, trees.is_leaf
+    # Sentence labels start with S, and root labels don't count in Frazier scores
+    sent = trees.label_starts_with("S")
+    root_label = trees.label_is(["", "ROOT", "TOP"])
+    # Whether the parent of each node is a sentence, which is not the case for roots
+    parent_sent = np.where(parent >= 0, sent[np.maximum(parent, 0)], False)
+    yngve = np.zeros(len(parent))
+    frazier = np.zeros(len(parent))
+    for nodes in trees.levels()[1:]:
+        par = parent[nodes]
+        yngve[nodes] = yngve[par] + num_children[par] - 1 - position[nodes]
+        first = np.where(sent[par], np.where(parent_sent[par], 0, frazier[par] + 1.5),
+                         np.where(root_label[par], 0, frazier[par] + 1))
+        frazier[nodes] = np.where(position[nodes] == 0, first, 0)
+    num_trees = trees.num_trees
+    words = np.bincount(tree[is_leaf], minlength=num_trees)
+    nodes = np.bincount(tree, minlength=num_trees) - 1
+    yngve = np.bincount(tree[is_leaf], weights=yngve[is_leaf], minlength=num_trees)
+    frazier = np.bincount(tree[is_leaf], weights=frazier[is_leaf] - 1, minlength=num_trees)
+    return words, nodes, yngve, frazier
+
+def read_chunks(lines, chunk_lines=CHUNK_LINES):
+    ''' Split non-empty lines into lists of at most chunk_lines lines, as bytes '''
+    chunk = []
+    for line in lines:
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        if line.strip() == b"":
+            continue
+        chunk.append(line)
+        if len(chunk) == chunk_lines:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def chunk_measures(lines):
+    ''' Calculate the measures of the trees on each of a list of lines '''
+    measures = calc_measures(TreeArrays(lines))
+    empty = np.nonzero(measures[0] == 0)[0]
+    if len(empty):
+        raise ValueError('Tree without words: %s' % lines[empty[0]].strip().decode('utf-8', 'replace'))
+    return measures
+
+def format_sentences(first, words, nodes, yngve, frazier, fmt):
+    ''' Format the per-sentence averages of a chunk, numbering sentences from first '''
+    keys = ("sentence", "words", "yngve", "frazier", "nodes")
+    rows = zip(range(first, first + len(words)), words, yngve, frazier, nodes)
+    if fmt == "text":
+        return "".join("Sentence=%d\twords=%d\tyngve=%f\tfrazier=%f\tnodes=%f\n" % x for x in rows)
+    elif fmt == "tsv":
+        return "".join("%d\t%d\t%r\t%r\t%r\n" % x for x in rows)
     else:
-        val = 0
-        for i, child in enumerate(t):
-            # For all but the leftmost child, zero
-            score = 0
-            if i == 0:
-                my_lab = t.node
-                # If it's a sentence, and not duplicated, add 1.5
-                if is_sent(my_lab):
-                    score = (0 if is_sent(par_lab) else par+1.5)
-                # Otherwise, unless it's a root node, add one
-                elif my_lab != "" and my_lab != "ROOT" and my_lab != "TOP":
-                    score = par + 1
-            val += calc_frazier(child, score, my_lab)
-        return val
+        return "".join(json.dumps(dict(zip(keys, x))) + "\n" for x in rows)
 
 def main():
-    sents = 0
-    words_tot = 0
-    yngve_tot = 0
-    frazier_tot = 0
-    nodes_tot = 0
-    for line in sys.stdin:
-        if line.strip() == "":
-            continue
-        t = Tree.parse(line)
-        words = calc_words(t)
-        words_tot += words
-        sents += 1
-        yngve = calc_yngve(t, 0)
-        yngve_avg = float(yngve)/words
-        yngve_tot += yngve_avg
-        nodes = calc_nodes(t)
-        nodes_avg = float(nodes)/words
-        nodes_tot += nodes_avg
-        frazier = calc_frazier(t, 0, "")
-        frazier_avg = float(frazier)/words
-        frazier_tot += frazier_avg
-        # print "Sentence=%d\twords=%d\tyngve=%f\tfrazier=%f\tnodes=%f" % (sents, words, yngve_avg, frazier_avg, nodes_avg)
-    yngve_avg = float(yngve_tot)/sents
-    frazier_avg = float(frazier_tot)/sents
-    nodes_avg = float(nodes_tot)/sents
-    words_avg = float(words_tot)/sents
-    print "Total\tsents=%d\twords=%f\tyngve=%f\tfrazier=%f\tnodes=%f" % (sents, words_avg, yngve_avg, frazier_avg, nodes_avg)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=1, help='How many processes to calculate the measures with')
+    parser.add_argument('--per_sentence', choices=['text', 'tsv', 'json'], default=None,
+                        help='Also print the words and average Yngve, Frazier and node scores of every sentence, as text, TSV with a header, or JSON lines. The totals are then printed last in the same format, with the number of sentences in the sentence column of the last TSV row')
+    parser.add_argument('--profile', action='store_true', help='Print the time spent reading trees, calculating measures and writing output to stderr')
+    args = parser.parse_args()
+    timer = PhaseTimer(args.profile)
+    out = sys.stdout
+    # Reading the chunks happens while waiting for the measures of earlier
+    # ones, and anything else is output
+    chunks = timer.iterate('load', read_chunks(sys.stdin.buffer))
+    measures = timer.iterate('measure', map_chunks(chunk_measures, chunks, args.workers))
+    with timer.phase('output'):
+        if args.per_sentence == 'tsv':
+            out.write("sentence\twords\tyngve\tfrazier\tnodes\n")
+        sents = 0
+        words_tot = 0
+        yngve_tot = 0
+        frazier_tot = 0
+        nodes_tot = 0
+        for words, nodes, yngve, frazier in measures:
+            yngve_avg, nodes_avg, frazier_avg = [(x / words).tolist() for x in (yngve, nodes, frazier)]
+            if args.per_sentence:
+                out.write(format_sentences(sents + 1, words.tolist(), nodes_avg, yngve_avg, frazier_avg, args.per_sentence))
+            words_tot += int(words.sum())
+            sents += len(words)
+            # add the averages in order, to get the same totals as adding one sentence at a time
+            for x in yngve_avg:
+                yngve_tot += x
+            for x in nodes_avg:
+                nodes_tot += x
+            for x in frazier_avg:
+                frazier_tot += x
+        yngve_avg = float(yngve_tot)/sents
+        frazier_avg = float(frazier_tot)/sents
+        nodes_avg = float(nodes_tot)/sents
+        words_avg = float(words_tot)/sents
+        # The totals are in the same format as the sentences, if they are printed
+        if args.per_sentence == 'json':
+            print(json.dumps({"total": True, "sents": sents, "words": words_avg, "yngve": yngve_avg, "frazier": frazier_avg, "nodes": nodes_avg}))
+        elif args.per_sentence == 'tsv':
+            # the sentence column of the last row has the number of sentences
+            print("%d\t%r\t%r\t%r\t%r" % (sents, words_avg, yngve_avg, frazier_avg, nodes_avg))
+        else:
+            print("Total\tsents=%d\twords=%f\tyngve=%f\tfrazier=%f\tnodes=%f" % (sents, words_avg, yngve_avg, frazier_avg, nodes_avg))
+    timer.report()
 
 if __name__ == '__main__':
   main()
@@ -1,7 +1,12 @@
 from __future__ import annotations
 
 import argparse
+import itertools
 import random
+from collections import Counter
+from typing import Iterable, Iterator
+
+from phase_timer import PhaseTimer
 
 """
 What's this?
@@ -37,17 +42,125 @@ any effect of ordering on the decisions, and also identical hypotheses will
 be combined so the rater does not need to grade the same sentence twice.
 This order is saved in the output.ids file, and can be restored after the
 manual evaluation is finished by syseval-report.py.
+
+The lines to evaluate are chosen from the source alone, using the
+histogram of source lengths, and then all the files are read together line
+by line, keeping only the chosen lines, so memory use is bounded by the
+number of lines written rather than the number of systems times the size of
+the test set. With --seed, the same lines and orders are chosen every time,
+and with --strata the lines are sampled evenly from buckets of similar
+source lengths. With --corpus_cache, the source lengths are read from a
+tokenized corpus cache built by corpus_cache.py instead of the source file.
 """
 
-def load_lines(fname: str) -> list[str]:
+# The size of the buffers used when writing the output files
+WRITE_BUFFER_SIZE = 1 << 20
+
+def read_lines(fname: str) -> Iterator[str]:
     with open(fname, 'r') as fin:
-        return [x.strip() for x in fin]
+        for x in fin:
+            yield x.strip()
 
-def print_line(src: str, ref: str | None, hyp: str, rating: str, file):
+def format_line(src: str, ref: str | None, hyp: str, rating: str) -> str:
     if ref:
-        print(f'{src}\t{ref}\t{hyp}\t{rating}', file=file)
+        return f'{src}\t{ref}\t{hyp}\t{rating}\n'
     else:
-        print(f'{src}\t{hyp}\t{rating}', file=file)
+        return f'{src}\t{hyp}\t{rating}\n'
+
+def source_lengths(src_fname: str, corpus_cache: str | None = None) -> Iterable[int]:
+    """Get the length in tokens of every source line, from the corpus cache if given."""
+    if corpus_cache is not None:
+        # only imported when used, as it needs NumPy
+        from corpus_cache import load_corpus
+        return load_corpus(src_fname, corpus_cache).lengths().tolist()
+    return (len(x.split()) for x in read_lines(src_fname))
+
+def length_histogram(src_fname: str, corpus_cache: str | None = None) -> Counter[int]:
+    """Count the source lines of each length in tokens."""
+    return Counter(source_lengths(src_fname, corpus_cache))
+
+def length_buckets(hist: Counter[int], strata: int) -> dict[int, int]:
+    """Divide the lengths into at most `strata` buckets with similar numbers of lines.
+
+    Returns the bucket of each length. All lines of the same length are in
+    the same bucket, so there are fewer buckets if many lines share a length.
+    """
+    total = sum(hist.values())
+    buckets = {}
+    num_shorter = 0
+    for length in sorted(hist):
+        buckets[length] = min(strata - 1, num_shorter * strata // total)
+        num_shorter += hist[length]
+    return buckets
+
+def allocate(counts: list[int], lines: int) -> list[int]:
+    """Divide `lines` between groups in proportion to their sizes, by largest remainder."""
+    total = sum(counts)
+    lines = min(lines, total)
+    quotas = [x * lines // total for x in counts]
+    remainders = sorted(range(len(counts)), key=lambda i: (-(counts[i] * lines % total), i))
+    for i in remainders[:lines - sum(quotas)]:
+        quotas[i] += 1
+    return quotas
+
+def sample_ids(src_fname: str, min_len: int, max_len: int, lines: int | None,
+               strata: int = 1, rng: random.Random | None = None,
+               corpus_cache: str | None = None) -> list[int]:
+    """Choose the lines to evaluate from the source.
+
+    The source is read once to get the histogram of lengths, which is enough
+    to choose the lines within the length limits by their rank in each length
+    bucket, and once more to find those lines. Only the chosen IDs are held in
+    memory, and they are returned in random order.
+    """
+    rng = rng or random.Random()
+    hist = length_histogram(src_fname, corpus_cache)
+    valid = Counter({k: v for k, v in hist.items() if min_len <= k <= max_len})
+    if not valid:
+        return []
+    buckets = length_buckets(valid, strata)
+    counts = [0] * strata
+    for length, count in valid.items():
+        counts[buckets[length]] += count
+    quotas = counts if lines is None else allocate(counts, lines)
+    # the ranks of the chosen lines among the lines of their bucket
+    ranks = [set(rng.sample(range(c), q)) if q < c else None for c, q in zip(counts, quotas)]
+    chosen = []
+    seen = [0] * strata
+    for i, length in enumerate(source_lengths(src_fname, corpus_cache)):
+        bucket = buckets.get(length)
+        if bucket is not None:
+            if ranks[bucket] is None or seen[bucket] in ranks[bucket]:
+                chosen.append(i)
+            seen[bucket] += 1
+    rng.shuffle(chosen)
+    return chosen
+
+def read_chosen(fnames: list[str], ids: list[int]) -> tuple[dict[int, list[str]], list[int]]:
+    """Read the files in lockstep, keeping only the lines with the given IDs.
+
+    Returns the lines of each file for each kept ID, and the number of lines
+    in each file.
+    """
+    wanted = set(ids)
+    chosen = {}
+    num_full = 0
+    extra = [0] * len(fnames)
+    files = [open(x, 'r') for x in fnames]
+    try:
+        for i, lines in enumerate(itertools.zip_longest(*files)):
+            if None in lines:
+                # some files are longer than others, so just count the rest
+                for j, x in enumerate(lines):
+                    extra[j] += x is not None
+                continue
+            num_full += 1
+            if i in wanted:
+                chosen[i] = [x.strip() for x in lines]
+    finally:
+        for f in files:
+            f.close()
+    return chosen, [num_full + x for x in extra]
 
 def main():
 
@@ -58,46 +171,55 @@ def main():
     p.add_argument("--src", help="the source file")
     p.add_argument("--ref", required=False, help="the reference file")
     p.add_argument("--hyps", nargs="+", help="the hypotheses")
-    p.add_argument("--min", default=0, help="the minimum sentence length")
-    p.add_argument("--max", default=10000, help="the maximum sentence length")
-    p.add_argument("--lines", default=None, help="the number of lines to print out")
+    p.add_argument("--min", default=0, type=int, help="the minimum sentence length, in source tokens")
+    p.add_argument("--max", default=10000, type=int, help="the maximum sentence length, in source tokens")
+    p.add_argument("--lines", default=None, type=int, help="the number of lines to print out")
+    p.add_argument("--seed", default=None, type=int, help="the random seed, to choose the same lines and orders every time")
+    p.add_argument("--strata", default=1, type=int, help="the number of source length buckets to sample lines evenly from")
+    p.add_argument("--corpus_cache", default=None, help="a directory of tokenized corpora built with corpus_cache.py, to read the source lengths from")
+    p.add_argument("--profile", action="store_true", help="print the time spent sampling, reading and writing lines to stderr")
     p.add_argument("--ids_out", help="the file to write IDs to")
     p.add_argument("--tsv_out", help="the file to write the tsv to")
     args = p.parse_args()
-
-    src_lines = load_lines(args.src)
-    ref_lines = load_lines(args.ref) if args.ref else None
-    hyps_lines = [load_lines(x) for x in args.hyps]
-
-    if not all([len(x) == len(src_lines) for x in hyps_lines]):
+    if args.strata < 1:
+        p.error('--strata must be at least 1')
+
+    timer = PhaseTimer(args.profile)
+    rng = random.Random(args.seed)
+    with timer.phase('sample'):
+        valid_ids = sample_ids(args.src, args.min, args.max, args.lines, args.strata, rng, args.corpus_cache)
+    fnames = [args.src] + ([args.ref] if args.ref else []) + args.hyps
+    with timer.phase('load'):
+        chosen, lens = read_chosen(fnames, valid_ids)
+    src_len = lens[0]
+    ref_lens = lens[1:2] if args.ref else []
+    hyp_lens = lens[1+len(ref_lens):]
+
+    if not all([x == src_len for x in hyp_lens]):
         raise ValueError(
-            f'src and hyp lines don\'t match ({len(src_lines)} != {[len(x) for x in hyps_lines]})')
-    if ref_lines and len(ref_lines) != len(src_lines):
-        raise ValueError(f'src and ref lines don\'t match ({len(src_lines)} != {len(ref_lines)})')
-
-    valid_ids = []
-    for i, src_line in enumerate(src_lines):
-        src_len = len(' '.split(src_line))
-        if src_len >= args.min and src_len <= args.max:
-            valid_ids.append(i)
-    random.shuffle(valid_ids)
-    if args.lines and args.lines < valid_ids:
-        valid_ids = valid_ids[:args.lines]
-
-    with open(args.tsv_out, 'w') as tsv_out, open(args.ids_out, 'w') as ids_out:
-        print_line('Source', 'Reference' if args.ref else None, 'Translation', 'Rating', tsv_out)
-        for i in valid_ids:
-            hyps_line = [x[i] for x in hyps_lines]
-            dedup_line = list(set(hyps_line))
-            random.shuffle(dedup_line)
-            dedup_map = {v: str(i) for i, v in enumerate(dedup_line)}
-            hyps_ids = [dedup_map[x] for x in hyps_line]
-            ref_line = ref_lines[i] if ref_lines else None
-            print('\t'.join(hyps_ids), file=ids_out)
-            print_line(src_lines[i], ref_line, dedup_line[0], 'XXX', tsv_out)
-            for x in dedup_line[1:]:
-                print_line('', ' ' if ref_lines else None, x, 'XXX', tsv_out)
-            print('', file=tsv_out)
+            f'src and hyp lines don\'t match ({src_len} != {hyp_lens})')
+    if ref_lens and ref_lens[0] != src_len:
+        raise ValueError(f'src and ref lines don\'t match ({src_len} != {ref_lens[0]})')
+
+    with timer.phase('output'):
+        with open(args.tsv_out, 'w', buffering=WRITE_BUFFER_SIZE) as tsv_out, \
+                open(args.ids_out, 'w', buffering=WRITE_BUFFER_SIZE) as ids_out:
+            tsv_out.write(format_line('Source', 'Reference' if args.ref else None, 'Translation', 'Rating'))
+            for i in valid_ids:
+                src_line, *hyps_line = chosen.pop(i)
+                ref_line = hyps_line.pop(0) if args.ref else None
+                # dict keys are unique and keep their order, unlike a set
+                dedup_line = list(dict.fromkeys(hyps_line))
+                rng.shuffle(dedup_line)
+                dedup_map = {v: str(i) for i, v in enumerate(dedup_line)}
+                hyps_ids = [dedup_map[x] for x in hyps_line]
+                ids_out.write('\t'.join(hyps_ids) + '\n')
+                rows = [format_line(src_line, ref_line, dedup_line[0], 'XXX')]
+                for x in dedup_line[1:]:
+                    rows.append(format_line('', ' ' if args.ref else None, x, 'XXX'))
+                rows.append('\n')
+                tsv_out.write(''.join(rows))
+    timer.report()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
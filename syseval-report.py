@@ -1,62 +1,157 @@
-import sys
-
-import numpy as np
-
 """
 What's this?
 ------------
 
 Given a TSV-format manual evaluation file created by syseval-combine.py,
 this script restores the orders of the systems and calculates an average
-score for each system.
+score for each system, with bootstrap confidence intervals and pairwise
+significance between the systems.
 
 Usage and Data Format
 ---------------------
 
-syseval-report.py finished-eval.tsv output.ids
+syseval-report.py finished-eval.tsv output.ids [finished-eval-2.tsv output-2.ids ...]
 
 Where finished-eval is a completely filled in manual evaluation TSV file
-and output.ids is the ID file output by syseval-combine.pl
+and output.ids is the ID file output by syseval-combine.pl. Several pairs of
+evaluation and ID files, e.g. from different annotators, can be given at
+once, and their scores are combined.
 """
 
-with open(sys.argv[1], 'r') as tsv_in, open(sys.argv[2], 'r') as ids_in:
+from __future__ import annotations
+
+import argparse
+import sys
+from array import array
+from typing import Iterator, TextIO
+
+import numpy as np
+
+from phase_timer import PhaseTimer
+
+# The maximum number of sampled scores to hold in memory at once, counting
+# every system's score of each sampled item
+MAX_CHUNK_INDICES = 2**22
+
+def read_blocks(tsv_in: TextIO) -> Iterator[tuple[list[str], list[str], list[str]]]:
+    """Read the blocks of a TSV file from syseval-combine.py one at a time.
+
+    Yields the source (and reference, if any), and the hypotheses and scores
+    of each block.
+    """
     header = next(tsv_in).split('\t')
     if header[0] != 'Source':
         raise ValueError(f'Illegal header {header}')
     has_reference = 1 if header[1] == 'Reference' else 0
-    parsed_tsv = []
-    curr_data = {}
+    head, hyps, scores = None, [], []
     for line in tsv_in:
         cols = [x.strip() for x in line.split('\t')]
         if len(cols) > 1:
-            if 'src' not in curr_data:
-                curr_data['src'] = cols[0]
-                if has_reference:
-                    curr_data['ref'] = cols[1]
-                curr_data['hyps'] = []
-                curr_data['scores'] = []
-            curr_data['hyps'].append(cols[1+has_reference])
-            curr_data['scores'].append(cols[2+has_reference])
-        else:
-            parsed_tsv.append(curr_data)
-            curr_data = {}
+            if head is None:
+                head = cols[:1+has_reference]
+            hyps.append(cols[1+has_reference])
+            scores.append(cols[2+has_reference])
+        elif head is not None:
+            yield head, hyps, scores
+            head, hyps, scores = None, [], []
+    if head is not None:
+        yield head, hyps, scores
+
+def parse_score(score: str) -> float:
+    try:
+        return float(score)
+    except ValueError:
+        print(f'WARNING: illegal score {score}', file=sys.stderr)
+        return np.nan
+
+def read_scores(tsv_fname: str, ids_fname: str, all_scores: list[array] | None,
+                out: TextIO | None = sys.stdout) -> list[array]:
+    """Add the scores of each system in an evaluation file to per-system arrays.
+
+    Illegal scores are added as NaN. The rows with the systems in their
+    original order are printed to `out`, if given.
+    """
+    with open(tsv_fname, 'r') as tsv_in, open(ids_fname, 'r') as ids_in:
+        for ids_str, (head, hyps, scores) in zip(ids_in, read_blocks(tsv_in)):
+            ids = [int(x) for x in ids_str.strip().split('\t')]
+            if all_scores is None:
+                all_scores = [array('d') for _ in ids]
+            elif len(ids) != len(all_scores):
+                raise ValueError(f'{ids_fname} has {len(ids)} systems instead of {len(all_scores)}')
+            out_cols = list(head)
+            for i, j in enumerate(ids):
+                out_cols += [hyps[j], scores[j]]
+                all_scores[i].append(parse_score(scores[j]))
+            if out is not None:
+                out.write('\t'.join(out_cols) + '\n')
+    return all_scores
+
+def bootstrap_means(scores: np.ndarray, num_samples: int, seed: int | None = None) -> np.ndarray:
+    """Calculate the mean score of each system on bootstrap samples of the items.
+
+    :param scores: a matrix with one row per item and one column per system,
+                   where NaN scores are left out of the means
+    :returns: a matrix with one row per sample and one column per system
+    """
+    rng = np.random.default_rng(seed)
+    valid = ~np.isnan(scores)
+    values = np.where(valid, scores, 0.0)
+    num_items, num_systems = scores.shape
+    # each sample of item indices gathers a row of scores for every system
+    block_size = max(1, MAX_CHUNK_INDICES // max(1, num_items * num_systems))
+    means = []
+    for start in range(0, num_samples, block_size):
+        ids = rng.integers(0, num_items, size=(min(block_size, num_samples-start), num_items))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means.append(values[ids].sum(axis=1) / valid[ids].sum(axis=1))
+    return np.concatenate(means) if means else np.empty((0, scores.shape[1]))
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('files', nargs='+', help='pairs of evaluation TSV and ID files')
+    p.add_argument('--num_samples', type=int, default=1000, help='the number of bootstrap samples')
+    p.add_argument('--seed', type=int, default=None, help='the random seed for bootstrap sampling')
+    p.add_argument('--profile', action='store_true', help='print the time spent reading scores, sampling and writing output to stderr')
+    args = p.parse_args()
+    if len(args.files) % 2:
+        p.error('files must be given as pairs of evaluation TSV and ID files')
+    if args.num_samples < 1:
+        p.error('--num_samples must be at least 1')
+
+    timer = PhaseTimer(args.profile)
     all_scores = None
-    for ids_str, data in zip(ids_in, parsed_tsv):
-        ids = [int(x) for x in ids_str.strip().split('\t')]
-        if not all_scores:
-            all_scores = [list() for _ in ids]
-        my_hyps = [data['hyps'][i] for i in ids]
-        my_scores = [data['scores'][i] for i in ids]
-        out_cols = [data['src']]
-        if 'ref' in data:
-            out_cols.append(data['ref'])
-        for i, (hyp, score) in enumerate(zip(my_hyps, my_scores)):
-            out_cols += [hyp, score]
-            try:
-                all_scores[i].append(float(score))
-            except:
-                print(f'WARNING: illegal score {score}', file=sys.stderr)
-        print('\t'.join(out_cols))
-    avg_scores = [str(np.average(x)) for x in all_scores]
-    print('\n--- Average Scores ---\n'+'\t'.join(avg_scores))
+    with timer.phase('load'):
+        for tsv_fname, ids_fname in zip(args.files[0::2], args.files[1::2]):
+            all_scores = read_scores(tsv_fname, ids_fname, all_scores)
+    if all_scores is None:
+        raise ValueError('No evaluated items found')
+    scores = np.stack([np.frombuffer(x, dtype=np.float64) for x in all_scores], axis=-1)
+    valid = ~np.isnan(scores)
+
+    with timer.phase('output'):
+        avg_scores = [str(np.average(scores[valid[:,i],i])) for i in range(scores.shape[1])]
+        print('\n--- Average Scores ---\n'+'\t'.join(avg_scores))
+
+    # Confidence intervals of the means, and the ratio of samples in which each
+    # system has a higher mean than each other system
+    with timer.phase('sample'):
+        means = bootstrap_means(scores, args.num_samples, args.seed)
+        wins = (means[:,:,None] > means[:,None,:]).mean(axis=0)
+        means.sort(axis=0)
+    with timer.phase('output'):
+        lows = means[int(len(means) * 0.025)]
+        highs = means[min(len(means)-1, int(len(means) * 0.975))]
+        print('\n--- 95% Confidence Intervals ---\n'+'\t'.join(f'[{lo:.3f}, {hi:.3f}]' for lo, hi in zip(lows, highs)))
+        names = [f'sys{i+1}' for i in range(scores.shape[1])]
+        print('\n--- Win Ratio (row system beats column system) ---')
+        print('\t'.join([''] + names))
+        for i, name in enumerate(names):
+            print('\t'.join([name] + ['-' if i == j else f'{wins[i,j]:.3f}' for j in range(len(names))]))
+        print('\n--- p value (row system is superior to column system) ---')
+        print('\t'.join([''] + names))
+        for i, name in enumerate(names):
+            print('\t'.join([name] + ['-' if i == j else f'{1-wins[i,j]:.3f}' for j in range(len(names))]))
+    timer.report()
 
+if __name__ == '__main__':
+    main()
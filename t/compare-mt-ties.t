@@ -0,0 +1,49 @@
+#!/usr/bin/perl
+use strict;
+use warnings;
+use File::Temp qw(tempfile);
+use FindBin;
+use Test::More;
+
+# N-grams with equal scores should be listed in the order of the original
+# compare-mt.py: when analyzing one system, the reference n-grams by first
+# occurrence and then the n-grams only in the output, and when comparing two
+# systems, the n-grams the second system matched more often first.
+
+my $python = $ENV{PYTHON} || 'python';
+
+sub write_lines {
+    my ($fh, $file) = tempfile(UNLINK => 1);
+    print $fh map { "$_\n" } @_;
+    close $fh;
+    return $file;
+}
+
+# The n-grams and scores of the first section of the n-gram report
+sub first_ngrams {
+    my @args = @_;
+    my @lines = `$python $FindBin::Bin/../compare-mt.py @args --ngram 1 --ngram_size 2`;
+    is($?, 0, "compare-mt.py runs with $#args system(s)");
+    my @ret;
+    foreach my $line (@lines[2 .. 3]) {
+        my ($ngram, $score) = split /\t| /, $line;
+        push @ret, "$ngram $score";
+    }
+    return join(', ', @ret);
+}
+
+plan tests => 4;
+
+# q is only in the output of the first line, and a is in the reference of the
+# second, both with a score of 1/3
+my $ref = write_lines('p', 'a');
+my $out = write_lines('q', 'a a a');
+is(first_ngrams($ref, $out), 'a 0.333333, q 0.333333', 'reference n-grams come first in ties');
+
+# j is matched once more by system 1 in the first line, and k once more by
+# system 2 in the second line and three times more by system 1 after that,
+# both with a score of 1/3
+$ref = write_lines('j', 'k', 'k', 'k', 'k');
+my $sys1 = write_lines('j', 'z', 'k', 'k', 'k');
+my $sys2 = write_lines('z', 'k', 'z', 'z', 'z');
+is(first_ngrams($ref, $sys1, $sys2), 'k 0.333333, j 0.333333', 'n-grams system 2 matched more come first in ties');
@@ -0,0 +1,50 @@
+#!/usr/bin/perl
+use strict;
+use warnings;
+use File::Temp qw(tempfile);
+use FindBin;
+use Test::More;
+
+use Levenshtein;
+
+# Pairs of reference and test strings, with the path and cost expected from
+# Levenshtein::distance. Several have more than one minimum path, where the
+# deletions and insertions should come first.
+my @cases = (
+    ["a b c", "a b c", "eee", 0],
+    ["", "a b", "ii", 2],
+    ["a b", "", "dd", 2],
+    ["a", "b", "s", 1.1],
+    ["a b", "b a", "ied", 2],
+    ["a b c", "a c", "ede", 1],
+    ["a c", "a b c", "eie", 1],
+    ["a b c d", "x y", "ssdd", 4.2],
+    ["the cat sat", "the the cat", "eied", 2],
+    ["a a b", "a b b", "ese", 1.1],
+    ["a b c d e f g h i j k", "k j i h g f e d c b a", "sssssesssss", 11],
+);
+
+plan tests => 2 * @cases + 1;
+
+foreach my $case (@cases) {
+    my ($ref, $test, $path, $cost) = @$case;
+    my ($hist, $dist) = Levenshtein::distance($ref, $test);
+    is("$hist $dist", "$path $cost", "Levenshtein.pm: '$ref' -> '$test'");
+}
+
+# levenshtein.py should give the same paths and costs, printed the same way
+my ($ref_fh, $ref_file) = tempfile(UNLINK => 1);
+my ($test_fh, $test_file) = tempfile(UNLINK => 1);
+print $ref_fh map { "$_->[0]\n" } @cases;
+print $test_fh map { "$_->[1]\n" } @cases;
+close $ref_fh; close $test_fh;
+my $python = $ENV{PYTHON} || 'python';
+my @lines = `$python $FindBin::Bin/../levenshtein.py $ref_file $test_file`;
+is($?, 0, 'levenshtein.py runs');
+foreach my $i (0 .. $#cases) {
+    my ($ref, $test) = @{$cases[$i]};
+    my ($hist, $dist) = Levenshtein::distance($ref, $test);
+    my $line = defined $lines[$i] ? $lines[$i] : '';
+    chomp $line;
+    is($line, "$hist\t$dist", "levenshtein.py: '$ref' -> '$test'");
+}